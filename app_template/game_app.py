@@ -22,7 +22,8 @@
 #
 #     def get_user_manager(self, application_settings):
 #         """
-#         This one should return application UserManager instance with application_settings
+#         This one should return application UserManager instance with application_settings.
+#         Use AsyncUserManager from engine.user.async_user_manager for non-blocking redis client.
 #
 #         :param application_settings:
 #         :return:
@@ -1,4 +1,6 @@
 from engine.common.data import DataObjectAbstract
+from engine.common.snapshot import load_snapshot
+from engine.user.user_stash import precompile_stash_values
 
 
 class GameData(DataObjectAbstract):
@@ -7,7 +9,12 @@ class GameData(DataObjectAbstract):
     """
 
     def __init__(self, settings):
-        self._data = 'Store game data into this variable'
+        game_data_settings = settings.get('game_data', {})
+        if game_data_settings.get('snapshot', False):
+            # read-only views of the compiled file, that all game processes of the machine share
+            self._data = load_snapshot(game_data_settings['dump_file']).data
+        else:
+            self._data = 'Store game data into this variable'
 
     @property
     def data(self):
@@ -43,6 +50,8 @@ class ContentManager(object):
     """
     This is main content manager object, that application would use
     """
+    # client payloads of the data are encoded once, increase it if the data is changed in place
+    content_version = 0
 
     def __init__(self, settings):
         self.settings = settings
@@ -53,6 +62,23 @@ class ContentManager(object):
     def game_data(self):
         return self._game_data.data
 
+    def content_files(self):
+        """
+        Files to watch for hot reload, content manager is built again when they change
+
+        :rtype: list
+        """
+        return [self.settings['game_data']['dump_file']]
+
     @property
     def static_data(self):
-        return self._static_data.data
\ No newline at end of file
+        return self._static_data.data
+
+    def precompile_stash_values(self):
+        """
+        Parse stash values of the game data (rewards, prices etc.) once at load time
+
+        :return: Compiled values count
+        :rtype: int
+        """
+        return precompile_stash_values(self.game_data)
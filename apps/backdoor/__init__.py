@@ -2,6 +2,7 @@ from logging import getLogger
 
 from engine.common.process import Process
 from engine.common.settings import load_settings
+from engine.common.telemetry import TelemetryCollector
 
 
 log = getLogger('process')
@@ -16,4 +17,5 @@ class BackdoorProcess(Process):
         port = self.settings['server']['backdoor']['port']
         super(BackdoorProcess, self).__init__(
             'backdoor', crc=crc, ports={'tornado': port},
-            external_address=address, settings=self.settings, loop=loop)
\ No newline at end of file
+            external_address=address, settings=self.settings, loop=loop)
+        self.telemetry = TelemetryCollector.from_settings(self.settings.get('telemetry', {}), loop=self.loop)
@@ -117,3 +117,25 @@ class CommandsLogHandler(AbstractBackdoorHandler, FlashMessageMixin):
         log = user_manager.get_commands_log(user_id)
         self.set_header("Content-Type", "application/json")
         self.write(json.dumps(log, indent=4))
+
+
+class PerformanceHandler(RequestHandler):
+    """
+    Live performance of game processes collected by telemetry. Pass format=json to get the data itself.
+    """
+
+    def initialize(self, collector=None):
+        """
+        :param collector: Telemetry collector of the backdoor process, None if telemetry is disabled
+        :type collector: engine.common.telemetry.TelemetryCollector
+        """
+        self.collector = collector
+
+    def get(self, *args, **kwargs):
+        data = self.collector.dump() if self.collector is not None else None
+        if self.get_argument('format', None) == 'json':
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps(data))
+            return
+        self.render('performance.html', data=data, refresh=self.get_argument('refresh', 5),
+                    format_timestamp=format_timestamp, message=None, active_url=lambda x: x, user_id=None)
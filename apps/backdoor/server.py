@@ -5,7 +5,7 @@ from zmq.eventloop.ioloop import install, IOLoop
 from engine.apps.backdoor.handlers import (
     BackdoorGateway, BackdoorUserHandler, MapHandler,
     BackdoorWipeHandler, BackdoorActiveProcessesHandler,
-    CommandsLogHandler)
+    CommandsLogHandler, PerformanceHandler)
 from engine.common.development import DevelopmentStaticHandler
 from engine.common.log import setup_logger
 from engine.utils.pathutils import norm_path
@@ -38,6 +38,7 @@ def _init(crc, settings_path):
         (r'/wipe/', BackdoorWipeHandler),
         (r'/map/', MapHandler),
         (r'/commands_log_(.*)\.json', CommandsLogHandler),
+        (r'/performance/', PerformanceHandler, {'collector': backdoor_process.telemetry}),
 
         (r'/static/(.+)', DevelopmentStaticHandler, {
             'path': [
@@ -55,6 +56,8 @@ def _init(crc, settings_path):
     application = Application(handlers, **tornado_settings)
     application.listen(tornado_port, address=backdoor_process.settings['server']['backdoor']['address'])
     getLogger('process').info('Tornado listening to port {0}'.format(tornado_port))
+    if backdoor_process.telemetry is not None:
+        getLogger('process').info('Collecting telemetry at {0}'.format(backdoor_process.telemetry.address))
 
     backdoor_process.start()
 
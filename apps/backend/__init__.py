@@ -35,7 +35,21 @@ class BackendProcess(Process):
         self.logger.info('Saving started.')
         initial_save, self.initial_save = self.initial_save, False
         start = seconds()
-        count = self.user_manager.dump_users(all=initial_save)
+        if initial_save:
+            batches = ((count, time) for count, time, _ in self.user_manager.dump_all_users_batches())
+        elif self.user_manager.dump_settings['streaming']:
+            batches = self.user_manager.dump_users_batches()
+        else:
+            batches = None
+        if batches is not None:
+            count = 0
+            for batch, (batch_count, batch_time) in enumerate(batches, 1):
+                count += batch_count
+                self.logger.info('Batch %s saved. Count: %s. Time: %.3fs. Users per second: %.1f',
+                                 batch, batch_count, batch_time, batch_count / max(batch_time, 0.001))
+        else:
+            count = self.user_manager.dump_users()
+        self.user_manager.prune_online_users()
         end = seconds()
         period = self.save_players_time
         self.logger.info('Saving done. Count: %s. Time: %.3fs. Period: %ss',
@@ -43,5 +57,5 @@ class BackendProcess(Process):
 
     def atexit(self):
         # NOTE: do not call this method if multiple backends are used
-        self.user_manager.remove_user_ttls()
-        self.logger.info("User's ttls have been removed")
+        count = self.user_manager.remove_user_ttls()
+        self.logger.info("User's ttls have been removed. Count: %s", count)
@@ -1,6 +1,11 @@
+from tornado.ioloop import PeriodicCallback
+
 from engine.apps.game.performance import PerformanceInfo
+from engine.commands.profiling import CommandProfiler
 from engine.common.process import Process
 from engine.common.settings import load_settings
+from engine.common.telemetry import TelemetryPublisher
+from engine.utils.timeutils import milliseconds
 
 
 class GameProcess(Process):
@@ -20,6 +25,19 @@ class GameProcess(Process):
             external_address=external_address, loop=loop, settings=self.settings)
 
         self.state = 'active'
+        self.performance = PerformanceInfo(self.server_id)
+        self.profiler = CommandProfiler.from_settings(self.settings.get('command_profiling', {}))
+        self.telemetry = TelemetryPublisher.from_settings(self.settings.get('telemetry', {}))
+        self._performance_callback = PeriodicCallback(
+            self.log_performance, milliseconds(self.settings['performance_info_time'])
+        )
 
     def start(self):
-        super(GameProcess, self).start()
\ No newline at end of file
+        self._performance_callback.start()
+        super(GameProcess, self).start()
+
+    def log_performance(self):
+        self.logger.info(self.performance.get())
+        if self.telemetry is not None:
+            self.telemetry.push(self.performance.snapshot(self.info.id))
+        self.performance.reset()
@@ -1,5 +1,7 @@
+from functools import partial
 from logging import getLogger
 
+from engine.common.data import ContentReloader, EncodedContent
 from engine.social.interface import connect_social_interface
 
 from game_app import GameApp
@@ -12,7 +14,7 @@ log = getLogger('process')
 
 def setup_game_server(application_settings, tornado_port):
     """
-    Setup environment. Prepare user manager, init database locks, content manager, social interface, static files etc.
+    Setup environment. Prepare user manager, init database locks, content reloader, social interface, static files etc.
 
     :param application_settings: Application settings
     :type application_settings: dict
@@ -32,7 +34,10 @@ def setup_game_server(application_settings, tornado_port):
 
     log.info('game.%s : Preparing content manager for game data. Building cache...', tornado_port)
 
-    content_manager = app.get_content_manager(application_settings)
+    reload_settings = application_settings.get('content_reload', {})
+    content = ContentReloader(partial(app.get_content_manager, application_settings),
+                              paths=reload_settings.get('paths') or None,
+                              check_period=reload_settings.get('check_period', 1000))
 
     log.info('game.%s : Content manager cache built successfully', tornado_port)
 
@@ -43,6 +48,7 @@ def setup_game_server(application_settings, tornado_port):
     return {
         'command_processor_class': command_processor_class,
         'user_manager': user_manager,
-        'content_manager': content_manager,
+        'content': content,
+        'encoded_content': EncodedContent(),
         'social': social_interface,
     }
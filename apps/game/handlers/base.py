@@ -11,7 +11,7 @@ class GameServerHandlerAbstract(DataHandler, metaclass=ABCMeta):
         Initialize game server handler with all required managers, social interfaces and other stuff.
 
         :param args:
-        :param kwargs: User manager, content manager, social interface are required to pass
+        :param kwargs: User manager, content reloader, social interface are required to pass
         :return:
         """
         self.logger = kwargs.pop('logger')
@@ -21,12 +21,11 @@ class GameServerHandlerAbstract(DataHandler, metaclass=ABCMeta):
             raise HTTPError(503)
         self.command_processor_class = kwargs.pop('command_processor_class')
         self.user_manager = kwargs.pop('user_manager')
-        self.content_manager = kwargs.pop('content_manager')
+        # the request keeps content it started with, whatever is reloaded meanwhile
+        self.content_manager = kwargs.pop('content').current
+        self.encoded_content = kwargs.pop('encoded_content')
         self.game_settings = kwargs.pop('game_settings')
         self.social_interface = kwargs.pop('social')
-        if self.game_settings['development_mode']:
-            # This will reload game data on each request, even if game data file haven't changed
-            self.content_manager.reload_game_data()
         super(GameServerHandlerAbstract, self).initialize(*args, **kwargs)
 
     @abstractmethod
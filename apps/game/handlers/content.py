@@ -0,0 +1,36 @@
+import hmac
+
+from tornado.gen import coroutine
+
+from engine.utils.dictutils import JSON
+from engine.utils.handlers import DataHandler
+
+__author__ = 'kollad'
+
+
+class ContentReloadHandler(DataHandler):
+    """
+    Reload content of the game process without a restart, the token from content_reload settings is required.
+    """
+    data_format = JSON
+
+    def initialize(self, content=None, token=None, **kwargs):
+        """
+        :param content: Content reloader of the process
+        :type content: engine.common.data.ContentReloader
+        :param token: Token to pass for reload
+        :type token: str
+        """
+        self.content = content
+        self.token = token
+        super(ContentReloadHandler, self).initialize(**kwargs)
+
+    @coroutine
+    def post(self, *args, **kwargs):
+        token = self.get_argument('token', '')
+        if not self.token or not hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8')):
+            self.set_status(403)
+            self.respond({'error': 'Invalid token'})
+            return
+        reloaded = yield self.content.reload()
+        self.respond({'reloaded': reloaded, 'version': self.content.version})
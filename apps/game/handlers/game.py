@@ -1,9 +1,10 @@
-from copy import deepcopy
 
-from tornado.gen import coroutine
+from time import perf_counter
+
+from tornado.gen import coroutine, maybe_future
 
 from engine.apps.game.handlers.base import GameServerHandlerAbstract
-from engine.utils.dictutils import dump_value
+from engine.utils.dictutils import encode_data_with, get_content_type
 from engine.utils.pathutils import norm_path
 from engine.utils.timeutils import milliseconds
 
@@ -32,16 +33,22 @@ class GameServerHandler(GameServerHandlerAbstract):
         else:
             self.user_id = self.get_argument('user_id')
             self.sid = self.get_argument('sid', None)
+            performance = self.server_process.performance
+            performance.requests += 1
+            performance.request_size += len(self.request.body)
+            start = milliseconds()
             if action == 'fetch_player':
                 self.logger.debug('Fetch player. User:{}. Sid:{}'.format(self.user_id, self.sid))
                 yield from self.fetch_player()
+                performance.fetch_time += milliseconds() - start
             elif action == 'run_commands':
                 commands = self.get_argument('commands')
                 testing = self.get_argument('testing', True)
                 if not testing:
-                    self.verify_session(self.user_id, self.sid)
+                    yield from self.verify_session(self.user_id, self.sid)
                 response = yield from self.run_commands(commands, self.user_id, log=True)
                 self.finish(self.respond({'response': response}))
+                performance.run_commands_time += milliseconds() - start
             else:
                 raise NotImplementedError('Action {} not implemented'.format(action))
 
@@ -52,7 +59,7 @@ class GameServerHandler(GameServerHandlerAbstract):
         :param sid:
         :return:
         """
-        user = self.user_manager.get(self.user_id)
+        user = yield maybe_future(self.user_manager.get(self.user_id))
         if user['social_data']['sid'] != sid:
             raise AttributeError("Invalid session id {} != {}".format(user['social_data']['sid'], sid))
 
@@ -72,7 +79,7 @@ class GameServerHandler(GameServerHandlerAbstract):
         :return:
         """
         response_events = []
-        user = self.user_manager.get(self.user_id)
+        user = yield maybe_future(self.user_manager.get(self.user_id))
         user.set_content_manager(self.content_manager)
         if user['new_user']:
             create_user_events = yield from self.run_commands(self._create_user_commands, self.user_id)
@@ -82,32 +89,40 @@ class GameServerHandler(GameServerHandlerAbstract):
             fetch_player_events = yield from self.run_commands(self._fetch_player_commands, self.user_id)
             response_events.append(fetch_player_events)
 
-        game_data = deepcopy(user.content_manager.game_data)
-        del game_data['location']
+        # game data is encoded once per content reload and copied into the response as it is
+        game_data = self.encoded_content.get('game_data', self.data_format, self.content_manager)
+        user = yield maybe_future(self.user_manager.get(self.user_id))
         self.finish(
             self.respond({
-                'user': dump_value(self.user_manager.get(self.user_id)),
-                'game_data': dump_value(game_data),
+                'user': user.dump(copy=False),
                 'response': response_events
-            })
+            }, encoded={'game_data': game_data.body})
         )
 
     def run_commands(self, commands, user_id, log=False):
         """
-        Run commands
+        Run commands. Concurrent requests of one user join the same transaction: they run one by one on the
+        loaded state and the state is saved once, but each request gets its own response.
 
         :param commands: List of commands
         :type commands: list
         :return: Response or nothing
         """
-        with (yield from self.user_manager.transaction(user_id)) as writable_state:
+        # parsed and checked before the state is locked, so malformed commands don't hold the lock
+        batch = self.command_processor_class.compile(commands)
+        start = perf_counter()
+        transaction = yield from self.user_manager.transaction(user_id)
+        self.server_process.performance.lock_wait_time += (perf_counter() - start) * 1000
+        with transaction as writable_state:
             command_processor = self.command_processor_class(
                 writable_state,
                 self.content_manager,
-                commands)
+                batch,
+                profiler=self.server_process.profiler)
             response = command_processor.run()
+        yield from transaction.wait()
         if log:
-            self.user_manager.log_commands(user_id, commands, response)
+            yield maybe_future(self.user_manager.log_commands(user_id, commands, response))
         return response
 
     @coroutine
@@ -143,17 +158,27 @@ class GameServerHandler(GameServerHandlerAbstract):
         }
         yield from self.run_commands([command], user_id=social_data['social_id'])
 
-    def respond(self, data=None):
+    def respond(self, data=None, encoded=None):
         """
         Respond to client or whatever requests game server and append current server time
 
         :param data: Response data
         :type data: dict
+        :param encoded: Response values already encoded in the data format by key
+        :type encoded: dict
         :return:
         """
         data = data or {}
         data['time'] = milliseconds()
-        super(GameServerHandler, self).respond(data)
+        if encoded:
+            body = encode_data_with(data, encoded, self.data_format)
+        else:
+            body = self.encode_data(data)
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+        self.server_process.performance.response_size += len(body)
+        self.set_header('Content-Type', get_content_type(self.data_format))
+        self.write(body)
 
     def static_url(self, path, include_host=False, **kwargs):
         """
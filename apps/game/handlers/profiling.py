@@ -0,0 +1,35 @@
+import hmac
+
+from engine.utils.dictutils import JSON
+from engine.utils.handlers import DataHandler
+
+__author__ = 'kollad'
+
+
+class CommandProfileHandler(DataHandler):
+    """
+    Command profile of the game process, the token from command_profiling settings is required. Pass reset=1
+    to start a new profile after reading this one.
+    """
+    data_format = JSON
+
+    def initialize(self, profiler=None, token=None, **kwargs):
+        """
+        :param profiler: Command profiler of the process
+        :type profiler: engine.commands.profiling.CommandProfiler
+        :param token: Token to pass for the profile
+        :type token: str
+        """
+        self.profiler = profiler
+        self.token = token
+        super(CommandProfileHandler, self).initialize(**kwargs)
+
+    def get(self, *args, **kwargs):
+        token = self.get_argument('token', '')
+        if not self.token or not hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8')):
+            self.set_status(403)
+            self.respond({'error': 'Invalid token'})
+            return
+        self.respond(self.profiler.dump())
+        if self.get_argument('reset', '0') == '1':
+            self.profiler.reset()
@@ -1,15 +1,25 @@
-from copy import deepcopy
-
 from tornado.gen import coroutine
 from tornado.web import asynchronous
 
 from engine.apps.game.handlers.base import GameServerHandlerAbstract
+from engine.utils.dictutils import get_content_type
 
 
 __author__ = 'kollad'
 
 
 class StaticDataHandler(GameServerHandlerAbstract):
+    """
+    Game data and static data for clients, encoded once per content reload. Responses have a strong ETag, distinct
+    for gzipped and identity bodies, so clients get 304 for content they already have. Content requested with its
+    version, ?v=<version of the content>, is cached for a year.
+    """
+    content_uris = {
+        '/data/game_data': 'game_data',
+        '/data/static_data': 'static_data',
+    }
+    versioned_max_age = 365 * 24 * 60 * 60  # seconds
+
     @asynchronous
     @coroutine
     def get(self, *args, **kwargs):
@@ -21,18 +31,37 @@ class StaticDataHandler(GameServerHandlerAbstract):
         self.process()
 
     def process(self):
-        request_uri = self.request.uri
-        if request_uri == '/data/game_data':
-            game_data = deepcopy(self.content_manager.game_data)
-            del game_data['location']
-            self.respond(game_data)
-        elif request_uri == '/data/static_data':
-            self.respond(self.content_manager.static_data)
-        else:
+        request_uri = self.request.path
+        try:
+            name = self.content_uris[request_uri]
+        except KeyError:
             raise NotImplementedError('Request uri {} not found'.format(request_uri))
+        self.respond_content(self.encoded_content.get(name, self.data_format, self.content_manager))
+
+    def respond_content(self, blob):
+        """
+        :param blob: Encoded content
+        :type blob: engine.common.data.EncodedBlob
+        """
+        gzipped = 'gzip' in self.request.headers.get('Accept-Encoding', '')
+        self.set_header('Content-Type', get_content_type(blob.data_format))
+        self.set_header('Etag', blob.gzipped_etag if gzipped else blob.etag)
+        self.set_header('Vary', 'Accept-Encoding')
+        if self.get_argument('v', None) == blob.version:
+            self.set_header('Cache-Control', 'public, max-age={}, immutable'.format(self.versioned_max_age))
+        else:
+            self.set_header('Cache-Control', 'no-cache')
+        if self.request.method in ('GET', 'HEAD') and self.check_etag_header():
+            self.set_status(304)
+            return
+        if gzipped:
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(blob.gzipped)
+        else:
+            self.write(blob.body)
 
     def get_game_data(self):
-        self.respond(self.content_manager.game_data)
+        self.respond_content(self.encoded_content.get('game_data', self.data_format, self.content_manager))
 
     def get_static_data(self):
-        self.respond(self.content_manager.static_data)
\ No newline at end of file
+        self.respond_content(self.encoded_content.get('static_data', self.data_format, self.content_manager))
@@ -1,38 +1,115 @@
 from engine.utils.timeutils import milliseconds
-from engine.utils.mathutils import Median
+from engine.utils.mathutils import QuantileSketch
 
 
 class PerformanceInfo(object):
-    __slots__ = ('_process_id', 'time', 'requests', 'fetch_time', 'run_commands_time', 'game_server_id')
+    __slots__ = ('time', 'requests', 'fetch_time', 'run_commands_time', 'lock_wait_time', 'redis_time',
+                 'request_size', 'response_size', 'game_server_id', '_round_trips_counter', '_round_trips_start')
 
-    def __init__(self, game_server_id):
+    # milliseconds and bytes, pushed to the telemetry collector
+    sketches = ('fetch_time', 'run_commands_time', 'lock_wait_time', 'redis_time', 'request_size', 'response_size')
+
+    def __init__(self, game_server_id, round_trips_counter=None):
+        """
+        :param game_server_id: Game server ID
+        :type game_server_id: str
+        :param round_trips_counter: Function that returns total redis round trips count of the process
+        """
         self.time = milliseconds()
         self.requests = 0
-        self.fetch_time = Median()
-        self.run_commands_time = Median()
+        # fixed memory, whatever the requests count between resets is
+        self.fetch_time = QuantileSketch()
+        self.run_commands_time = QuantileSketch()
+        # until the user state is locked and loaded, waiting for other requests of the user included
+        self.lock_wait_time = QuantileSketch()
+        # redis round trips of the user manager, see track_redis_time
+        self.redis_time = QuantileSketch()
+        self.request_size = QuantileSketch()
+        self.response_size = QuantileSketch()
         self.game_server_id = game_server_id
+        self._round_trips_counter = round_trips_counter
+        self._round_trips_start = self._count_round_trips()
+
+    def _count_round_trips(self):
+        if self._round_trips_counter is None:
+            return 0
+        return self._round_trips_counter()
+
+    def track_round_trips(self, round_trips_counter):
+        self._round_trips_counter = round_trips_counter
+        self._round_trips_start = self._count_round_trips()
+
+    def track_redis_time(self, user_manager):
+        """
+        Measure redis round trips of the user manager into redis_time
+
+        :type user_manager: engine.user.user_manager.UserManager
+        """
+        user_manager.track_round_trip_time(self.redis_time)
+
+    @property
+    def redis_round_trips(self):
+        return self._count_round_trips() - self._round_trips_start
+
+    @property
+    def period(self):
+        """
+        :return: Seconds since the last reset
+        :rtype: float
+        """
+        return float(milliseconds() - self.time) * .001
 
     def reset(self):
         self.time = milliseconds()
         self.requests = 0
-        self.fetch_time.clear()
-        self.run_commands_time.clear()
+        for name in self.sketches:
+            getattr(self, name).clear()
+        self._round_trips_start = self._count_round_trips()
 
     def dump(self):
-        return dict((s, getattr(self, s)) for s in self.__slots__)
+        data = dict((s, getattr(self, s)) for s in self.__slots__ if not s.startswith('_'))
+        data['redis_round_trips'] = self.redis_round_trips
+        return data
+
+    def snapshot(self, process_id):
+        """
+        Performance of the process since the last reset, sketches are dumped, so they can be merged by
+        the collector
+
+        :param process_id: Process ID, like game@machine.001.123
+        :type process_id: str
+        :rtype: dict
+        """
+        period = self.period
+        return {
+            'process_id': process_id,
+            'game_server_id': self.game_server_id,
+            'time': milliseconds(),
+            'period': period,
+            'requests': self.requests,
+            'rps': self.requests / period if period else 0,
+            'redis_round_trips': self.redis_round_trips,
+            'sketches': dict((name, getattr(self, name).dump()) for name in self.sketches),
+        }
 
     def get(self):
         if not self.requests:
             return 'Performance info: Empty'
 
-        period = float(milliseconds() - self.time) * .001
+        period = self.period
         rps = self.requests / period
+        data = self.dump()
         return ('Performance info: {game_server_id}\n'
                 'Period: {period:.2f}s, Requests: {requests}, Fetch count: {fetch_count}, '
                 'Run directive count: {run_directive_count}\n'
                 'Requests per second:          {rps:.2f}\n'
                 'Fetch time (ms):              {fetch_time}\n'
                 'Run commands time (ms):       {run_commands_time}\n'
+                'Lock wait time (ms):          {lock_wait_time}\n'
+                'Redis round trip time (ms):   {redis_time}\n'
+                'Response size (bytes):        {response_size}\n'
+                'Redis round trips:            {redis_round_trips}, per request: {round_trips_per_request:.2f}\n'
                 '------------------------------------------------------------------------').format(
-            game_server_id=self.game_server_id,
-            rps=rps, period=period, fetch_count=self.fetch_time.len, **self.dump())
\ No newline at end of file
+            rps=rps, period=period, fetch_count=self.fetch_time.len,
+            run_directive_count=self.run_commands_time.len,
+            round_trips_per_request=data['redis_round_trips'] / self.requests, **data)
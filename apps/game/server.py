@@ -1,12 +1,15 @@
 from logging import getLogger
+import signal
 
 from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import Application
 import tornado.netutil
 
 from engine.apps.game.environment import setup_game_server
+from engine.apps.game.handlers.content import ContentReloadHandler
 from engine.apps.game.handlers.game import GameServerHandler
+from engine.apps.game.handlers.profiling import CommandProfileHandler
 from engine.apps.game.handlers.static import StaticDataHandler
 from engine.common.development import DevelopmentStaticHandler
 from engine.common.log import setup_logger
@@ -33,6 +36,11 @@ def _init(index, crc, settings_path, server_id):
     tornado_port = game_server_process.ports['tornado']
     unix_socket = game_server_process.sockets['tornado']
     environment_variables = setup_game_server(settings, tornado_port)
+    user_manager = environment_variables['user_manager']
+    game_server_process.performance.track_round_trips(lambda: user_manager.redis_round_trips)
+    game_server_process.performance.track_redis_time(user_manager)
+    if game_server_process.telemetry is not None:
+        log.info('Pushing performance snapshots to {}'.format(game_server_process.telemetry.address))
     environment_variables['data_format'] = settings['data_format']
     environment_variables['game_settings'] = settings
     environment_variables['logger'] = log
@@ -44,6 +52,25 @@ def _init(index, crc, settings_path, server_id):
         (r'/', GameServerHandler, environment_variables),
 
     ]
+    content = environment_variables['content']
+    reload_settings = settings.get('content_reload', {})
+    if reload_settings.get('token'):
+        handlers.insert(0, (r'/content/reload', ContentReloadHandler,
+                            {'content': content, 'token': reload_settings['token']}))
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: _loop.add_callback_from_signal(content.reload))
+    watch = reload_settings.get('watch')
+    if watch is None:
+        watch = settings['development_mode']
+    if watch:
+        log.info('Watching content files: {}'.format(', '.join(content.paths) or 'none'))
+        PeriodicCallback(content.check, content.check_period).start()
+    if game_server_process.profiler is not None:
+        log.info('Command profiling on, sample rate: {}'.format(game_server_process.profiler.sample_rate))
+        profiling_token = settings['command_profiling'].get('token')
+        if profiling_token:
+            handlers.insert(0, (r'/profile/commands', CommandProfileHandler,
+                                {'profiler': game_server_process.profiler, 'token': profiling_token}))
     app_settings = {}
     if settings['development_mode']:
         log.info('Development mode on')
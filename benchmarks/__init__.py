@@ -0,0 +1,110 @@
+"""
+Micro benchmarks for the engine. Run them from the project root, e.g.:
+
+    python -m engine.benchmarks.user_codecs
+"""
+from random import Random
+from timeit import default_timer
+
+__author__ = 'kollad'
+
+
+RESOURCES = ['gold', 'coins', 'wood', 'stone', 'iron', 'food', 'energy', 'crystals', 'experience', 'level',
+             'tickets', 'keys', 'seeds', 'water', 'glass', 'planks', 'bricks', 'nails', 'rope', 'cloth']
+
+OBJECT_TYPES = ['house', 'tree', 'rock', 'farm', 'mill', 'well', 'fence', 'road', 'decor', 'workshop']
+
+
+def generate_user_state(objects=500, map_size=64, seed=0):
+    """
+    Generate user state that looks like a real one: resources, a map with tile grid, placed objects, open cells
+    and active processes.
+
+    :param objects: Placed map objects count
+    :type objects: int
+    :param map_size: Map side size in cells
+    :type map_size: int
+    :param seed: Random seed
+    :type seed: int
+    :return: User state
+    :rtype: dict
+    """
+    random = Random(seed)
+    user_id = str(random.randint(10 ** 9, 10 ** 10))
+    state = {
+        '_id': user_id,
+        'user_id': user_id,
+        'registration_time': 1400000000000 + random.randint(0, 10 ** 10),
+        'new_user': False,
+        '_id_counter': objects,
+        'social_data': {
+            'social_id': user_id,
+            'sid': random.getrandbits(64),
+            'first_name': 'Name',
+            'last_name': 'Surname',
+            'friends': [str(random.randint(10 ** 9, 10 ** 10)) for _ in range(random.randint(10, 100))],
+        },
+        'resources': dict((resource, random.randint(0, 100000)) for resource in RESOURCES),
+        'map': {
+            'tilegrid': [[random.randint(0, 3) for _ in range(map_size)] for _ in range(map_size)],
+            'open_cells': [[random.randrange(map_size), random.randrange(map_size)]
+                           for _ in range(map_size * 4)],
+            'areas': [random.randint(0, 1) for _ in range((map_size // 3) ** 2)],
+            'layers': {'ground': 'grass', 'water': [[random.randrange(map_size)] * 2 for _ in range(20)]},
+            'objects': {},
+        },
+        'active_processes': {},
+        'quests': dict(('quest_{}'.format(i), {'state': random.choice(['active', 'done']),
+                                               'progress': random.randint(0, 10)})
+                       for i in range(50)),
+    }
+    for index in range(objects):
+        object_id = str(index)
+        state['map']['objects'][object_id] = {
+            'id': object_id,
+            'type': random.choice(OBJECT_TYPES),
+            'position': [random.randrange(map_size), random.randrange(map_size)],
+            'rotation': random.randrange(4),
+            'level': random.randint(1, 10),
+            'state': {'built': random.random() > 0.1, 'harvest_time': random.randint(0, 10 ** 12)},
+        }
+        if random.random() < 0.1:
+            state['active_processes'][object_id] = {
+                'type': 'production',
+                'start_time': random.randint(0, 10 ** 12),
+                'duration': random.randint(1000, 10 ** 6),
+                'reward': {'gold': random.randint(1, 100)},
+            }
+    return state
+
+
+def measure(function, *args, repeat=5, number=None, min_time=0.2):
+    """
+    Measure function call time
+
+    :param function: Function to measure
+    :param repeat: Measurements count, the best one is returned
+    :type repeat: int
+    :param number: Calls per measurement, it is calibrated to take at least min_time if not set
+    :type number: int
+    :return: Best time per call in seconds
+    :rtype: float
+    """
+    if number is None:
+        number = 1
+        while True:
+            start = default_timer()
+            for _ in range(number):
+                function(*args)
+            if default_timer() - start >= min_time:
+                break
+            number *= 2
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        for _ in range(number):
+            function(*args)
+        elapsed = (default_timer() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
@@ -0,0 +1,149 @@
+"""
+Compare game processes loading content from json against mapping a compiled snapshot: startup time, memory of
+a process after loading, after reading a share of the content and after reading all of it, and lookup time.
+Content is loaded as game servers do, through ContentReloader, so stash values are precompiled too. Each
+measurement runs in a fresh process, memory is taken from /proc, so it's measured on Linux only. Private memory
+is what each of the game processes of a machine keeps by itself, the mapped snapshot is shared between them.
+
+    python -m engine.benchmarks.content_snapshot --buildings 2000 --levels 20
+"""
+from argparse import ArgumentParser
+from functools import partial
+from multiprocessing import get_context
+from random import Random
+from timeit import default_timer
+import json
+import os
+import shutil
+import tempfile
+
+from engine.benchmarks import RESOURCES
+from engine.common.data import ContentReloader
+from engine.common.snapshot import load_snapshot
+from engine.user.user_stash import precompile_stash_values
+
+__author__ = 'kollad'
+
+
+def generate_game_data(buildings, levels, seed=0):
+    random = Random(seed)
+    game_data = {'buildings': {}, 'quests': {}, 'location': {}}
+    for index in range(buildings):
+        game_data['buildings']['building_{}'.format(index)] = {
+            'size': [random.randint(1, 4), random.randint(1, 4)],
+            'category': random.choice(['house', 'farm', 'decor', 'workshop']),
+            'levels': [{
+                'price': dict((resource, '{}:{}'.format(level * 10, level * 20))
+                              for resource in random.sample(RESOURCES, 3)),
+                'reward': dict((resource, '{}%50'.format(level)) for resource in random.sample(RESOURCES, 2)),
+                'build_time': random.randint(60, 86400),
+                'experience': level * random.randint(1, 100),
+                'requirements': {'level': level, 'building': 'building_{}'.format(random.randrange(buildings))},
+            } for level in range(1, levels + 1)],
+        }
+    for index in range(buildings // 2):
+        game_data['quests']['quest_{}'.format(index)] = {
+            'goals': [{'type': 'build', 'target': 'building_{}'.format(random.randrange(buildings)),
+                       'count': random.randint(1, 5)} for _ in range(3)],
+            'reward': {'gold': random.randint(10, 1000), 'experience': random.randint(10, 100)},
+            'description': 'Quest description {}'.format(index),
+        }
+    game_data['location'] = {'tiles': [[random.randint(0, 3) for _ in range(128)] for _ in range(128)]}
+    return game_data
+
+
+def memory():
+    """
+    :return: Resident and private resident memory of the process in megabytes
+    """
+    values = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('VmRSS', 'RssAnon'):
+                values[name] = int(value.split()[0]) / 1024
+    return values.get('VmRSS', 0), values.get('RssAnon', 0)
+
+
+class ContentManager(object):
+    """
+    Game data of the app template content manager
+    """
+
+    def __init__(self, path, mode):
+        if mode == 'json':
+            with open(path) as f:
+                self.game_data = json.load(f)
+        else:
+            self.game_data = load_snapshot(path).data
+
+    def precompile_stash_values(self):
+        return precompile_stash_values(self.game_data)
+
+
+def read(game_data, buildings, share, random):
+    """
+    Read levels of a share of buildings, as commands do
+    """
+    total = 0
+    for index in random.sample(range(buildings), int(buildings * share)):
+        building = game_data['buildings']['building_{}'.format(index)]
+        for level in building['levels']:
+            total += level['experience'] + len(level['price'])
+    return total
+
+
+def worker(path, mode, options, results):
+    start = default_timer()
+    content = ContentReloader(partial(ContentManager, path, mode), paths=[path])
+    load_time = default_timer() - start
+    loaded_memory = memory()
+    game_data = content.current.game_data
+    start = default_timer()
+    read(game_data, options.buildings, options.share, Random(1))
+    read_time = default_timer() - start
+    # content read by requests is mostly the same
+    start = default_timer()
+    read(game_data, options.buildings, options.share, Random(1))
+    read_again_time = default_timer() - start
+    read_memory = memory()
+    read(game_data, options.buildings, 1, Random(1))
+    results.put((mode, load_time, loaded_memory, read_time, read_again_time, read_memory, memory()))
+
+
+def run(options):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'game_data.json')
+        with open(path, 'w') as f:
+            json.dump(generate_game_data(options.buildings, options.levels), f)
+        start = default_timer()
+        snapshot = load_snapshot(path)
+        compile_time = default_timer() - start
+        print('json: {:.1f} MB, snapshot: {:.1f} MB, compiled once in {:.0f} ms'.format(
+            os.path.getsize(path) / 2 ** 20, len(snapshot) / 2 ** 20, compile_time * 1000))
+
+        context = get_context('spawn')
+        results = context.Queue()
+        print('{:<10} {:>10} {:>10} {:>12} {:>10} {:>14} {:>12} {:>14} {:>14}'.format(
+            'mode', 'load, ms', 'RSS, MB', 'private, MB', 'read, ms', 'read again, ms', 'RSS read, MB',
+            'private read', 'private all'))
+        for mode in ('json', 'snapshot'):
+            process = context.Process(target=worker, args=(path, mode, options, results))
+            process.start()
+            mode, load_time, (rss, private), read_time, read_again_time, (read_rss, read_private), \
+                (_, all_private) = results.get()
+            process.join()
+            print('{:<10} {:>10.1f} {:>10.1f} {:>12.1f} {:>10.1f} {:>14.1f} {:>12.1f} {:>14.1f} {:>14.1f}'.format(
+                mode, load_time * 1000, rss, private, read_time * 1000, read_again_time * 1000, read_rss,
+                read_private, all_private))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--buildings', type=int, default=2000)
+    parser.add_argument('--levels', type=int, default=20)
+    parser.add_argument('--share', type=float, default=0.1, help='Share of buildings read after loading')
+    run(parser.parse_args())
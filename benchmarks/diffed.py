@@ -0,0 +1,77 @@
+"""
+Compare Diffed lookups with and without materialized mode over diff stack depth and document size: reading every
+key, keys and len, and reading a key after every write.
+
+    python -m engine.benchmarks.diffed
+"""
+from copy import deepcopy
+from random import Random
+
+from engine.benchmarks import measure
+from engine.utils.dictutils import Diffed
+
+__author__ = 'kollad'
+
+
+DEPTHS = [1, 8, 32]
+SIZES = [100, 1000]
+WRITES = 100
+
+
+def generate_document(size, depth, random):
+    data = {}
+    for index in range(size):
+        key = 'field_{}'.format(index)
+        if index % 4:
+            data[key] = random.randint(0, 1000)
+        else:
+            data[key] = {'level': random.randint(1, 10), 'state': {'built': True}}
+    diffs = []
+    for _ in range(depth):
+        diff = {}
+        for key in random.sample(list(data), max(size // 20, 1)):
+            if isinstance(data[key], dict):
+                diff[key] = {'level': random.randint(1, 10)}
+            else:
+                diff[key] = random.randint(0, 1000)
+        diffs.append(diff)
+    return data, diffs
+
+
+def run():
+    random = Random(0)
+    print('{:<6} {:<6} {:<14} {:>12} {:>12} {:>10}'.format('size', 'depth', 'operation', 'plain, ms',
+                                                           'cached, ms', 'speedup'))
+    for size in SIZES:
+        for depth in DEPTHS:
+            data, diffs = generate_document(size, depth, random)
+            keys = list(data)
+            # plain values are written, the first, nested one is read
+            plain_keys = [key for key in keys if not isinstance(data[key], dict)]
+            written = [random.choice(plain_keys) for _ in range(WRITES)]
+            plain = Diffed(deepcopy(data), deepcopy(diffs))
+            cached = Diffed(deepcopy(data), deepcopy(diffs), materialized=True)
+
+            def read_all(document):
+                for key in keys:
+                    document[key]
+
+            def count_keys(document):
+                return len(document), document.keys()
+
+            def write_and_read(document):
+                for key in written:
+                    document[key] = document[keys[0]]['level']
+                    len(document)
+
+            for operation, function in [('read all', read_all), ('keys and len', count_keys),
+                                        ('write and read', write_and_read)]:
+                plain_time = measure(function, plain)
+                cached_time = measure(function, cached)
+                print('{:<6} {:<6} {:<14} {:>12.3f} {:>12.3f} {:>9.1f}x'.format(
+                    size, depth, operation, plain_time * 1000, cached_time * 1000, plain_time / cached_time))
+            assert plain.dump() == cached.dump()
+
+
+if __name__ == '__main__':
+    run()
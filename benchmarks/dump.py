@@ -0,0 +1,37 @@
+"""
+Compare ways to dump and encode user states: dumping with and without copying plain subtrees, serializing for
+the json codec, and json encoding of views with and without dumping them first.
+
+    python -m engine.benchmarks.dump
+"""
+import json
+
+from engine.benchmarks import generate_user_state, measure
+from engine.common.serializers import serialize
+from engine.utils.dictutils import DictView, dump_value, encode_data, iter_json
+
+__author__ = 'kollad'
+
+
+STATES = [('small', 50, 24), ('medium', 500, 64), ('big', 3000, 128)]
+
+
+def run():
+    print('{:<8} {:<24} {:>10}'.format('state', 'method', 'time, ms'))
+    for state_name, objects, map_size in STATES:
+        state = generate_user_state(objects=objects, map_size=map_size)
+        view = DictView(state)
+        encoded = json.dumps(dump_value(view))
+        assert encode_data(view) == encoded
+        assert b''.join(iter_json(view)).decode('utf-8') == encoded
+        for method, function in [('dump_value', lambda: dump_value(view)),
+                                 ('dump_value, no copy', lambda: dump_value(view, copy=False)),
+                                 ('serialize', lambda: serialize(state)),
+                                 ('dump and encode', lambda: json.dumps(dump_value(view))),
+                                 ('encode view', lambda: encode_data(view)),
+                                 ('iter_json', lambda: list(iter_json(view)))]:
+            print('{:<8} {:<24} {:>10.3f}'.format(state_name, method, measure(function) * 1000))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,135 @@
+"""
+Requests per second of a single game process with many concurrent users, with blocking and asynchronous user
+managers. Every request runs a transaction on its user state: lock, load, modify, save and unlock. Users are saved
+to redis before the run, so mongo is never used, but redis is flushed, so use a dedicated database.
+
+    python -m engine.benchmarks.game_requests --users 500 --concurrency 200 --requests 10000
+"""
+from argparse import ArgumentParser
+from multiprocessing import get_context
+import json
+import time
+
+from tornado.gen import coroutine, maybe_future
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.web import Application, RequestHandler
+
+from engine.benchmarks import generate_user_state
+from engine.user.async_user_manager import AsyncUserManager
+from engine.user.user_manager import UserManager
+
+__author__ = 'kollad'
+
+
+MANAGERS = [('blocking', UserManager), ('async', AsyncUserManager)]
+
+
+def make_settings(options):
+    return {
+        'user_manager': {
+            'redis': {'host': options.host, 'port': options.port, 'password': '', 'db': options.db,
+                      'pool_size': options.pool_size,
+                      'log_commands': {'enable': False, 'size': 0, 'ttl': 0}},
+            'mongo': {'host': 'localhost', 'port': 27017, 'db_name': 'benchmark', 'collection': 'users'},
+            'storage': options.storage,
+            'codec': options.codec,
+            'cache': {'enable': True, 'size': options.users},
+            'lock': {'mode': options.lock},
+            'fixed_random_seed': True,
+        },
+        'user': {'session_ttl': 1800, 'starting_state': {}},
+    }
+
+
+class TransactionHandler(RequestHandler):
+    def initialize(self, user_manager):
+        self.user_manager = user_manager
+
+    @coroutine
+    def get(self, user_id):
+        transaction = yield from self.user_manager.transaction(user_id)
+        with transaction as writable_state:
+            resources = writable_state['resources']
+            resources['gold'] += 1
+            response = {'gold': resources['gold']}
+        yield from transaction.wait()
+        yield maybe_future(self.user_manager.log_commands(user_id, [], response))
+        self.finish(json.dumps(response))
+
+
+def serve(options, manager_class):
+    user_manager = manager_class(make_settings(options))
+    application = Application([(r'/(\w+)', TransactionHandler, {'user_manager': user_manager})])
+    application.listen(options.http_port, address='127.0.0.1')
+    IOLoop.instance().start()
+
+
+@coroutine
+def load(options):
+    client = AsyncHTTPClient(max_clients=options.concurrency)
+    url = 'http://127.0.0.1:{}/{{}}'.format(options.http_port)
+    remaining = [options.requests]
+    errors = [0]
+
+    @coroutine
+    def user_session(index):
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            response = yield client.fetch(url.format(index % options.users), raise_error=False)
+            if response.code != 200:
+                errors[0] += 1
+
+    start = time.time()
+    yield [user_session(index) for index in range(options.concurrency)]
+    return time.time() - start, errors[0]
+
+
+def wait_server(options):
+    client = AsyncHTTPClient()
+    url = 'http://127.0.0.1:{}/0'.format(options.http_port)
+    for _ in range(100):
+        try:
+            IOLoop.current().run_sync(lambda: client.fetch(url))
+            return
+        except Exception:
+            time.sleep(0.1)
+    raise RuntimeError('Game server has not started')
+
+
+def run():
+    parser = ArgumentParser(description='Game process requests per second benchmark')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--pool-size', type=int, default=100)
+    parser.add_argument('--http-port', type=int, default=9181)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--objects', type=int, default=100, help='Map objects of every user state')
+    parser.add_argument('--storage', default='blob')
+    parser.add_argument('--codec', default='json')
+    parser.add_argument('--lock', default='notify')
+    options = parser.parse_args()
+
+    print('{:<10} {:>10} {:>12} {:>8}'.format('manager', 'time, s', 'requests/s', 'errors'))
+    for name, manager_class in MANAGERS:
+        user_manager = UserManager(make_settings(options))
+        user_manager.redis.flushdb()
+        for index in range(options.users):
+            user_manager.save(str(index), generate_user_state(objects=options.objects, seed=index))
+        # spawned, not forked, so the server doesn't share the parent's ioloop
+        server = get_context('spawn').Process(target=serve, args=(options, manager_class))
+        server.start()
+        try:
+            wait_server(options)
+            elapsed, errors = IOLoop.current().run_sync(lambda: load(options))
+        finally:
+            server.terminate()
+            server.join()
+        print('{:<10} {:>10.2f} {:>12.1f} {:>8}'.format(name, elapsed, options.requests / elapsed, errors))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,110 @@
+"""
+Compare polling and notified user lock acquisition under contention: several processes, each running several
+coroutines, lock the same few keys and hold the lock for a while. Redis commands are counted with INFO
+commandstats, so the benchmark needs a dedicated redis server.
+
+    python -m engine.benchmarks.lock_contention --processes 4 --waiters 8 --keys 2
+"""
+from argparse import ArgumentParser
+from multiprocessing import get_context
+
+from redis import StrictRedis
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from engine.user.lock import RedisLock, LockRedisMixin, LockNotifier
+from engine.utils.asyncutils import sleep
+
+__author__ = 'kollad'
+
+
+class LockRedis(StrictRedis, LockRedisMixin):
+    pass
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def worker(options, mode, results):
+    ioloop = IOLoop()
+    ioloop.make_current()
+    redis = LockRedis(options.host, options.port, options.db)
+    redis.init_lock_script()
+    notifier = LockNotifier(redis, ioloop) if mode == 'notify' else None
+    waits = []
+
+    @coroutine
+    def contend(index):
+        key = 'benchmark:{}'.format(index % options.keys)
+        for _ in range(options.rounds):
+            lock = RedisLock(redis, key, ioloop, notifier)
+            start = ioloop.time()
+            yield from lock.acquire(timeout=60)
+            waits.append(ioloop.time() - start)
+            yield from sleep(options.hold / 1000, ioloop)
+            lock.release()
+
+    @coroutine
+    def run():
+        yield [contend(index) for index in range(options.waiters)]
+
+    start = ioloop.time()
+    ioloop.run_sync(run)
+    elapsed = ioloop.time() - start
+    if notifier is not None:
+        notifier.stop()
+    results.put((waits, elapsed))
+
+
+def commands_count(redis):
+    return dict((command, stats['calls']) for command, stats in redis.info('commandstats').items())
+
+
+def run_mode(options, mode):
+    redis = StrictRedis(options.host, options.port, options.db)
+    before = commands_count(redis)
+    context = get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(options, mode, results)) for _ in range(options.processes)]
+    for process in processes:
+        process.start()
+    waits = []
+    elapsed = 0
+    for _ in processes:
+        process_waits, process_elapsed = results.get()
+        waits.extend(process_waits)
+        elapsed = max(elapsed, process_elapsed)
+    for process in processes:
+        process.join()
+    after = commands_count(redis)
+    delta = dict((command, after.get(command, 0) - before.get(command, 0)) for command in after)
+    # INFO itself is counted too
+    delta['cmdstat_info'] = delta.get('cmdstat_info', 0) - 1
+    total = sum(delta.values())
+    print('{:<8} {:>10.2f} {:>12.1f} {:>10.2f} {:>10.2f} {:>10} {:>12.1f}'.format(
+        mode, elapsed, len(waits) / elapsed, percentile(waits, 0.5) * 1000, percentile(waits, 0.99) * 1000,
+        total, total / len(waits)))
+
+
+def run():
+    parser = ArgumentParser(description='User lock contention benchmark')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--waiters', type=int, default=8, help='Coroutines per process')
+    parser.add_argument('--keys', type=int, default=2)
+    parser.add_argument('--rounds', type=int, default=10, help='Acquisitions per coroutine')
+    parser.add_argument('--hold', type=float, default=2, help='Lock hold time, ms')
+    options = parser.parse_args()
+
+    print('{:<8} {:>10} {:>12} {:>10} {:>10} {:>10} {:>12}'.format(
+        'mode', 'time, s', 'locks/s', 'p50, ms', 'p99, ms', 'commands', 'per lock'))
+    for mode in ('poll', 'notify'):
+        run_mode(options, mode)
+
+
+if __name__ == '__main__':
+    run()
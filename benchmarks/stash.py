@@ -0,0 +1,74 @@
+"""
+Compare stash arithmetic on user resources: the generic path, that parses and rolls every operand, against
+the plain numbers path and batched deltas.
+
+    python -m engine.benchmarks.stash
+"""
+import operator
+from random import Random
+
+from engine.benchmarks import RESOURCES, measure
+from engine.user.user_stash import Stash
+from engine.user.user_state import UserStash
+
+__author__ = 'kollad'
+
+
+DELTAS = 100
+DELTA_SIZES = [1, 5, 20]
+
+
+def generic_operation(stash, other, op):
+    # operation as it is done for values, that should be parsed
+    for key, value in Stash(other, random=stash.random).items():
+        stash._apply_operator(key, value, op)
+    return stash
+
+
+def generate_deltas(size, random):
+    deltas = []
+    for _ in range(DELTAS):
+        deltas.append(dict((resource, random.randint(1, 100)) for resource in random.sample(RESOURCES, size)))
+    return deltas
+
+
+def run():
+    random = Random(0)
+    print('{:<6} {:<16} {:>14} {:>10}'.format('keys', 'method', 'deltas/sec', 'speedup'))
+    for size in DELTA_SIZES:
+        add = generate_deltas(size, random)
+        subtract = generate_deltas(size, random)
+
+        def make_stash():
+            return UserStash({'resources': dict.fromkeys(RESOURCES, 10 ** 6)}, random=random)
+
+        def run_generic():
+            stash = make_stash()
+            for delta in add:
+                generic_operation(stash, delta, operator.add)
+            for delta in subtract:
+                generic_operation(stash, delta, operator.sub)
+            return stash
+
+        def run_plain():
+            stash = make_stash()
+            for delta in add:
+                stash += delta
+            for delta in subtract:
+                stash -= delta
+            return stash
+
+        def run_batched():
+            return make_stash().apply_deltas(add, subtract)
+
+        expected = dict(run_generic())
+        baseline = None
+        for method, function in [('generic', run_generic), ('plain', run_plain), ('apply_deltas', run_batched)]:
+            assert dict(function()) == expected
+            rate = DELTAS * 2 / measure(function)
+            baseline = baseline or rate
+            print('{:<6} {:<16} {:>14,.0f} {:>9.1f}x'.format(size, method, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    run()
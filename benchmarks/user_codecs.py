@@ -0,0 +1,35 @@
+"""
+Compare user state codecs: encode and decode time and encoded size on generated user states.
+
+    python -m engine.benchmarks.user_codecs
+"""
+from engine.benchmarks import generate_user_state, measure
+from engine.user.codecs import JSON, MSGPACK, MSGPACK_ZLIB, MSGPACK_LZ4, get_codec, decode_data
+
+__author__ = 'kollad'
+
+
+CODECS = [JSON, MSGPACK, MSGPACK_ZLIB, MSGPACK_LZ4]
+STATES = [('small', 50, 24), ('medium', 500, 64), ('big', 3000, 128)]
+
+
+def run():
+    print('{:<8} {:<14} {:>12} {:>12} {:>12}'.format('state', 'codec', 'size, KB', 'encode, ms', 'decode, ms'))
+    for state_name, objects, map_size in STATES:
+        state = generate_user_state(objects=objects, map_size=map_size)
+        for codec_name in CODECS:
+            try:
+                codec = get_codec(codec_name)
+            except ImportError as e:
+                print('{:<8} {:<14} skipped: {}'.format(state_name, codec_name, e))
+                continue
+            encoded = codec.encode(state)
+            assert decode_data(encoded) == state
+            encode_time = measure(codec.encode, state)
+            decode_time = measure(decode_data, encoded)
+            print('{:<8} {:<14} {:>12.1f} {:>12.3f} {:>12.3f}'.format(
+                state_name, codec_name, len(encoded) / 1024, encode_time * 1000, decode_time * 1000))
+
+
+if __name__ == '__main__':
+    run()
@@ -8,33 +8,143 @@ __author__ = 'kollad'
 
 log = getLogger('process')
 
+NoneType = type(None)
+
+
+class CommandError(Exception):
+    pass
+
+
+def compile_schema(schema):
+    """
+    Compile command arguments schema into checks, that are run for every command of the class
+
+    :param schema: Argument types by argument name, either a type or a tuple of types. Argument is optional,
+        if None is one of its types
+    :type schema: dict
+    :return: Tuple of (argument name, types, required) tuples or None if arguments are not checked
+    :rtype: tuple
+    """
+    if schema is None:
+        return None
+    checks = []
+    for name, types in sorted(schema.items()):
+        if not isinstance(types, tuple):
+            types = (types,)
+        types = tuple(NoneType if value_type is None else value_type for value_type in types)
+        if float in types and int not in types:
+            # json has a single number type
+            types += (int,)
+        checks.append((name, types, NoneType not in types))
+    return tuple(checks)
+
+
+class CommandBatch(object):
+    """
+    Commands of a request, parsed, resolved and checked once before any of them runs. Command classes are taken
+    from the registry by name, arguments are checked with the schemas compiled when command classes are defined.
+    """
+    __slots__ = ('commands', 'names')
+
+    def __init__(self, registry, commands_list):
+        """
+        :param registry: Command classes by name
+        :type registry: dict
+        :param commands_list: Commands as json or list of dicts with name and arguments
+        :type commands_list: str or list
+        :raises: CommandError if a command is unknown or its arguments don't match its schema
+        """
+        if isinstance(commands_list, (str, bytes)):
+            # freshly parsed, nobody else refers to the commands, so there is no need to copy them
+            try:
+                commands_list = json.loads(commands_list)
+            except ValueError as e:
+                raise CommandError('Commands are not valid json: {}'.format(e))
+        else:
+            commands_list = deepcopy(commands_list)
+        if not isinstance(commands_list, list):
+            raise CommandError('Commands should be a list')
+        self.commands = commands = []
+        self.names = names = []
+        for index, data in enumerate(commands_list):
+            try:
+                name = data['name']
+                command_class = registry[name]
+            except (KeyError, TypeError):
+                raise CommandError('Unknown command #{}: {!r}'.format(index, data))
+            arguments = data.get('arguments', {})
+            checks = command_class.argument_checks
+            if checks is not None:
+                self.check_arguments(name, arguments, checks)
+            commands.append((command_class, arguments))
+            names.append(name)
+
+    @staticmethod
+    def check_arguments(name, arguments, checks):
+        if not isinstance(arguments, dict):
+            raise CommandError('Arguments of {} should be an object'.format(name))
+        for argument, types, required in checks:
+            try:
+                value = arguments[argument]
+            except KeyError:
+                if required:
+                    raise CommandError('Argument {} of {} is missing'.format(argument, name))
+                continue
+            if not isinstance(value, types):
+                raise CommandError('Argument {} of {} should be {}, not {}'.format(
+                    argument, name, ' or '.join(value_type.__name__ for value_type in types), type(value).__name__))
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(self.commands)
+
 
 class CommandProcessor(object):
     command_class = None  # must be implemented in a subclass
 
-    def __init__(self, writable_state, content_manager, commands_list):
+    def __init__(self, writable_state, content_manager, commands_list, profiler=None):
+        """
+        :param profiler: Profiler of sampled commands
+        :type profiler: engine.commands.profiling.CommandProfiler
+        """
         assert issubclass(self.command_class, BaseCommand), self.command_class
         self.writable_state = writable_state
         self.content_manager = content_manager
+        self.profiler = profiler
+        if not isinstance(commands_list, CommandBatch):
+            commands_list = self.compile(commands_list)
+        self.batch = commands_list
 
-        if isinstance(commands_list, str):
-            commands_list = json.loads(commands_list)
+    @classmethod
+    def compile(cls, commands_list):
+        """
+        Parse and check commands, e.g. before the user state is locked
 
-        self.commands_list = deepcopy(commands_list)
+        :param commands_list: Commands as json or list of dicts with name and arguments
+        :type commands_list: str or list
+        :return: Command batch to pass to the processor
+        :rtype: CommandBatch
+        :raises: CommandError
+        """
+        return CommandBatch(cls.command_class.registry, commands_list)
 
     def run(self):
         response_events = []
-        processed_commands = []
-        for data in self.commands_list:
-            command = self.command_class.create(
-                self.writable_state, self.content_manager,
-                data['name'], data.get('arguments', {}),
-            )
-            command.run()
+        writable_state = self.writable_state
+        content_manager = self.content_manager
+        profiler = self.profiler
+        create = self.command_class.create
+        for name, (command_class, arguments) in zip(self.batch.names, self.batch):
+            command = create(writable_state, content_manager, name, arguments)
+            if profiler is not None and profiler.sample():
+                profiler.run(name, command)
+            else:
+                command.run()
             response_events.extend(command.response_events)
-            processed_commands.append(data['name'])
 
-        self.log(processed_commands, response_events)
+        self.log(self.batch.names, response_events)
 
         return [event.dump() for event in response_events]
 
@@ -59,6 +169,7 @@ class CommandProcessor(object):
 class CommandMeta(type):
     def __init__(self, name, bases, command):
         super(CommandMeta, self).__init__(name, bases, command)
+        self.argument_checks = compile_schema(self.schema)
         if command.get('disabled', False):
             return
         self.registry[name] = self
@@ -67,6 +178,9 @@ class CommandMeta(type):
 class BaseCommand(metaclass=CommandMeta):
     registry = None  # must be implemented in a subclass
     disabled = True
+    # argument types by argument name, e.g. {'item_id': str, 'count': int, 'position': (list, None)},
+    # arguments are not checked if None
+    schema = None
 
     def __init__(self, user_state, content_manager, arguments):
         self.user_state = user_state
@@ -0,0 +1,201 @@
+from bisect import bisect_left
+from random import Random
+import time
+
+from engine.utils.timeutils import milliseconds
+
+__author__ = 'kollad'
+
+
+class Histogram(object):
+    """
+    Histogram with fixed bucket bounds, cheap to update. Percentiles are estimated by the upper bound
+    of the bucket they fall into.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds):
+        """
+        :param bounds: Sorted upper bounds of buckets, values greater than the last one go to an overflow bucket
+        :type bounds: tuple
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def __add__(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        return self
+
+    def percentile(self, q):
+        """
+        :param q: Quantile from 0 to 1
+        :type q: float
+        :return: Upper bound of the bucket of the quantile, the max value for the overflow bucket
+        :rtype: float
+        """
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index == len(self.bounds):
+                    return self.max
+                return min(self.bounds[index], self.max)
+        return self.max
+
+    def dump(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'avg': self.sum / max(self.count, 1),
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': [[bound, count] for bound, count in zip(self.bounds + ('inf',), self.counts) if count],
+        }
+
+
+class CommandStats(object):
+    # milliseconds
+    time_bounds = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+    # kilobytes
+    allocation_bounds = (1, 4, 16, 64, 256, 1024, 4096, 16384, 65536)
+
+    __slots__ = ('errors', 'wall_time', 'cpu_time', 'allocated')
+
+    def __init__(self):
+        self.errors = 0
+        self.wall_time = Histogram(self.time_bounds)
+        self.cpu_time = Histogram(self.time_bounds)
+        self.allocated = Histogram(self.allocation_bounds)
+
+    def dump(self):
+        data = {
+            'calls': self.wall_time.count + self.allocated.count,
+            'errors': self.errors,
+            'wall_time_ms': self.wall_time.dump(),
+            'cpu_time_ms': self.cpu_time.dump(),
+        }
+        if self.allocated.count:
+            data['allocated_kb'] = self.allocated.dump()
+        return data
+
+
+class CommandProfiler(object):
+    """
+    Per-process profile of game commands: wall time, CPU time and, optionally, memory allocated by sampled
+    commands, aggregated into histograms by command name.
+
+    Allocations are traced with tracemalloc only while a sampled command runs, commands are synchronous, so
+    nothing else is traced meanwhile. Tracing slows the command down, so traced samples are not timed: with
+    allocation tracing every other sample is traced and the rest are timed.
+    """
+
+    def __init__(self, sample_rate=0.01, trace_allocations=False, random=None):
+        """
+        :param sample_rate: Share of commands to measure, from 0 to 1
+        :type sample_rate: float
+        :param trace_allocations: Measure memory allocated by sampled commands
+        :type trace_allocations: bool
+        """
+        self.sample_rate = sample_rate
+        self.trace_allocations = trace_allocations
+        self.random = random or Random()
+        self.since = milliseconds()
+        self.stats = {}
+        self._trace_next = False
+        if trace_allocations:
+            import tracemalloc
+            self._tracemalloc = tracemalloc
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        :param settings: Command profiling settings
+        :type settings: dict
+        :return: Profiler or None if profiling is disabled
+        :rtype: CommandProfiler
+        """
+        if not settings.get('enable', False):
+            return None
+        return cls(sample_rate=settings.get('sample_rate', 0.01),
+                   trace_allocations=settings.get('trace_allocations', False))
+
+    def sample(self):
+        return self.random.random() < self.sample_rate
+
+    def command_stats(self, name):
+        try:
+            return self.stats[name]
+        except KeyError:
+            stats = self.stats[name] = CommandStats()
+            return stats
+
+    def run(self, name, command):
+        """
+        Run sampled command and measure it
+
+        :param name: Command name
+        :type name: str
+        :param command: Command
+        :type command: BaseCommand
+        :return:
+        """
+        stats = self.command_stats(name)
+        if self.trace_allocations:
+            # every other sample is traced, so tracing overhead doesn't get into times
+            self._trace_next = not self._trace_next
+            if self._trace_next:
+                return self._run_traced(stats, command)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            command.run()
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.cpu_time += (time.process_time() - cpu_start) * 1000
+            stats.wall_time += (time.perf_counter() - wall_start) * 1000
+
+    def _run_traced(self, stats, command):
+        tracemalloc = self._tracemalloc
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        start, _ = tracemalloc.get_traced_memory()
+        try:
+            command.run()
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            if started:
+                tracemalloc.stop()
+                # peak since tracing started is the peak of the command
+                stats.allocated += (peak - start) / 1024
+            else:
+                stats.allocated += max(current - start, 0) / 1024
+
+    def reset(self):
+        self.since = milliseconds()
+        self.stats = {}
+
+    def dump(self):
+        return {
+            'since': self.since,
+            'sample_rate': self.sample_rate,
+            'trace_allocations': self.trace_allocations,
+            'commands': dict((name, stats.dump()) for name, stats in self.stats.items()),
+        }
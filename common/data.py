@@ -1,7 +1,21 @@
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import gzip
+import hashlib
+from logging import getLogger
+import os
+from weakref import WeakKeyDictionary
+
+from tornado.gen import coroutine
+
+from engine.utils.dictutils import JSON, encode_data
+from engine.utils.timeutils import milliseconds
 
 __author__ = 'kollad'
 
+log = getLogger('process')
+
 
 class DataObjectAbstract(metaclass=ABCMeta):
     @abstractmethod
@@ -10,4 +24,221 @@ class DataObjectAbstract(metaclass=ABCMeta):
 
     @abstractmethod
     def drop_cache(self):
-        pass
\ No newline at end of file
+        pass
+
+class EncodedBlob(object):
+    """
+    Content encoded in a data format, gzipped once as well, when it's asked for the first time
+    """
+    __slots__ = ('data_format', 'body', 'version', 'etag', 'gzipped_etag', '_gzipped')
+
+    def __init__(self, data_format, body):
+        """
+        :param data_format: Data format, see engine.utils.dictutils
+        :type data_format: str
+        :param body: Encoded content
+        :type body: bytes
+        """
+        self.data_format = data_format
+        self.body = body
+        self._gzipped = None
+        # derived from the content, so all the processes serving it give the same ETag
+        self.version = hashlib.sha1(body).hexdigest()[:20]
+        self.etag = '"{}"'.format(self.version)
+        # strong ETags are byte for byte, so the gzipped body has its own
+        self.gzipped_etag = '"{}-gz"'.format(self.version)
+
+    @property
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=9)
+        return self._gzipped
+
+    def __len__(self):
+        return len(self.body)
+
+    def __repr__(self):
+        return '<EncodedBlob: {} {}, {} bytes>'.format(self.data_format, self.version, len(self.body))
+
+
+class EncodedContent(object):
+    """
+    Client payloads of content manager data, encoded once per content reload for each data format, instead of
+    being copied and encoded for every request.
+
+    Payloads are kept per content manager, while it's in use: requests started before a reload keep getting
+    the payloads of their content manager without evicting the ones of the new manager. A payload is encoded
+    again when the content manager gives another data object or its content_version attribute changes,
+    so content managers, that change the data in place, should increase content_version.
+    """
+    # keys of content manager data, that are not sent to clients
+    exclude = {
+        'game_data': ('location',),
+    }
+
+    def __init__(self, content_manager=None):
+        """
+        :param content_manager: Application content manager, if it's not passed to get
+        """
+        self.content_manager = content_manager
+        # content manager: {name: (data, content version, blobs by data format)}
+        self._encoded = WeakKeyDictionary()
+
+    def client_data(self, name, data):
+        """
+        :return: Data without the excluded keys, only the top level is copied
+        :rtype: dict
+        """
+        exclude = self.exclude.get(name)
+        if not exclude:
+            return data
+        return dict((key, value) for key, value in data.items() if key not in exclude)
+
+    def get(self, name, data_format=JSON, content_manager=None):
+        """
+        :param name: Content manager attribute, game_data or static_data
+        :type name: str
+        :param data_format: Data format
+        :type data_format: str
+        :param content_manager: Content manager to get the data of, the one given on init by default
+        :rtype: EncodedBlob
+        """
+        if content_manager is None:
+            content_manager = self.content_manager
+        data = getattr(content_manager, name)
+        version = getattr(content_manager, 'content_version', None)
+        try:
+            encoded = self._encoded[content_manager]
+        except KeyError:
+            encoded = self._encoded[content_manager] = {}
+        try:
+            encoded_data, encoded_version, blobs = encoded[name]
+        except KeyError:
+            encoded_data = encoded_version = blobs = None
+        if encoded_data is not data or encoded_version != version:
+            blobs = {}
+            encoded[name] = (data, version, blobs)
+        try:
+            return blobs[data_format]
+        except KeyError:
+            body = encode_data(self.client_data(name, data), data_format)
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            blob = blobs[data_format] = EncodedBlob(data_format, body)
+            return blob
+
+
+class ContentReloader(object):
+    """
+    Keeps the current content manager and replaces it with a new one on reload. Content managers are not changed
+    after they are built, so a reload is an atomic swap: requests take the current one when they start and keep
+    it, whatever is reloaded meanwhile. New content managers are built in an executor, so requests are served
+    while content is loaded, and swapped on the IOLoop.
+
+    Content files are watched by their modification times and sizes, the check is cheap, but it's done at most
+    every check_period milliseconds anyway.
+    """
+
+    def __init__(self, factory, paths=None, check_period=1000, executor=None):
+        """
+        :param factory: Function, that builds a content manager with freshly loaded content
+        :param paths: Files or directories to watch, content_files() of the content manager by default
+        :type paths: list
+        :param check_period: Milliseconds between file checks
+        :type check_period: int
+        :param executor: Executor to build content managers on reload, a single thread by default
+        :type executor: concurrent.futures.Executor
+        """
+        self.factory = factory
+        self.check_period = check_period
+        self.executor = executor or ThreadPoolExecutor(1)
+        self.version = 0
+        self._checked = 0
+        self._reloading = None
+        # the first content manager is built before the process starts serving requests
+        self.current = self.build()
+        if paths is None:
+            paths = self.current.content_files() if hasattr(self.current, 'content_files') else ()
+        self.paths = list(paths)
+        self._signature = self.signature()
+
+    def build(self):
+        content_manager = self.factory()
+        if hasattr(content_manager, 'precompile_stash_values'):
+            compiled = content_manager.precompile_stash_values()
+            log.info('Content {}: {} stash values of game data compiled'.format(self.version, compiled))
+        return content_manager
+
+    def files(self):
+        for path in self.paths:
+            if os.path.isdir(path):
+                for directory, _, names in os.walk(path):
+                    for name in names:
+                        yield os.path.join(directory, name)
+            else:
+                yield path
+
+    def signature(self):
+        """
+        :return: Modification times and sizes of the watched files
+        :rtype: list
+        """
+        signature = []
+        for path in self.files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                signature.append((path, None, None))
+            else:
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+        return sorted(signature)
+
+    @coroutine
+    def check(self):
+        """
+        Reload content if the watched files are changed. Files are not checked while a reload is running, so
+        changes made meanwhile are found by the next check. Files, that failed to load, are loaded again by
+        the next check, until the content is reloaded.
+
+        :return: True if content is reloaded
+        :rtype: bool
+        """
+        now = milliseconds()
+        if self._reloading is not None or now - self._checked < self.check_period:
+            return False
+        self._checked = now
+        signature = self.signature()
+        if signature == self._signature:
+            return False
+        return (yield self.reload())
+
+    def reload(self):
+        """
+        Build a new content manager and make it current, the current one is kept if the content fails to load.
+        A reload asked for while another one is running waits for it.
+
+        :return: Future of True if content is reloaded
+        """
+        if self._reloading is None:
+            # taken before the build, so files changed while they are loaded are reloaded by the next check
+            signature = self.signature()
+            self._reloading = self._reload()
+            self._reloading.add_done_callback(partial(self._reloaded, signature))
+        return self._reloading
+
+    def _reloaded(self, signature, future):
+        self._reloading = None
+        if future.exception() is None and future.result():
+            self._signature = signature
+
+    @coroutine
+    def _reload(self):
+        try:
+            content_manager = yield self.executor.submit(self.build)
+        except Exception:
+            log.exception('Content reload failed, content {} is kept'.format(self.version))
+            return False
+        self.current = content_manager
+        self.version += 1
+        log.info('Content reloaded, version: {}'.format(self.version))
+        return True
@@ -1,6 +1,8 @@
-from collections import namedtuple, OrderedDict
+from collections import namedtuple, OrderedDict, Mapping, MutableSequence, Set
 import json
 
+from engine.utils.dictutils import TreeNode, convert_tree, is_plain
+
 __author__ = 'kollad'
 
 
@@ -12,34 +14,73 @@ def isnamedtuple(obj):
            and callable(obj._asdict)
 
 
-def serialize(data):
+_str_type = frozenset((str,))
+
+
+def _wrap(marker):
+    return lambda values: {marker: values}
+
+
+def _pairs(items):
+    return [[key, value] for key, value in items]
+
+
+def _serialize_node(data):
+    data_type = type(data)
+    if data_type is dict:
+        # the most common case goes first
+        if _str_type.issuperset(map(type, data)):
+            if is_plain(data.values()):
+                return data
+            return TreeNode(data, is_dict=True, reusable=True)
+    elif data_type is list and is_plain(data):
+        return data
     if data is None or isinstance(data, (bool, int, float, str)):
         return data
     if isinstance(data, list):
-        return [serialize(val) for val in data]
+        if is_plain(data):
+            return data
+        return TreeNode(data, reusable=True)
     if isinstance(data, OrderedDict):
-        return {"py/collections.OrderedDict":
-                    [[serialize(k), serialize(v)] for k, v in data.items()]}
+        return TreeNode(_pairs(data.items()), wrap=_wrap("py/collections.OrderedDict"))
     if isnamedtuple(data):
-        return {"py/collections.namedtuple": {
-            "type": type(data).__name__,
-            "fields": list(data._fields),
-            "values": [serialize(getattr(data, f)) for f in data._fields]}}
+        return TreeNode([getattr(data, f) for f in data._fields], wrap=lambda values: {
+            "py/collections.namedtuple": {
+                "type": type(data).__name__,
+                "fields": list(data._fields),
+                "values": values}})
     if isinstance(data, dict):
-        if all(isinstance(k, str) for k in data):
-            return {k: serialize(v) for k, v in data.items()}
-        return {"py/dict": [[serialize(k), serialize(v)] for k, v in data.items()]}
+        if _str_type.issuperset(map(type, data)) or all(isinstance(k, str) for k in data):
+            if is_plain(data.values()):
+                return data
+            return TreeNode(data, is_dict=True, reusable=True)
+        return TreeNode(_pairs(data.items()), wrap=_wrap("py/dict"))
     if isinstance(data, tuple):
-        return {"py/tuple": [serialize(val) for val in data]}
+        return TreeNode(data, wrap=_wrap("py/tuple"))
     if isinstance(data, set):
-        return {"py/set": [serialize(val) for val in data]}
-    if isinstance(data, np.ndarray):
+        return TreeNode(data, wrap=_wrap("py/set"))
+    # wrappers like journaled state containers or views are serialized as the containers they wrap
+    if isinstance(data, Mapping):
+        return _serialize_node(dict(data.items()))
+    if isinstance(data, MutableSequence):
+        return _serialize_node(list(data))
+    if isinstance(data, Set):
+        return TreeNode(data, wrap=_wrap("py/set"))
+    if type(data).__module__ == 'numpy' and type(data).__name__ == 'ndarray':
         return {"py/numpy.ndarray": {
             "values": data.tolist(),
             "dtype": str(data.dtype)}}
     raise TypeError("Type %s not data-serializable" % type(data))
 
 
+def serialize(data):
+    """
+    Convert data to json compatible types, marking types json doesn't have, so restore could bring them back.
+    Lists and dicts, which need no conversion, are returned as is.
+    """
+    return convert_tree(data, _serialize_node)
+
+
 def restore(dct):
     if "py/dict" in dct:
         return dict(dct["py/dict"])
@@ -51,6 +92,7 @@ def restore(dct):
         data = dct["py/collections.namedtuple"]
         return namedtuple(data["type"], data["fields"])(*data["values"])
     if "py/numpy.ndarray" in dct:
+        import numpy as np
         data = dct["py/numpy.ndarray"]
         return np.array(data["values"], dtype=data["dtype"])
     if "py/collections.OrderedDict" in dct:
@@ -0,0 +1,523 @@
+"""
+Content compiled into a binary snapshot file, that game processes map into memory and read lazily, so the
+processes of a machine share one copy of the content and don't parse it at startup.
+
+Every value is a node: a tag byte and its payload, containers keep offsets of their items, equal scalars and
+strings are stored once. Snapshots are written in the byte order of the machine, they are not meant to be copied
+to other ones.
+"""
+from bisect import bisect_left
+from collections import Mapping, Sequence
+from functools import lru_cache
+import json
+import mmap
+import os
+import struct
+import sys
+
+from engine.utils.dictutils import ListView, MappingView, dump_value
+
+__author__ = 'kollad'
+
+
+MAGIC = b'CSNP'
+FORMAT_VERSION = 2
+# magic, format version, byte order, source file modification time and size, root, key and string table offsets
+_header = struct.Struct('=4sBBqqIII2x')
+_size = struct.Struct('=I')
+_int = struct.Struct('=q')
+_float = struct.Struct('=d')
+_LITTLE_ENDIAN = int(sys.byteorder == 'little')
+
+_NONE, _TRUE, _FALSE = b'N', b'T', b'F'
+_INT, _BIG_INT, _FLOAT, _STR = b'i', b'b', b'd', b's'
+_LIST, _DICT = b'l', b'm'
+# tags as they are read from the mapped file
+_NONE_TAG, _TRUE_TAG, _FALSE_TAG, _INT_TAG, _BIG_INT_TAG, _FLOAT_TAG, _STR_TAG, _LIST_TAG, _DICT_TAG = (
+    ord(tag) for tag in (_NONE, _TRUE, _FALSE, _INT, _BIG_INT, _FLOAT, _STR, _LIST, _DICT))
+
+_MAX_OFFSET = 0xffffffff
+
+
+class SnapshotError(Exception):
+    pass
+
+
+_missing = object()
+
+
+_SCALAR, _DICT_KIND, _LIST_KIND = 0, 1, 2
+_scalar_types = frozenset((str, int, float, bool, type(None)))
+
+
+def _kind(value):
+    value_type = type(value)
+    if value_type in _scalar_types:
+        return _SCALAR
+    if value_type is dict:
+        return _DICT_KIND
+    if value_type is list or value_type is tuple:
+        return _LIST_KIND
+    if isinstance(value, Mapping):
+        return _DICT_KIND
+    if isinstance(value, Sequence) and not isinstance(value, (str, bytes)):
+        return _LIST_KIND
+    return _SCALAR
+
+
+class SnapshotWriter(object):
+    """
+    Containers are aligned to 4 bytes and hold a count and offsets of their items: keys, then values for a dict.
+    All dict keys are written first, sorted by their utf-8 bytes, so keys of a dict are sorted by their offsets
+    too, and a key is found with bisect over integers. Offsets of all the distinct strings are written last,
+    so they can be read without walking the containers.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray(_header.size)
+        # offsets of written scalars by type and value
+        self._scalars = {}
+
+    def _append(self, data):
+        offset = len(self.buffer)
+        if offset + len(data) > _MAX_OFFSET:
+            raise SnapshotError('Snapshot is too large')
+        self.buffer += data
+        return offset
+
+    def write_scalar(self, value):
+        key = (type(value), value)
+        try:
+            return self._scalars[key]
+        except KeyError:
+            pass
+        except TypeError:
+            raise TypeError('Type {} can not be stored in snapshot'.format(type(value)))
+        if value is None:
+            data = _NONE
+        elif value is True:
+            data = _TRUE
+        elif value is False:
+            data = _FALSE
+        elif isinstance(value, int):
+            if -2 ** 63 <= value < 2 ** 63:
+                data = _INT + _int.pack(value)
+            else:
+                digits = str(value).encode('ascii')
+                data = _BIG_INT + _size.pack(len(digits)) + digits
+        elif isinstance(value, float):
+            data = _FLOAT + _float.pack(value)
+        elif isinstance(value, str):
+            encoded = value.encode('utf-8')
+            data = _STR + _size.pack(len(encoded)) + encoded
+        else:
+            raise TypeError('Type {} can not be stored in snapshot'.format(type(value)))
+        offset = self._scalars[key] = self._append(data)
+        return offset
+
+    def write_container(self, tag, offsets):
+        padding = -len(self.buffer) % 4
+        if padding:
+            self._append(b'\0' * padding)
+        return self._append(tag + b'\0\0\0' + struct.pack('={}I'.format(len(offsets) + 1), len(offsets) // (
+            2 if tag == _DICT else 1), *offsets))
+
+    def write_keys(self, data):
+        """
+        Write all dict keys of the data sorted by their bytes
+
+        :return: Offset of the key table
+        :rtype: int
+        """
+        keys = set()
+        stack = [data]
+        while stack:
+            value = stack.pop()
+            kind = _kind(value)
+            if kind == _DICT_KIND:
+                keys.update(value.keys())
+                stack.extend(item for item in value.values() if _kind(item))
+            elif kind == _LIST_KIND:
+                stack.extend(item for item in value if _kind(item))
+        for key in keys:
+            if not isinstance(key, str):
+                raise TypeError('Only string keys can be stored in snapshot, got {!r}'.format(key))
+        keys = sorted(keys, key=lambda key: key.encode('utf-8'))
+        return self.write_container(_LIST, [self.write_scalar(key) for key in keys])
+
+    def _frame(self, value, kind):
+        """
+        :return: Key offsets or None for a list, iterator of items and offsets of the written ones
+        """
+        if kind == _DICT_KIND:
+            scalars = self._scalars
+            items = sorted((scalars[(str, key)], item) for key, item in value.items())
+            return [key for key, _ in items], iter([item for _, item in items]), []
+        return None, iter(value), []
+
+    def write(self, value):
+        """
+        Write value without recursion, children are written before their containers
+
+        :return: Offset of the value node
+        :rtype: int
+        """
+        kind = _kind(value)
+        if not kind:
+            return self.write_scalar(value)
+        scalars = self._scalars
+        stack = [self._frame(value, kind)]
+        while True:
+            keys, items, offsets = stack[-1]
+            for item in items:
+                kind = _kind(item)
+                if kind:
+                    stack.append(self._frame(item, kind))
+                    break
+                try:
+                    offsets.append(scalars[(type(item), item)])
+                except (KeyError, TypeError):
+                    offsets.append(self.write_scalar(item))
+            else:
+                stack.pop()
+                if keys is None:
+                    offset = self.write_container(_LIST, offsets)
+                else:
+                    offset = self.write_container(_DICT, keys + offsets)
+                if not stack:
+                    return offset
+                stack[-1][2].append(offset)
+
+    def build(self, data, source=(0, 0)):
+        """
+        :param data: Content
+        :param source: Modification time in nanoseconds and size of the file the content is loaded from
+        :type source: tuple
+        :return: Snapshot file contents
+        :rtype: bytearray
+        """
+        keys = self.write_keys(data)
+        root = self.write(data)
+        strings = self.write_container(_LIST, sorted(offset for (value_type, _), offset in self._scalars.items()
+                                                     if value_type is str))
+        self.buffer += b'\0' * (-len(self.buffer) % 4)
+        _header.pack_into(self.buffer, 0, MAGIC, FORMAT_VERSION, _LITTLE_ENDIAN, source[0], source[1], root, keys,
+                          strings)
+        return self.buffer
+
+
+def write_snapshot(data, path, source=(0, 0)):
+    """
+    Compile content into a snapshot file. The file is replaced atomically, processes, that have mapped
+    the previous one, keep reading it.
+
+    :param data: Content, dicts with string keys, lists and scalars
+    :param path: Snapshot file path
+    :type path: str
+    :param source: Modification time in nanoseconds and size of the file the content is loaded from
+    :type source: tuple
+    """
+    buffer = SnapshotWriter().build(data, source)
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temporary_path, 'wb') as f:
+            f.write(buffer)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+class ContentSnapshot(object):
+    """
+    Memory mapped snapshot file. Containers are returned as read-only views, which are decoded as they are read.
+    """
+    # looked up keys, that are cached with their offsets
+    key_cache_size = 100000
+    # recently read values and dict items, that are cached, so hot content is not decoded again and again
+    value_cache_size = 16384
+    item_cache_size = 16384
+
+    def __init__(self, path):
+        """
+        :param path: Snapshot file path
+        :type path: str
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < _header.size or len(self._mmap) % 4:
+            raise SnapshotError('Snapshot file is broken: {}'.format(path))
+        magic, version, little_endian, source_mtime, source_size, self.root_offset, keys_offset, \
+            self.strings_offset = _header.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION or little_endian != _LITTLE_ENDIAN:
+            raise SnapshotError('Not a snapshot file of version {}: {}'.format(FORMAT_VERSION, path))
+        self.source = (source_mtime, source_size)
+        # the file as 4 byte words, counts and offsets of containers are read from it
+        self._words = memoryview(self._mmap).cast('I')
+        self._keys_start = keys_offset // 4 + 2
+        self._keys_end = self._keys_start + self._words[keys_offset // 4 + 1]
+        self._key_offsets = {}
+        self.value = lru_cache(self.value_cache_size)(self.decode)
+        self.item = lru_cache(self.item_cache_size)(self.read_item)
+
+    @property
+    def data(self):
+        return self.value(self.root_offset)
+
+    def __len__(self):
+        return len(self._mmap)
+
+    def decode(self, offset):
+        buffer = self._mmap
+        tag = buffer[offset]
+        if tag == _STR_TAG:
+            size, = _size.unpack_from(buffer, offset + 1)
+            return buffer[offset + 5:offset + 5 + size].decode('utf-8')
+        if tag == _INT_TAG:
+            return _int.unpack_from(buffer, offset + 1)[0]
+        if tag == _DICT_TAG:
+            return SnapshotDict(self, offset)
+        if tag == _LIST_TAG:
+            return SnapshotList(self, offset)
+        if tag == _FLOAT_TAG:
+            return _float.unpack_from(buffer, offset + 1)[0]
+        if tag == _NONE_TAG:
+            return None
+        if tag == _TRUE_TAG:
+            return True
+        if tag == _FALSE_TAG:
+            return False
+        if tag == _BIG_INT_TAG:
+            size, = _size.unpack_from(buffer, offset + 1)
+            return int(buffer[offset + 5:offset + 5 + size])
+        raise SnapshotError('Unknown node {!r} at {}'.format(chr(tag), offset))
+
+    def read_item(self, start, key):
+        """
+        :param start: Word index of the first key offset of a dict
+        :type start: int
+        :param key: Dict key
+        :return: Value of the key or _missing
+        """
+        if not isinstance(key, str):
+            return _missing
+        key_offset = self.key_offset(key)
+        if key_offset < 0:
+            return _missing
+        words = self._words
+        end = start + words[start - 1]
+        index = bisect_left(words, key_offset, start, end)
+        if index < end and words[index] == key_offset:
+            return self.value(words[index + end - start])
+        return _missing
+
+    def strings(self):
+        """
+        :return: All the distinct strings of the snapshot, dict keys as well
+        :rtype: list
+        """
+        start = self.strings_offset // 4 + 2
+        decode = self.decode
+        return [decode(offset) for offset in self._words[start:start + self._words[start - 1]]]
+
+    def key_offset(self, key):
+        """
+        :param key: Dict key
+        :type key: str
+        :return: Offset of the key in the snapshot, -1 if no dict has it
+        :rtype: int
+        """
+        try:
+            return self._key_offsets[key]
+        except KeyError:
+            pass
+        encoded = key.encode('utf-8')
+        buffer, words = self._mmap, self._words
+        low, high = self._keys_start, self._keys_end
+        offset = -1
+        while low < high:
+            middle = (low + high) // 2
+            middle_offset = words[middle]
+            size, = _size.unpack_from(buffer, middle_offset + 1)
+            middle_key = buffer[middle_offset + 5:middle_offset + 5 + size]
+            if middle_key < encoded:
+                low = middle + 1
+            elif middle_key > encoded:
+                high = middle
+            else:
+                offset = middle_offset
+                break
+        if len(self._key_offsets) < self.key_cache_size:
+            self._key_offsets[key] = offset
+        return offset
+
+    def __repr__(self):
+        return '<ContentSnapshot: {}, {} bytes>'.format(self.path, len(self))
+
+
+class SnapshotDict(MappingView):
+    """
+    Read-only dict of a snapshot, views of the user state see it as a MappingView. Recently read items are cached
+    by the snapshot, so hot values are looked up once.
+    """
+
+    def __init__(self, snapshot, offset):
+        self._snapshot = snapshot
+        # word index of the first key offset
+        self._start = offset // 4 + 2
+        self._count = snapshot._words[self._start - 1]
+
+    @property
+    def _data(self):
+        return self
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def __getitem__(self, key):
+        value = self._snapshot.item(self._start, key)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._snapshot.item(self._start, key) is not _missing
+
+    def __len__(self):
+        return self._count
+
+    def keys(self):
+        snapshot = self._snapshot
+        return [snapshot.value(offset) for offset in snapshot._words[self._start:self._start + self._count]]
+
+    def values(self):
+        snapshot = self._snapshot
+        start = self._start + self._count
+        return [snapshot.value(offset) for offset in snapshot._words[start:start + self._count]]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def dump(self):
+        return dump_value(dict(self.items()))
+
+    def __str__(self):
+        return 'SnapshotDict({})'.format(self.dump())
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class SnapshotList(ListView):
+    """
+    Read-only list of a snapshot, views of the user state see it as a ListView
+    """
+
+    def __init__(self, snapshot, offset):
+        self._snapshot = snapshot
+        self._start = offset // 4 + 2
+        self._count = snapshot._words[self._start - 1]
+
+    @property
+    def _data(self):
+        return self
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('Snapshot list index out of range')
+        snapshot = self._snapshot
+        return snapshot.value(snapshot._words[self._start + index])
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        snapshot = self._snapshot
+        return iter([snapshot.value(offset) for offset in snapshot._words[self._start:self._start + self._count]])
+
+    def __contains__(self, item):
+        return any(value == item for value in self)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, Sequence)) or isinstance(other, (str, bytes)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def dump(self):
+        return dump_value(list(self))
+
+    def __str__(self):
+        return 'SnapshotList({})'.format(self.dump())
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def _lock(path):
+    """
+    :return: Exclusively locked file, so only one process compiles the snapshot, or None without fcntl
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    lock = open(path, 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+def load_snapshot(source_path, snapshot_path=None, load=json.load):
+    """
+    Map the snapshot of a content file, the snapshot is compiled if it's missing or the file has changed since.
+    Game processes of a machine, started together, wait while one of them compiles it.
+
+    :param source_path: Content file path
+    :type source_path: str
+    :param snapshot_path: Snapshot file path, the content file path with .snapshot suffix by default
+    :type snapshot_path: str
+    :param load: Function, that loads content from a file object
+    :return: Content snapshot
+    :rtype: ContentSnapshot
+    """
+    snapshot_path = snapshot_path or '{}.snapshot'.format(source_path)
+
+    def current():
+        stat = os.stat(source_path)
+        source = (stat.st_mtime_ns, stat.st_size)
+        try:
+            snapshot = ContentSnapshot(snapshot_path)
+        except (OSError, ValueError, SnapshotError):
+            return source, None
+        return source, snapshot if snapshot.source == source else None
+
+    source, snapshot = current()
+    if snapshot is not None:
+        return snapshot
+    lock = _lock('{}.lock'.format(snapshot_path))
+    try:
+        # another process might have compiled it meanwhile
+        source, snapshot = current()
+        if snapshot is None:
+            with open(source_path) as f:
+                data = load(f)
+            write_snapshot(data, snapshot_path, source)
+            snapshot = ContentSnapshot(snapshot_path)
+    finally:
+        if lock is not None:
+            lock.close()
+    return snapshot
@@ -0,0 +1,187 @@
+import json
+from logging import getLogger
+
+import zmq
+from zmq.eventloop.zmqstream import ZMQStream
+
+from engine.utils.mathutils import QuantileSketch
+from engine.utils.timeutils import milliseconds
+
+__author__ = 'kollad'
+
+log = getLogger('process')
+
+
+class TelemetryPublisher(object):
+    """
+    Pushes performance snapshots of a process to the telemetry collector. Sending never blocks the process: while
+    the collector is unreachable, a few snapshots are queued and the rest are dropped.
+    """
+
+    def __init__(self, address, queue_size=10, context=None):
+        """
+        :param address: Collector address, like tcp://localhost:8071
+        :type address: str
+        :param queue_size: Snapshots queued while the collector is unreachable
+        :type queue_size: int
+        """
+        self.address = address
+        self.dropped = 0
+        self.socket = (context or zmq.Context.instance()).socket(zmq.PUSH)
+        self.socket.setsockopt(zmq.SNDHWM, queue_size)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(address)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        :param settings: Telemetry settings
+        :type settings: dict
+        :return: Publisher or None if telemetry is disabled
+        :rtype: TelemetryPublisher
+        """
+        if not settings.get('enable', False):
+            return None
+        return cls(settings.get('collector', 'tcp://localhost:8071'), queue_size=settings.get('queue_size', 10))
+
+    def push(self, snapshot):
+        """
+        :param snapshot: Performance snapshot, see PerformanceInfo.snapshot
+        :type snapshot: dict
+        :return: False if the snapshot is dropped
+        :rtype: bool
+        """
+        try:
+            self.socket.send_json(snapshot, zmq.NOBLOCK)
+        except zmq.Again:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self):
+        self.socket.close()
+
+
+def summarize_sketch(sketch):
+    """
+    :type sketch: QuantileSketch
+    :rtype: dict
+    """
+    p50, p90, p99, p999 = sketch.quantiles(0.5, 0.9, 0.99, 0.999)
+    return {
+        'count': sketch.count,
+        'avg': sketch.avg,
+        'p50': p50,
+        'p90': p90,
+        'p99': p99,
+        'p999': p999,
+        'max': sketch.max,
+    }
+
+
+class TelemetryCollector(object):
+    """
+    Collects performance snapshots pushed by game processes and aggregates the latest ones: per process, to find
+    hot processes, and cluster-wide, with sketches merged for tail latencies. Processes, that haven't pushed
+    anything for stale_time, are dropped.
+    """
+
+    def __init__(self, address, stale_time=60, loop=None, context=None):
+        """
+        :param address: Address to bind to, like tcp://*:8071
+        :type address: str
+        :param stale_time: Seconds to keep the last snapshot of a process
+        :type stale_time: int
+        :param loop: zmq event loop
+        """
+        self.address = address
+        self.stale_time = stale_time
+        # the latest snapshot by process ID
+        self.snapshots = {}
+        self.socket = (context or zmq.Context.instance()).socket(zmq.PULL)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(address)
+        self.stream = ZMQStream(self.socket, loop)
+        self.stream.on_recv(self.receive)
+
+    @classmethod
+    def from_settings(cls, settings, loop=None):
+        """
+        :param settings: Telemetry settings
+        :type settings: dict
+        :return: Collector or None if telemetry is disabled
+        :rtype: TelemetryCollector
+        """
+        if not settings.get('enable', False):
+            return None
+        return cls(settings.get('bind', 'tcp://*:8071'), stale_time=settings.get('stale_time', 60), loop=loop)
+
+    def receive(self, frames):
+        for frame in frames:
+            try:
+                self.add(json.loads(frame.decode('utf-8')))
+            except (ValueError, KeyError) as e:
+                log.warning('Invalid telemetry snapshot: {}'.format(e))
+
+    def add(self, snapshot):
+        """
+        :param snapshot: Performance snapshot of a process
+        :type snapshot: dict
+        """
+        snapshot['sketches'] = dict((name, QuantileSketch.load(sketch))
+                                    for name, sketch in snapshot['sketches'].items())
+        snapshot['received'] = milliseconds()
+        self.snapshots[snapshot['process_id']] = snapshot
+
+    def drop_stale(self):
+        expired = milliseconds() - milliseconds(self.stale_time)
+        for process_id in [process_id for process_id, snapshot in self.snapshots.items()
+                           if snapshot['received'] < expired]:
+            del self.snapshots[process_id]
+
+    def processes(self):
+        """
+        :return: Summaries of the latest process snapshots, the busiest processes first
+        :rtype: list
+        """
+        self.drop_stale()
+        processes = []
+        for snapshot in self.snapshots.values():
+            summary = dict((key, value) for key, value in snapshot.items() if key != 'sketches')
+            summary['sketches'] = dict((name, summarize_sketch(sketch))
+                                       for name, sketch in snapshot['sketches'].items())
+            processes.append(summary)
+        processes.sort(key=lambda summary: summary['rps'], reverse=True)
+        return processes
+
+    def cluster(self):
+        """
+        :return: Summary of the latest snapshots of all the processes
+        :rtype: dict
+        """
+        self.drop_stale()
+        sketches = {}
+        for snapshot in self.snapshots.values():
+            for name, sketch in snapshot['sketches'].items():
+                try:
+                    sketches[name].merge(sketch)
+                except KeyError:
+                    sketches[name] = QuantileSketch(relative_accuracy=sketch.relative_accuracy).merge(sketch)
+        snapshots = self.snapshots.values()
+        return {
+            'processes': len(self.snapshots),
+            'requests': sum(snapshot['requests'] for snapshot in snapshots),
+            'rps': sum(snapshot['rps'] for snapshot in snapshots),
+            'redis_round_trips': sum(snapshot['redis_round_trips'] for snapshot in snapshots),
+            'sketches': dict((name, summarize_sketch(sketch)) for name, sketch in sketches.items()),
+        }
+
+    def dump(self):
+        return {
+            'time': milliseconds(),
+            'cluster': self.cluster(),
+            'processes': self.processes(),
+        }
+
+    def close(self):
+        self.stream.close()
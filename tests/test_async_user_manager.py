@@ -0,0 +1,100 @@
+import unittest
+
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from engine.tests.test_user_manager import RedisServerTestCase, make_settings
+from engine.user.async_user_manager import AsyncUserManager
+from engine.user.lock import LockError
+from engine.user.user_manager import UserManager
+
+__author__ = 'kollad'
+
+
+class AsyncUserManagerTestCase(RedisServerTestCase):
+    user_manager_class = AsyncUserManager
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import tornadis
+        except ImportError:
+            raise unittest.SkipTest('tornadis is not installed')
+        super(AsyncUserManagerTestCase, cls).setUpClass()
+
+    def run_sync(self, func):
+        return IOLoop.current().run_sync(coroutine(func), timeout=10)
+
+    def lock_key(self, user_manager, user_id):
+        return user_manager.get_lock(user_id).key
+
+    def test_01_load_and_save(self):
+        user_manager = self.make_user_manager()
+
+        def run():
+            state = yield user_manager.get('1')
+            self.assertTrue(state['new_user'])
+            self.assertTrue((yield user_manager.save('2', {'_id': '2', 'gold': 10})))
+            self.assertEqual((yield user_manager.load('2'))['gold'], 10)
+            self.assertIsNone((yield user_manager.get('3', auto_create=False)))
+            self.assertTrue((yield user_manager.delete('2')))
+            self.assertIsNone((yield user_manager.load('2')))
+
+        self.run_sync(run)
+        # states are stored the same way as with the blocking client
+        self.assertEqual(UserManager(make_settings(self.port)).load('1')['user_id'], '1')
+        self.assertEqual(user_manager.unsaved_users_count, 1)
+        self.assertEqual(user_manager.online_users_count, 1)
+
+    def test_02_commit(self):
+        user_manager = self.make_user_manager(storage='hash', dump={'streaming': True})
+        user_manager.save('1', {'_id': '1', 'gold': 10, 'wood': 5})
+        user_manager.dump_users()
+
+        def run():
+            transaction = yield from user_manager.transaction('1')
+            with transaction as writable_state:
+                self.assertTrue(self.redis.exists(self.lock_key(user_manager, '1')))
+                writable_state['gold'] += 10
+            yield from transaction.wait()
+            self.assertEqual((yield user_manager.get('1'))['gold'], 20)
+
+        self.run_sync(run)
+        self.assertFalse(self.redis.exists(self.lock_key(user_manager, '1')))
+        user_manager.dump_users()
+        self.assertEqual(user_manager.mongo.documents['1']['gold'], 20)
+
+    def test_03_release(self):
+        user_manager = self.make_user_manager()
+        user_manager.save('1', {'_id': '1', 'gold': 10})
+
+        def run():
+            transaction = yield from user_manager.transaction('1')
+            with self.assertRaises(ValueError):
+                with transaction as writable_state:
+                    writable_state['gold'] += 10
+                    raise ValueError()
+            # the lock is released in background, so the next transaction acquires it
+            transaction = yield from user_manager.transaction('1')
+            with transaction as writable_state:
+                self.assertEqual(writable_state['gold'], 10)
+            yield from transaction.wait()
+
+            lock = user_manager.get_lock('1')
+            yield from lock.acquire(timeout=1)
+            self.assertTrue(self.redis.exists(lock.key))
+            yield lock.release()
+            self.assertFalse(lock.acquired)
+            # the lock has expired and is taken by another process
+            yield from lock.acquire(timeout=1)
+            self.redis.set(lock.key, 'other')
+            with self.assertRaises(LockError):
+                yield lock.release()
+            self.redis.delete(lock.key)
+
+        self.run_sync(run)
+        self.assertFalse(self.redis.exists(self.lock_key(user_manager, '1')))
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
@@ -0,0 +1,70 @@
+from collections import OrderedDict, namedtuple
+import unittest
+
+from engine.common.serializers import data_to_json
+from engine.user.codecs import JSON, MSGPACK, MSGPACK_ZLIB, MSGPACK_LZ4, CodecError, decode_data, encode_data, \
+    get_codec, get_data_codec
+
+__author__ = 'kollad'
+
+
+Point = namedtuple('Point', ['x', 'y'])
+
+
+def make_data():
+    return {
+        '_id': '1',
+        'resources': {'gold': 100, 'wood': 5},
+        'visited': {1, 2},
+        'tilegrid': [[0, 1], [1, 0]],
+        'big': {'positive': 2 ** 64, 'negative': -2 ** 63 - 1, 'max': 2 ** 64 - 1, 'min': -2 ** 63},
+    }
+
+
+class CodecsTestCase(unittest.TestCase):
+    def codecs(self):
+        names = [MSGPACK, MSGPACK_ZLIB]
+        try:
+            get_codec(MSGPACK_LZ4)
+        except ImportError:
+            pass
+        else:
+            names.append(MSGPACK_LZ4)
+        return names
+
+    def test_01_mixed_records(self):
+        data = make_data()
+        # header-less json records written before codecs were introduced are stored next to the new ones
+        records = [data_to_json(data), data_to_json(data).encode('utf-8')]
+        records.extend(encode_data(data, name) for name in self.codecs())
+        self.assertEqual([get_data_codec(record).name for record in records], [JSON, JSON] + self.codecs())
+        for record in records:
+            self.assertEqual(decode_data(record), data)
+        self.assertEqual(decode_data(memoryview(records[-1]).tobytes()), data)
+
+    def test_02_msgpack_types(self):
+        data = {
+            'tuple': (1, 'a'),
+            'set': frozenset([1, 2]),
+            'ordered': OrderedDict([('b', 1), ('a', 2)]),
+            'point': Point(1, 2),
+            'int_keys': {1: 'a', 2: 'b'},
+            'huge': [10 ** 30, -10 ** 30],
+        }
+        for name in self.codecs():
+            decoded = decode_data(encode_data(data, name))
+            self.assertEqual(decoded, data)
+            self.assertIsInstance(decoded['tuple'], tuple)
+            self.assertEqual(list(decoded['ordered']), ['b', 'a'])
+            self.assertEqual(decoded['point']._fields, ('x', 'y'))
+            self.assertIs(type(decoded['huge'][0]), int)
+
+    def test_03_errors(self):
+        with self.assertRaises(CodecError):
+            get_codec('pickle')
+        with self.assertRaises(TypeError):
+            encode_data({'value': object()}, MSGPACK)
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
@@ -0,0 +1,114 @@
+import unittest
+
+from engine.commands import BaseCommand, CommandBatch, CommandError, CommandProcessor
+
+__author__ = 'kollad'
+
+
+registry = {}
+
+
+class ResponseEvent(object):
+    def __init__(self, event_id, data):
+        self.event_id = event_id
+        self.data = data
+
+    def dump(self):
+        return {'event_id': self.event_id, 'data': self.data}
+
+
+class Command(BaseCommand):
+    registry = registry
+    disabled = True
+    created = []
+
+    @classmethod
+    def create(cls, user_state, content_manager, name, arguments):
+        cls.created.append(name)
+        return super(Command, cls).create(user_state, content_manager, name, arguments)
+
+
+class AddGold(Command):
+    schema = {'count': int, 'reason': (str, None)}
+
+    def run(self):
+        self.user_state['gold'] += self.arguments['count']
+        self.add_response_event(ResponseEvent('gold', self.user_state['gold']))
+
+
+class Move(Command):
+    schema = {'x': float, 'y': float}
+
+    def run(self):
+        self.user_state['position'] = [self.arguments['x'], self.arguments['y']]
+
+
+class Ping(Command):
+    def run(self):
+        self.add_response_event(ResponseEvent('pong', self.arguments))
+
+
+class Processor(CommandProcessor):
+    command_class = Command
+
+
+class CommandBatchTestCase(unittest.TestCase):
+    def test_01_parse(self):
+        batch = CommandBatch(registry, '[{"name": "AddGold", "arguments": {"count": 5}}, {"name": "Ping"}]')
+        self.assertEqual(batch.names, ['AddGold', 'Ping'])
+        self.assertEqual(list(batch), [(AddGold, {'count': 5}), (Ping, {})])
+
+        commands = [{'name': 'Move', 'arguments': {'x': 1, 'y': 2.5}}]
+        batch = CommandBatch(registry, commands)
+        # commands given as a list are copied, so running them doesn't change the caller's arguments
+        self.assertIsNot(list(batch)[0][1], commands[0]['arguments'])
+        self.assertEqual(len(batch), 1)
+
+    def test_02_errors(self):
+        for commands, message in (
+                ('[{"name": "AddGold"', 'not valid json'),
+                ('{"name": "AddGold"}', 'should be a list'),
+                ([{'name': 'Unknown'}], 'Unknown command #0'),
+                (['AddGold'], 'Unknown command #0'),
+                ([{'name': 'Ping'}, {'arguments': {}}], 'Unknown command #1'),
+                ([{'name': 'AddGold', 'arguments': []}], 'should be an object'),
+                ([{'name': 'AddGold', 'arguments': {'reason': 'quest'}}], 'Argument count of AddGold is missing'),
+                ([{'name': 'AddGold', 'arguments': {'count': '5'}}], 'should be int, not str'),
+                ([{'name': 'AddGold', 'arguments': {'count': 5, 'reason': 1}}], 'should be str or NoneType'),
+                ([{'name': 'Move', 'arguments': {'x': 1, 'y': None}}], 'should be float or int, not NoneType')):
+            with self.assertRaises(CommandError) as context:
+                CommandBatch(registry, commands)
+            self.assertIn(message, str(context.exception))
+
+    def test_03_disabled_commands(self):
+        self.assertNotIn('Command', registry)
+        self.assertIsNone(Ping.argument_checks)
+        # checks are compiled once per class
+        self.assertEqual(AddGold.argument_checks, (('count', (int,), True), ('reason', (str, type(None)), False)))
+
+
+class CommandProcessorTestCase(unittest.TestCase):
+    def setUp(self):
+        Command.created = []
+
+    def test_01_run(self):
+        state = {'gold': 10}
+        batch = Processor.compile('[{"name": "AddGold", "arguments": {"count": 5}}, '
+                                  '{"name": "Move", "arguments": {"x": 1, "y": 2}}, '
+                                  '{"name": "AddGold", "arguments": {"count": 1, "reason": null}}]')
+        response = Processor(state, None, batch).run()
+        self.assertEqual(response, [{'event_id': 'gold', 'data': 15}, {'event_id': 'gold', 'data': 16}])
+        self.assertEqual(state, {'gold': 16, 'position': [1, 2]})
+        # commands are made with the create hook of the command class
+        self.assertEqual(Command.created, ['AddGold', 'Move', 'AddGold'])
+
+    def test_02_compile_on_init(self):
+        response = Processor({}, None, [{'name': 'Ping', 'arguments': {'n': 1}}]).run()
+        self.assertEqual(response, [{'event_id': 'pong', 'data': {'n': 1}}])
+        with self.assertRaises(CommandError):
+            Processor({}, None, [{'name': 'AddGold'}])
+        self.assertEqual(Command.created, ['Ping'])
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
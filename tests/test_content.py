@@ -0,0 +1,301 @@
+import gzip
+import json
+import os
+from random import Random
+import tempfile
+import time
+import unittest
+
+from tornado.gen import coroutine, sleep
+from tornado.ioloop import IOLoop
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+
+from engine.apps.game.handlers.static import StaticDataHandler
+from engine.common.data import ContentReloader, EncodedContent
+from engine.common.snapshot import ContentSnapshot, load_snapshot, write_snapshot
+from engine.user.user_stash import Stash, precompile_stash_values
+from engine.utils.dictutils import JSON, MSGPACK, DictView, decode_data, encode_data, encode_data_with
+
+__author__ = 'kollad'
+
+
+GAME_DATA = {
+    'buildings': {'farm': {'levels': [{'price': '10:20', 'time': 60}, {'price': 50, 'time': 120}]}},
+    'quests': ['first', 'second'],
+    'location': {'tiles': [[0, 1], [1, 0]]},
+}
+
+
+class ContentManager(object):
+    def __init__(self, game_data):
+        self.game_data = game_data
+        self.static_data = {'Game.swf': {'url': 'http://localhost/static/Game.swf'}}
+
+
+class EncodedContentTestCase(unittest.TestCase):
+    def test_01_encode_with(self):
+        data = {'user': {'resources': {'gold': 10}}, 'response': [], 'time': 1}
+        for data_format in (JSON, MSGPACK):
+            try:
+                content = EncodedContent(ContentManager(GAME_DATA)).get('game_data', data_format)
+            except ImportError:
+                continue
+            decoded = decode_data(encode_data_with(data, {'game_data': content.body}, data_format), data_format)
+            expected = dict(data, game_data=dict((key, value) for key, value in GAME_DATA.items()
+                                                 if key != 'location'))
+            self.assertEqual(decoded, expected)
+            self.assertEqual(decode_data(encode_data_with({}, {'game_data': content.body}, data_format),
+                                         data_format), {'game_data': expected['game_data']})
+
+    def test_02_encoded_once(self):
+        content_manager = ContentManager(GAME_DATA)
+        content = EncodedContent(content_manager)
+        blob = content.get('game_data')
+        self.assertIs(content.get('game_data'), blob)
+        self.assertNotIn('location', json.loads(blob.body.decode('utf-8')))
+        self.assertEqual(gzip.decompress(blob.gzipped), blob.body)
+        self.assertEqual(blob.etag, '"{}"'.format(blob.version))
+        self.assertIn('Game.swf', json.loads(content.get('static_data').body.decode('utf-8')))
+
+        # reloaded data is encoded again, the same content gives the same version
+        content_manager.game_data = dict(GAME_DATA)
+        reloaded = content.get('game_data')
+        self.assertIsNot(reloaded, blob)
+        self.assertEqual(reloaded.etag, blob.etag)
+
+        content_manager.game_data['quests'] = ['first']
+        self.assertIs(content.get('game_data'), reloaded)
+        content_manager.content_version = 1
+        self.assertNotEqual(content.get('game_data').etag, blob.etag)
+
+    def test_03_encoded_per_content_manager(self):
+        # requests started before and after a reload use both content managers for a while
+        old, new = ContentManager(GAME_DATA), ContentManager(dict(GAME_DATA, quests=['first']))
+        content = EncodedContent()
+        blobs = [content.get('game_data', content_manager=manager) for manager in (old, new)]
+        for _ in range(10):
+            for manager, blob in zip((old, new), blobs):
+                self.assertIs(content.get('game_data', content_manager=manager), blob)
+        self.assertNotEqual(blobs[0].etag, blobs[1].etag)
+        self.assertIsNone(blobs[0]._gzipped)
+
+        del old, manager
+        self.assertEqual(len(content._encoded), 1)
+
+
+class StaticDataHandlerTestCase(AsyncHTTPTestCase):
+    class Process(object):
+        state = 'active'
+
+    class Content(object):
+        current = ContentManager(GAME_DATA)
+
+    def get_app(self):
+        self.encoded_content = EncodedContent()
+        return Application([(r'/data/game_data', StaticDataHandler, {
+            'logger': None, 'server_process': self.Process(), 'command_processor_class': None, 'user_manager': None,
+            'content': self.Content(), 'encoded_content': self.encoded_content, 'game_settings': {}, 'social': None,
+            'data_format': JSON,
+        })])
+
+    def get(self, encoding, etag=None, url='/data/game_data'):
+        headers = {'Accept-Encoding': encoding}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        return self.fetch(url, headers=headers, decompress_response=False)
+
+    def test_01_etag_per_encoding(self):
+        identity, gzipped = self.get('identity'), self.get('gzip')
+        blob = self.encoded_content.get('game_data', JSON, self.Content.current)
+        self.assertEqual(identity.body, blob.body)
+        self.assertEqual(gzip.decompress(gzipped.body), blob.body)
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        # the bodies differ, so do the strong ETags
+        self.assertEqual(identity.headers['Etag'], blob.etag)
+        self.assertEqual(gzipped.headers['Etag'], blob.gzipped_etag)
+        self.assertNotEqual(blob.etag, blob.gzipped_etag)
+
+        self.assertEqual(self.get('identity', blob.etag).code, 304)
+        self.assertEqual(self.get('gzip', blob.gzipped_etag).code, 304)
+        # an ETag of the other encoding doesn't match, the body is sent
+        response = self.get('identity', blob.gzipped_etag)
+        self.assertEqual((response.code, response.body), (200, blob.body))
+        response = self.get('gzip', blob.etag)
+        self.assertEqual((response.code, response.headers['Content-Encoding']), (200, 'gzip'))
+
+    def test_02_versioned(self):
+        blob = self.encoded_content.get('game_data', JSON, self.Content.current)
+        for encoding in ('identity', 'gzip'):
+            response = self.get(encoding, url='/data/game_data?v={}'.format(blob.version))
+            self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(self.get('gzip', url='/data/game_data?v=old').headers['Cache-Control'], 'no-cache')
+
+
+class FileContentManager(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path) as f:
+            self.game_data = json.load(f)
+
+    def content_files(self):
+        return [self.path]
+
+
+class ContentReloaderTestCase(unittest.TestCase):
+    def setUp(self):
+        descriptor, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(descriptor)
+        self.write({'version': 1})
+        self.content = ContentReloader(lambda: FileContentManager(self.path), check_period=0)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, data):
+        with open(self.path, 'w') as f:
+            json.dump(data, f)
+
+    def run_sync(self, function):
+        return IOLoop.current().run_sync(function)
+
+    def test_01_check(self):
+        started = self.content.current
+        self.assertFalse(self.run_sync(self.content.check))
+        self.write({'version': 2, 'changed': True})
+        self.assertTrue(self.run_sync(self.content.check))
+        self.assertEqual(self.content.current.game_data['version'], 2)
+        self.assertEqual(self.content.version, 1)
+        # content taken before the reload is kept
+        self.assertEqual(started.game_data, {'version': 1})
+        self.assertFalse(self.run_sync(self.content.check))
+
+    def test_02_failed_reload(self):
+        current = self.content.current
+        with open(self.path, 'w') as f:
+            f.write('{broken')
+        self.assertFalse(self.run_sync(self.content.reload))
+        self.assertIs(self.content.current, current)
+        self.assertEqual(self.content.version, 0)
+        # the broken files are not taken as loaded, so they are checked again
+        self.assertFalse(self.run_sync(self.content.check))
+        self.assertFalse(self.run_sync(self.content.check))
+        self.assertEqual(self.content.version, 0)
+        # once they are fixed, the next check reloads them
+        self.write({'version': 2})
+        self.assertTrue(self.run_sync(self.content.check))
+        self.assertEqual(self.content.current.game_data, {'version': 2})
+        self.assertEqual(self.content.version, 1)
+        self.assertFalse(self.run_sync(self.content.check))
+
+        # a build failed for other reasons is retried by the next check, with no further changes of the files
+        factory, failures = self.content.factory, [ValueError()]
+
+        def failing_factory():
+            if failures:
+                raise failures.pop()
+            return factory()
+
+        self.content.factory = failing_factory
+        self.write({'version': 3})
+        self.assertFalse(self.run_sync(self.content.check))
+        self.assertTrue(self.run_sync(self.content.check))
+        self.assertEqual(self.content.current.game_data, {'version': 3})
+
+    def test_03_check_period(self):
+        self.content.check_period = 60000
+        self.run_sync(self.content.check)
+        self.write({'version': 2, 'changed': True})
+        self.assertFalse(self.run_sync(self.content.check))
+
+    def test_04_reload_in_background(self):
+        def slow_factory():
+            time.sleep(0.2)
+            return FileContentManager(self.path)
+
+        content = ContentReloader(slow_factory, check_period=0)
+        current = content.current
+        self.write({'version': 2})
+
+        @coroutine
+        def run():
+            reloading = content.reload()
+            # the IOLoop serves other callbacks meanwhile, a reload asked for during a reload joins it
+            self.assertIs(content.reload(), reloading)
+            start = IOLoop.current().time()
+            yield sleep(0.01)
+            self.assertLess(IOLoop.current().time() - start, 0.1)
+            self.assertIs(content.current, current)
+            self.assertFalse((yield content.check()))
+            return (yield reloading)
+
+        self.assertTrue(self.run_sync(run))
+        self.assertEqual(content.current.game_data, {'version': 2})
+        self.assertEqual(content.version, 1)
+
+
+class ContentSnapshotTestCase(unittest.TestCase):
+    DATA = dict(GAME_DATA, values=[None, True, False, 0, -1, 2 ** 70, 1.5, '', 'ünicode', [], {}],
+                keys={'b': 1, 'a': 2, 'é': 3, 'aa': 4, '': 5},
+                prices={'farm': {'gold': 10, 'wood': 5}, 'castle': {'gold': 1000}, 'reward': {'gold': '10:20'}})
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'game_data.json')
+        with open(self.path, 'w') as f:
+            json.dump(self.DATA, f)
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def test_01_views(self):
+        snapshot_path = os.path.join(self.directory, 'snapshot')
+        write_snapshot(self.DATA, snapshot_path)
+        data = ContentSnapshot(snapshot_path).data
+        self.assertEqual(data, self.DATA)
+        self.assertEqual(data.dump(), self.DATA)
+        self.assertEqual(DictView(data).dump(), self.DATA)
+        self.assertEqual(json.loads(encode_data(data)), json.loads(json.dumps(self.DATA)))
+        for key, value in self.DATA['keys'].items():
+            self.assertEqual(data['keys'][key], value)
+        self.assertNotIn('c', data['keys'])
+        self.assertIsNone(data.get('missing'))
+        self.assertEqual(data['buildings']['farm']['levels'][-1]['time'], 120)
+        self.assertRaises(IndexError, lambda: data['quests'][2])
+        self.assertRaises(TypeError, write_snapshot, {1: 'a'}, snapshot_path)
+
+    def test_02_load(self):
+        snapshot = load_snapshot(self.path)
+        self.assertEqual(snapshot.data, self.DATA)
+        self.assertEqual(load_snapshot(self.path).source, snapshot.source)
+        with open(self.path, 'w') as f:
+            json.dump({'quests': []}, f)
+        self.assertEqual(load_snapshot(self.path).data, {'quests': []})
+        # mapped snapshot is kept after the file is compiled again
+        self.assertEqual(snapshot.data, self.DATA)
+
+    def test_03_stash(self):
+        data = load_snapshot(self.path).data
+        price = data['prices']['farm']
+        stash = Stash({'gold': 100, 'wood': 10}, random=Random(0))
+        self.assertIn(price, stash)
+        stash -= price
+        self.assertEqual(dict(stash), {'gold': 90, 'wood': 5})
+        stash += data['prices']['reward']
+        self.assertTrue(100 <= stash['gold'] <= 110)
+        self.assertNotIn(data['prices']['castle'], stash)
+
+    def test_04_precompile(self):
+        snapshot = load_snapshot(self.path)
+        strings = snapshot.strings()
+        self.assertEqual(len(strings), len(set(strings)))
+        self.assertTrue({'10:20', 'ünicode', '', 'buildings', 'é'}.issubset(strings))
+        # distinct strings of the snapshot are compiled, instead of every string of the content
+        self.assertEqual(precompile_stash_values(snapshot.data), 1)
+        self.assertEqual(precompile_stash_values(self.DATA), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
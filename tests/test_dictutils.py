@@ -0,0 +1,232 @@
+from random import Random
+import unittest
+
+from engine.utils.dictutils import Diffed, DictView, FieldPath, compile_field, compile_fields, dump_value, get_value, \
+    get_values, set_value
+
+__author__ = 'kollad'
+
+
+DOCUMENT = {
+    'resources': {'gold': '100', 'wood': 5.0},
+    'map': {
+        'objects': {'1': {'x': 3, 'y': 4, 'tags': ['house', 'farm']}, '2': {'x': 1, 'y': 2, 'tags': []}},
+        'tilegrid': [[0, 1], [1, 0]],
+    },
+    'list': [0, 1, {'a': 1, 'b': [2, 3]}],
+    'name': 'user',
+}
+
+FIELDS = [
+    'resources.gold', 'resources.wood', 'resources', 'map.objects.1.x', 'map.objects.1.tags[1]', 'map.objects.2',
+    'map.tilegrid[1]', 'map.tilegrid', 'list[2].a', 'list[2].b[1]', 'list[0]', 'name', 'map.objects.1.tags[5]',
+    'missing', 'map.missing.x', 'list[7].a', 'name.first', 'list.a', 'map.objects.1.tags[0].x', 'map.[1]',
+]
+
+
+def get_or_error(function, *args, **kwargs):
+    try:
+        return function(*args, **kwargs)
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        return type(e)
+
+
+class FieldPathTestCase(unittest.TestCase):
+    def test_01_compile(self):
+        path = compile_field('list[2].b[1]')
+        self.assertIs(compile_field('list[2].b[1]'), path)
+        self.assertEqual([segment[:2] for segment in path.segments], [('list', 2), ('b', 1)])
+        self.assertIs(compile_fields(('name', 'list[0]')), compile_fields(('name', 'list[0]')))
+        with self.assertRaises(ValueError):
+            FieldPath('.name')
+
+    def test_02_same_as_get_value(self):
+        for document in (DOCUMENT, DictView(DOCUMENT)):
+            for flatten in (True, False, None):
+                for kwargs in ({}, {'default': None}, {'default': 0}):
+                    results = [get_or_error(get_value, document, field, flatten=flatten, **kwargs)
+                               for field in FIELDS]
+                    found = [(field, result) for field, result in zip(FIELDS, results) if not isinstance(result, type)]
+                    fields = [field for field, _ in found]
+                    # views are compared by their data
+                    self.assertEqual(dump_value(get_values(document, fields, flatten=flatten, **kwargs)),
+                                     dump_value([result for _, result in found]))
+                    # the fields that fail alone fail the whole lookup the same way
+                    for field, result in zip(FIELDS, results):
+                        if isinstance(result, type):
+                            self.assertEqual(get_or_error(get_values, document, fields + [field], flatten=flatten,
+                                                          **kwargs), result, field)
+
+    def test_03_values(self):
+        self.assertEqual(get_values(DOCUMENT, ['resources.gold', 'resources.wood', 'list[2].b[0]', 'name']),
+                         [100, 5, 2, 'user'])
+        self.assertEqual(get_values(DOCUMENT, ['missing', 'map.objects.1.tags[1]'], default=None), [None, 'farm'])
+        # a value can be asked for twice
+        self.assertEqual(get_values(DOCUMENT, ['name', 'name']), ['user', 'user'])
+        self.assertEqual(get_values(DOCUMENT, []), [])
+
+    def test_04_set_value(self):
+        document = {}
+        for field, value in (('a.b', 1), ('a.c[2]', 'x'), ('a.c[0]', 'y'), ('d', {'e': 1}), ('d.f', 2)):
+            set_value(document, field, value)
+        self.assertEqual(document, {'a': {'b': 1, 'c': ['y', None, 'x']}, 'd': {'e': 1, 'f': 2}})
+        with self.assertRaises(ValueError):
+            set_value(document, 'a.b[0]', 1)
+
+
+class DiffedTestCase(unittest.TestCase):
+    SEEDS = 200
+    STEPS = 200
+
+    @staticmethod
+    def make_diffed(seed, materialized):
+        random = Random(seed)
+        data = dict(('k{}'.format(i), {'a': i, 'n': {'x': i}} if i % 3 == 0 else i) for i in range(30))
+        diffs = [dict(('k{}'.format(random.randrange(40)),
+                       None if random.random() < 0.2 else
+                       {'a': random.randrange(9)} if random.random() < 0.3 else random.randrange(9))
+                      for _ in range(5))
+                 for _ in range(6)]
+        return Diffed(data, diffs, materialized=materialized)
+
+    def run_operations(self, diffed, random):
+        """
+        Run random operations on the object, outcomes are the same for the same seed, unless the object behaves
+        differently
+        """
+        outcomes = []
+        held = None
+        for _ in range(self.STEPS):
+            key = 'k{}'.format(random.randrange(40))
+            choice = random.random()
+            try:
+                if choice < 0.25:
+                    value = diffed[key]
+                    outcomes.append(('get', key, dump_value(value)))
+                elif choice < 0.4:
+                    diffed[key] = random.randrange(9)
+                elif choice < 0.45:
+                    del diffed[key]
+                elif choice < 0.55:
+                    outcomes.append(('keys', sorted(diffed.keys()), len(diffed), key in diffed, sorted(diffed)))
+                elif choice < 0.65:
+                    value = diffed[key]
+                    if isinstance(value, Diffed):
+                        value['a'] = random.randrange(9)
+                        value['n'] = {'y': 1}
+                        held = value
+                elif choice < 0.68:
+                    # a nested object, taken before other changes, writes through to the parent
+                    if held is not None:
+                        held['b'] = random.randrange(9)
+                elif choice < 0.73:
+                    diffed.add_diff(dict(('k{}'.format(random.randrange(40)), random.randrange(9)) for _ in range(3)))
+                elif choice < 0.76:
+                    if len(diffed.diffs) > 1:
+                        diffed.remove_diff(diffed.diffs[random.randrange(len(diffed.diffs))])
+                elif choice < 0.78:
+                    diffed.add_diff({key: {'a': 5}})
+                elif choice < 0.8:
+                    if len(diffed.diffs) > 2:
+                        diffed.flatten_diff(diffed.diffs[0])
+                else:
+                    outcomes.append(('dump', diffed.dump()))
+            except (KeyError, LookupError, TypeError, ValueError, RuntimeError) as e:
+                outcomes.append(('error', type(e).__name__))
+        return outcomes
+
+    def test_01_materialized_same_as_lookups(self):
+        for seed in range(self.SEEDS):
+            expected = self.run_operations(self.make_diffed(seed, False), Random(seed))
+            outcomes = self.run_operations(self.make_diffed(seed, True), Random(seed))
+            self.assertEqual(outcomes, expected, 'seed {}'.format(seed))
+
+    def test_02_cached_values(self):
+        diffed = Diffed({'a': 1, 'n': {'x': 1}}, [{}], materialized=True)
+        nested = diffed['n']
+        self.assertIs(diffed['n'], nested)
+        nested['y'] = 2
+        self.assertEqual(diffed.dump(), {'a': 1, 'n': {'x': 1, 'y': 2}})
+        diffed.add_diff({'n': None})
+        self.assertNotIn('n', diffed)
+        self.assertEqual(sorted(diffed), ['a'])
+        with self.assertRaises(KeyError):
+            diffed['n']
+
+    def test_03_stale_nested_object(self):
+        diffed = Diffed({'n': {'x': 1}}, [{}], materialized=True)
+        stale = diffed['n']
+        diffed.add_diff({'a': 1})
+        nested = diffed['n']
+        self.assertIsNot(nested, stale)
+        self.assertEqual(sorted(nested), ['x'])
+        # the object taken before the diff was added writes into the diffs below the new one
+        stale['y'] = 2
+        self.assertEqual(sorted(nested), ['x', 'y'])
+        self.assertEqual(nested['y'], 2)
+        diffed.flatten_diff(*diffed.diffs)
+        self.assertEqual(diffed.data, {'n': {'x': 1, 'y': 2}, 'a': 1})
+
+
+class DumpValueTestCase(unittest.TestCase):
+    @staticmethod
+    def make_value():
+        return {
+            'plain': {'a': 1, 'b': 'x'},
+            'list': [1, 2, 3],
+            'nested': {'list': [[1], [2]], 'dict': {'c': {'d': 4}}},
+            'tuple': (1, (2, 3)),
+            'set': {5},
+            'view': DictView({'e': [6]}),
+            'big': 2 ** 40,
+        }
+
+    def test_01_copy(self):
+        value = self.make_value()
+        dumped = dump_value(value)
+        self.assertEqual(dumped, {
+            'plain': {'a': 1, 'b': 'x'},
+            'list': [1, 2, 3],
+            'nested': {'list': [[1], [2]], 'dict': {'c': {'d': 4}}},
+            'tuple': [1, [2, 3]],
+            'set': [5],
+            'view': {'e': [6]},
+            'big': 2 ** 40,
+        })
+        # nothing is shared, so the dump can be modified
+        dumped['plain']['a'] = 2
+        dumped['list'].append(4)
+        dumped['nested']['list'][0].append(2)
+        dumped['nested']['dict']['c']['d'] = 5
+        dumped['view']['e'].append(7)
+        self.assertEqual(dump_value(value), dump_value(self.make_value()))
+
+    def test_02_reuse(self):
+        value = self.make_value()
+        dumped = dump_value(value, copy=False)
+        self.assertEqual(dumped, dump_value(value))
+        # containers, which need no conversion, are shared with the value
+        self.assertIs(dumped['plain'], value['plain'])
+        self.assertIs(dumped['list'], value['list'])
+        self.assertIs(dumped['nested'], value['nested'])
+        self.assertIs(dumped['view']['e'], value['view'].data['e'])
+        # the rest are converted, so the dicts above them are new
+        self.assertIsNot(dumped, value)
+        self.assertEqual(dumped['tuple'], [1, [2, 3]])
+        self.assertEqual(dumped['set'], [5])
+
+    def test_03_reuse_whole_value(self):
+        value = {'a': [1, {'b': [2]}], 'c': {'d': 'e'}}
+        self.assertIs(dump_value(value, copy=False), value)
+        self.assertIsNot(dump_value(value), value)
+        value['a'][1]['b'].append((3,))
+        dumped = dump_value(value, copy=False)
+        # only the path to the converted tuple is copied
+        self.assertIsNot(dumped['a'], value['a'])
+        self.assertEqual(dumped['a'][1]['b'], [2, [3]])
+        self.assertIs(dumped['c'], value['c'])
+        self.assertEqual(value['a'][1]['b'], [2, (3,)])
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
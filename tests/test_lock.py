@@ -0,0 +1,99 @@
+import unittest
+
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from engine.tests.test_user_manager import RedisServerTestCase
+from engine.user.lock import LockError
+from engine.utils.asyncutils import sleep
+
+__author__ = 'lopalo'
+
+
+class LockNotifierTestCase(RedisServerTestCase):
+    def make_notifier(self):
+        user_manager = self.make_user_manager(lock={'mode': 'notify', 'check_period': 1})
+        return user_manager, user_manager.lock_notifiers[user_manager.shard_name('1')]
+
+    def run_sync(self, func):
+        return IOLoop.current().run_sync(coroutine(func), timeout=10)
+
+    def test_01_own_notifications_are_skipped(self):
+        _, first = self.make_notifier()
+        _, second = self.make_notifier()
+        ioloop = IOLoop.current()
+        key = 'lock:1'
+
+        def wait(notifier, timeout):
+            ioloop.call_later(0.02, self.redis.publish, first.channel(key), first.token)
+            start = ioloop.time()
+            yield from notifier.wait_notification(key, timeout)
+            return ioloop.time() - start
+
+        def run():
+            # the first waits subscribe and return right away
+            yield from first.wait_notification(key, 1)
+            yield from second.wait_notification(key, 1)
+            self.assertGreaterEqual((yield from wait(first, 0.3)), 0.3)
+            self.assertLess((yield from wait(second, 0.3)), 0.2)
+
+            first.pass_turn(key)
+            second.pass_turn(key)
+            yield from sleep(0.05)
+            # polling is stopped when the notifiers are unsubscribed from all channels
+            self.assertIsNone(first._poll_timeout)
+            self.assertIsNone(second._poll_timeout)
+
+        self.run_sync(run)
+
+    def test_02_turns(self):
+        _, notifier = self.make_notifier()
+        key = 'lock:1'
+        turns = []
+
+        def wait_turn(name, timeout=1):
+            if (yield from notifier.wait_turn(key, timeout)):
+                turns.append(name)
+            else:
+                turns.append(name + ' timeout')
+
+        def run():
+            yield from wait_turn('first')
+            futures = [coroutine(wait_turn)('second'), coroutine(wait_turn)('third', 0.05),
+                       coroutine(wait_turn)('fourth')]
+            yield from sleep(0.1)
+            self.assertEqual(turns, ['first', 'third timeout'])
+            # the waiter that timed out is removed from the queue
+            self.assertEqual(len(notifier.queue(key).waiters), 2)
+            notifier.pass_turn(key)
+            notifier.pass_turn(key)
+            yield futures
+            self.assertEqual(turns, ['first', 'third timeout', 'second', 'fourth'])
+            notifier.pass_turn(key)
+            self.assertNotIn(key, notifier._queues)
+
+        self.run_sync(run)
+
+    def test_03_release_wakes_up_other_process(self):
+        first_manager, _ = self.make_notifier()
+        second_manager, _ = self.make_notifier()
+        ioloop = IOLoop.current()
+
+        def run():
+            first = first_manager.get_lock('1')
+            second = second_manager.get_lock('1')
+            yield from first.acquire()
+            ioloop.call_later(0.05, first.release)
+            start = ioloop.time()
+            self.assertTrue((yield from second.acquire(timeout=2)))
+            # woken up by the notification, not by the check period
+            self.assertLess(ioloop.time() - start, 0.5)
+            with self.assertRaises(LockError):
+                yield from first.acquire(blocking=True, timeout=0.1)
+            second.release()
+
+        self.run_sync(run)
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
@@ -0,0 +1,92 @@
+from random import Random
+import unittest
+
+from engine.utils.mathutils import QuantileSketch
+
+__author__ = 'kollad'
+
+
+QUANTILES = (0, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 0.999, 1)
+
+
+def exact_quantile(values, q):
+    return values[int(q * (len(values) - 1))]
+
+
+class QuantileSketchTestCase(unittest.TestCase):
+    def assertWithinAccuracy(self, sketch, values, quantiles=QUANTILES):
+        values = sorted(values)
+        estimates = sketch.quantiles(*quantiles)
+        for q, estimate in zip(quantiles, estimates):
+            expected = exact_quantile(values, q)
+            self.assertLessEqual(abs(estimate - expected), sketch.relative_accuracy * expected + 1e-9, q)
+            self.assertEqual(sketch.quantile(q), estimate)
+
+    def test_01_relative_error(self):
+        random = Random(0)
+        for accuracy in (0.01, 0.05):
+            for values in ([random.expovariate(1) for _ in range(5000)],
+                           [random.lognormvariate(0, 3) for _ in range(5000)],
+                           [random.uniform(100, 101) for _ in range(500)],
+                           [7.5]):
+                sketch = QuantileSketch(*values, relative_accuracy=accuracy)
+                self.assertEqual((sketch.count, sketch.min, sketch.max), (len(values), min(values), max(values)))
+                self.assertWithinAccuracy(sketch, values)
+
+        sketch = QuantileSketch(0, 0, -1, 5, 10)
+        # negative values are counted as zeros
+        self.assertEqual(sketch.quantiles(0, 0.5, 1), [0, 0, 10])
+        self.assertAlmostEqual(sketch.quantile(0.8), 5, delta=0.05)
+        self.assertEqual(QuantileSketch().quantiles(0.5, 0.9), [0, 0])
+
+    def test_02_quantiles_order(self):
+        sketch = QuantileSketch(*range(1, 1001))
+        self.assertEqual(sketch.quantiles(0.99, 0.5, 0.9, 0.5), [sketch.p99, sketch.p50, sketch.p90, sketch.med])
+        self.assertLess(sketch.p50, sketch.p90)
+
+    def test_03_merge(self):
+        random = Random(1)
+        parts = [[random.lognormvariate(0, 2) for _ in range(count)] + [0] * zeros
+                 for count, zeros in ((1000, 3), (300, 0), (0, 0), (2000, 10))]
+        merged = QuantileSketch()
+        for values in parts:
+            merged.merge(QuantileSketch(*values))
+        combined = QuantileSketch(*[value for values in parts for value in values])
+        self.assertEqual(merged.counts, combined.counts)
+        self.assertEqual((merged.count, merged.zero_count, merged.min, merged.max),
+                         (combined.count, combined.zero_count, combined.min, combined.max))
+        self.assertAlmostEqual(merged.sum, combined.sum)
+        self.assertEqual(merged.quantiles(*QUANTILES), combined.quantiles(*QUANTILES))
+        with self.assertRaises(ValueError):
+            merged.merge(QuantileSketch(relative_accuracy=0.05))
+
+    def test_04_collapse(self):
+        random = Random(2)
+        values = [random.lognormvariate(0, 1) for _ in range(5000)]
+        sketch = QuantileSketch(*values, max_buckets=200)
+        self.assertEqual(len(sketch.counts), 200)
+        # the lowest buckets are merged, so high quantiles keep their accuracy
+        self.assertWithinAccuracy(sketch, values, (0.9, 0.99, 0.999, 1))
+        full = QuantileSketch(*values)
+        self.assertEqual(sorted(sketch.counts)[1:], sorted(full.counts)[-199:])
+        self.assertEqual(sketch.counts[min(sketch.counts)],
+                         sum(full.counts[index] for index in sorted(full.counts)[:-199]))
+
+        merged = QuantileSketch(max_buckets=200).merge(QuantileSketch(*values[:2500])).merge(
+            QuantileSketch(*values[2500:]))
+        self.assertEqual(merged.counts, sketch.counts)
+
+    def test_05_dump_and_load(self):
+        sketch = QuantileSketch(*[x / 10 for x in range(1000)])
+        loaded = QuantileSketch.load(sketch.dump())
+        self.assertEqual(loaded.dump(), sketch.dump())
+        self.assertEqual(loaded.quantiles(*QUANTILES), sketch.quantiles(*QUANTILES))
+        loaded += 1000
+        self.assertEqual(loaded.max, 1000)
+        self.assertEqual(loaded.quantile(1), 1000)
+        sketch.clear()
+        self.assertEqual((sketch.count, sketch.counts, sketch.quantile(0.5)), (0, {}, 0))
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
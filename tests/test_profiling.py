@@ -0,0 +1,91 @@
+from random import Random
+import json
+import unittest
+
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+
+from engine.apps.game.handlers.profiling import CommandProfileHandler
+from engine.commands.profiling import CommandProfiler, Histogram
+
+__author__ = 'kollad'
+
+
+class Command(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    def run(self):
+        if self.fail:
+            raise ValueError()
+        return [0] * 1000
+
+
+class CommandProfilerTestCase(unittest.TestCase):
+    def test_01_histogram(self):
+        histogram = Histogram((1, 10, 100))
+        for value in (0.5, 0.5, 5, 50, 500):
+            histogram += value
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.percentile(0.4), 1)
+        self.assertEqual(histogram.percentile(0.5), 10)
+        # the overflow bucket is estimated by the max value
+        self.assertEqual(histogram.percentile(0.99), 500)
+        data = histogram.dump()
+        self.assertEqual((data['count'], data['sum'], data['avg']), (5, 556, 111.2))
+        self.assertEqual(data['buckets'], [[1, 2], [10, 1], [100, 1], ['inf', 1]])
+        self.assertEqual(Histogram((1,)).percentile(0.5), 0)
+
+    def test_02_aggregation(self):
+        profiler = CommandProfiler(sample_rate=0.25, random=Random(0))
+        self.assertAlmostEqual(sum(profiler.sample() for _ in range(10000)) / 10000, 0.25, delta=0.02)
+        for _ in range(3):
+            profiler.run('Build', Command())
+        with self.assertRaises(ValueError):
+            profiler.run('Build', Command(fail=True))
+        profiler.run('Sell', Command())
+
+        data = profiler.dump()
+        self.assertEqual(set(data['commands']), {'Build', 'Sell'})
+        build = data['commands']['Build']
+        self.assertEqual((build['calls'], build['errors']), (4, 1))
+        self.assertEqual(build['wall_time_ms']['count'], 4)
+        self.assertNotIn('allocated_kb', build)
+        self.assertEqual(data['commands']['Sell']['calls'], 1)
+
+        profiler.reset()
+        self.assertEqual(profiler.dump()['commands'], {})
+
+    def test_03_allocations(self):
+        profiler = CommandProfiler(sample_rate=1, trace_allocations=True)
+        for _ in range(4):
+            profiler.run('Build', Command())
+        build = profiler.dump()['commands']['Build']
+        # every other sample is traced instead of being timed
+        self.assertEqual((build['calls'], build['wall_time_ms']['count'], build['allocated_kb']['count']), (4, 2, 2))
+        self.assertGreater(build['allocated_kb']['max'], 4)
+
+
+class CommandProfileHandlerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.profiler = CommandProfiler(sample_rate=1)
+        return Application([
+            (r'/profile/commands', CommandProfileHandler, {'profiler': self.profiler, 'token': 'secret'}),
+            (r'/profile/open', CommandProfileHandler, {'profiler': self.profiler}),
+        ])
+
+    def test_01_token(self):
+        self.profiler.run('Build', Command())
+        for url in ('/profile/commands', '/profile/commands?token=wrong', '/profile/open?token='):
+            response = self.fetch(url)
+            self.assertEqual(response.code, 403)
+            self.assertEqual(json.loads(response.body.decode('utf-8')), {'error': 'Invalid token'})
+
+        response = self.fetch('/profile/commands?token=secret&reset=1')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body.decode('utf-8'))['commands']['Build']['calls'], 1)
+        self.assertEqual(self.profiler.stats, {})
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
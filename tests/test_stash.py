@@ -0,0 +1,233 @@
+from collections import Counter
+from random import Random
+import unittest
+
+from engine.user.loot_simulation import LootSimulator
+from engine.user import user_stash
+from engine.user.user_stash import Stash, StashError, StashValue, compile_stash_value, precompile_stash_values
+from engine.user.user_state import UserState
+from engine.utils.mathutils import AliasSampler, FenwickSampler, Weights
+
+__author__ = 'kollad'
+
+
+LOOT = {'gold': '10:100', 'crystals': '1:3%25', 'wood': '5%50*', 'stone': '7%50*', 'iron': '2%30*', 'energy': 5}
+
+# outcomes of rolling LOOT four times with Random(42), loot tables with a fixed seed should keep them
+SEEDED_LOOT = [
+    {'gold': 91, 'crystals': 3, 'energy': 5, 'wood': 5, 'stone': 0, 'iron': 0},
+    {'gold': 38, 'crystals': 1, 'energy': 5, 'wood': 0, 'stone': 7, 'iron': 0},
+    {'gold': 79, 'crystals': 2, 'energy': 5, 'wood': 5, 'stone': 0, 'iron': 0},
+    {'gold': 21, 'crystals': 3, 'energy': 5, 'wood': 0, 'stone': 7, 'iron': 0},
+]
+
+
+def roll_loot(random, times):
+    return [dict(Stash(LOOT, random=random)) for _ in range(times)]
+
+
+class StashDeterminismTestCase(unittest.TestCase):
+    def test_01_seeded_outcomes(self):
+        self.assertEqual(roll_loot(Random(42), len(SEEDED_LOOT)), SEEDED_LOOT)
+
+    def test_02_same_seed_same_outcomes(self):
+        self.assertEqual(roll_loot(Random(7), 100), roll_loot(Random(7), 100))
+        self.assertNotEqual(roll_loot(Random(7), 100), roll_loot(Random(8), 100))
+
+    def test_03_fixed_random_seed(self):
+        # user manager passes no random with fixed_random_seed, so every loaded state rolls the same
+        first = UserState({'resources': {}}, random=None)
+        second = UserState({'resources': {}}, random=None)
+        self.assertEqual(roll_loot(first.random, 20), roll_loot(second.random, 20))
+
+    def test_04_weighted_gives_one(self):
+        for loot in roll_loot(Random(1), 200):
+            self.assertEqual(sum(1 for key in ('wood', 'stone', 'iron') if loot[key]), 1)
+
+    def test_05_range_roll(self):
+        value = StashValue('1:{}'.format(10 ** 9), random=Random(3))
+        rolls = [value.roll() for _ in range(1000)]
+        self.assertTrue(all(1 <= roll <= 10 ** 9 for roll in rolls))
+        self.assertEqual(StashValue('5:5', random=Random(3)).roll(), 5)
+        value = StashValue('1:3', random=Random(3))
+        self.assertEqual(set(value.roll() for _ in range(3000)), {1, 2, 3})
+
+
+class SamplersTestCase(unittest.TestCase):
+    WEIGHTS = {'a': 1, 'b': 2, 'c': 0, 'd': 7}
+    CHOICES = 50000
+
+    def assertDistribution(self, choose, weights):
+        total = sum(weights.values())
+        counts = Counter(choose() for _ in range(self.CHOICES))
+        self.assertLessEqual(set(counts), set(name for name, weight in weights.items() if weight))
+        for name, weight in weights.items():
+            self.assertAlmostEqual(counts[name] / self.CHOICES, weight / total, delta=0.01)
+
+    def test_01_alias(self):
+        sampler = AliasSampler(self.WEIGHTS, Random(0))
+        self.assertDistribution(sampler.choice, self.WEIGHTS)
+        self.assertEqual(AliasSampler({'a': 3}, Random(0)).choice(), 'a')
+        self.assertRaises(IndexError, AliasSampler, {'a': 0})
+
+    def test_02_fenwick(self):
+        sampler = FenwickSampler(self.WEIGHTS, Random(0))
+        self.assertDistribution(sampler.choice, self.WEIGHTS)
+
+        weights = dict(self.WEIGHTS)
+        for index in range(20):
+            weights['item_{}'.format(index)] = sampler['item_{}'.format(index)] = index % 4
+        del weights['d'], sampler['d']
+        weights['c'] = sampler['c'] = 5
+        weights['e'] = sampler['e'] = 3
+        self.assertEqual(dict(sampler), weights)
+        self.assertEqual(sampler.total, sum(weights.values()))
+        self.assertDistribution(sampler.choice, weights)
+
+    def test_03_weights(self):
+        weights = Weights(**self.WEIGHTS)
+        weights.random = Random(0)
+        self.assertDistribution(weights.choice, self.WEIGHTS)
+        weights['c'] = 10
+        self.assertDistribution(weights.choice, dict(self.WEIGHTS, c=10))
+
+    def test_04_seeded(self):
+        for sampler_class in (AliasSampler, FenwickSampler):
+            first = sampler_class(self.WEIGHTS, Random(5))
+            second = sampler_class(self.WEIGHTS, Random(5))
+            self.assertEqual([first.choice() for _ in range(100)], [second.choice() for _ in range(100)])
+
+
+class StashDeltasTestCase(unittest.TestCase):
+    RESOURCES = ['gold', 'wood', 'stone', 'iron', 'crystals', 'energy']
+
+    def make_deltas(self, random, count):
+        return [dict((key, random.randint(-5, 20)) for key in random.sample(self.RESOURCES, random.randint(1, 4)))
+                for _ in range(count)]
+
+    def test_01_same_as_one_by_one(self):
+        random = Random(0)
+        for _ in range(50):
+            add = self.make_deltas(random, 5) + [Stash({'gold': 3}, random=random)]
+            subtract = self.make_deltas(random, 5)
+            resources = {'gold': 100, 'wood': 0, 'stone': 10}
+            batched = UserState({'resources': dict(resources)}, random=None).stash.apply_deltas(add, subtract)
+            stash = UserState({'resources': dict(resources)}, random=None).stash
+            for delta in add:
+                stash += delta
+            for delta in subtract:
+                stash -= delta
+            # one by one, a missing key is set to 0 by deltas that cancel each other out
+            self.assertEqual(dict(batched), dict((key, value) for key, value in stash.items()
+                                                 if value or key in resources or key in batched))
+
+    def test_02_cancelled_deltas(self):
+        stash = UserState({'resources': {'gold': 10, 'wood': 0}}, random=None).stash
+        stash.apply_deltas([{'gold': 5, 'wood': 2, 'iron': 3}], [{'gold': 5, 'wood': 2, 'iron': 3}])
+        self.assertEqual(dict(stash), {'gold': 10, 'wood': 0})
+        stash.apply_deltas(subtract=[{'gold': 10}])
+        self.assertEqual(dict(stash), {'gold': 0, 'wood': 0})
+
+    def test_03_stash_strings(self):
+        add = [{'gold': '10:100', 'wood': 1}, {'gold': '5%50'}]
+        subtract = [{'gold': '1:3'}]
+        batched = UserState({'resources': {'gold': 100}}, random=Random(3)).stash.apply_deltas(add, subtract)
+        stash = UserState({'resources': {'gold': 100}}, random=Random(3)).stash
+        for delta in add:
+            stash += delta
+        for delta in subtract:
+            stash -= delta
+        # strings are rolled in the same order
+        self.assertEqual(dict(batched), dict(stash))
+
+    def test_04_journaled_state(self):
+        state = UserState({'resources': {'gold': 10}}, random=None)
+        state.begin()
+        state.stash.apply_deltas([{'gold': 5, 'wood': 1}], [{'gold': 1}])
+        self.assertEqual(dict(state['resources']), {'gold': 14, 'wood': 1})
+        state.rollback()
+        self.assertEqual(dict(state['resources']), {'gold': 10})
+
+
+class StashSpecsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.specs = dict(user_stash._specs)
+        user_stash._specs.clear()
+
+    def tearDown(self):
+        user_stash._specs.clear()
+        user_stash._specs.update(self.specs)
+
+    def test_01_shared_specs(self):
+        spec = compile_stash_value('5:10%30*')
+        self.assertIs(compile_stash_value('5:10%30*'), spec)
+        self.assertEqual((spec.min, spec.max, spec.probability, spec.weighted), (5, 10, 0.3, True))
+        with self.assertRaises(AttributeError):
+            spec.min = 1
+        # values of the same string share the spec, but a weighted probability is kept per value
+        first = StashValue('5:10%30*', random=Random(0))
+        second = StashValue('5:10%30*', random=Random(0))
+        first.probability = 0
+        self.assertEqual(second.probability, 0.3)
+        self.assertEqual(len(user_stash._specs), 1)
+        with self.assertRaises(StashError):
+            compile_stash_value('gold')
+        self.assertNotIn('gold', user_stash._specs)
+
+    def test_02_limit(self):
+        limit = user_stash.MAX_SPECS
+        user_stash.MAX_SPECS = 3
+        try:
+            for value in ('1', '2:3', '4%50', '5*'):
+                compile_stash_value(value)
+                self.assertLessEqual(len(user_stash._specs), 3)
+            # the specs are dropped at once when the limit is reached
+            self.assertEqual(list(user_stash._specs), ['5*'])
+            self.assertEqual(compile_stash_value('2:3').max, 3)
+        finally:
+            user_stash.MAX_SPECS = limit
+
+    def test_03_precompile(self):
+        data = {'rewards': [{'gold': '10:100', 'wood': 5}, {'gold': '10:100%50'}, ('10:100',)], 'name': 'farm'}
+        self.assertEqual(precompile_stash_values(data), 3)
+        self.assertEqual(set(user_stash._specs), {'10:100', '10:100%50'})
+
+
+class LootSimulatorTestCase(unittest.TestCase):
+    LOOT = dict(LOOT, token='0%0*', scroll='1:2#2', potion='3%50#2', rune='4#2', broken='10:5')
+    SCALAR_ROLLS = 20000
+    SIMULATED_ROLLS = 200000
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            cls.simulator = LootSimulator(cls.LOOT, seed=0)
+        except ImportError as e:
+            raise unittest.SkipTest(str(e))
+
+    def test_01_matches_scalar_rolls(self):
+        random = Random(0)
+        scalar = [Stash(self.LOOT, random=random) for _ in range(self.SCALAR_ROLLS)]
+        simulated = self.simulator.simulate(self.SIMULATED_ROLLS)
+        self.assertEqual(set(simulated), set(self.LOOT))
+        for key, stats in simulated.items():
+            values = [stash[key] for stash in scalar]
+            self.assertEqual(stats.rolls, self.SIMULATED_ROLLS)
+            self.assertLessEqual(set(stats.counts), set(values) | {0}, key)
+            for value, probability in stats.distribution().items():
+                scalar_probability = values.count(value) / self.SCALAR_ROLLS
+                # 5 standard errors of the scalar estimate
+                error = 5 * (probability * (1 - probability) / self.SCALAR_ROLLS) ** 0.5 + 0.001
+                self.assertAlmostEqual(probability, scalar_probability, delta=error, msg='{} = {}'.format(key, value))
+            mean = sum(values) / self.SCALAR_ROLLS
+            self.assertAlmostEqual(stats.mean, mean, delta=5 * stats.std / self.SCALAR_ROLLS ** 0.5 + 0.001, msg=key)
+
+    def test_02_seeded(self):
+        first = LootSimulator(self.LOOT, seed=3).roll(1000)
+        second = LootSimulator(self.LOOT, seed=3).roll(1000)
+        for key in self.LOOT:
+            self.assertEqual(first[key].tolist(), second[key].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
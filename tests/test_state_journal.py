@@ -0,0 +1,74 @@
+from random import Random
+import json
+import unittest
+
+from engine.common.serializers import data_to_json, json_to_data
+from engine.user.state_journal import TrackedDict
+from engine.user.user_state import UserState
+from engine.utils.dictutils import get_value, set_value, dump_value
+
+__author__ = 'kollad'
+
+
+def make_state():
+    state = UserState({
+        'resources': {'gold': 100, 'wood': 5},
+        'rewards': {'gold': 10, 'crystals': 2},
+        'price': {'gold': 30},
+        'map': {'objects': {'1': {'x': 3, 'y': 4, 'tags': ['house']}}, 'tilegrid': [[0, 1], [1, 0]]},
+        'visited': {1, 2},
+    }, random=Random(0))
+    state.begin()
+    return state
+
+
+class JournaledStateTestCase(unittest.TestCase):
+    def test_01_stash_arithmetic(self):
+        state = make_state()
+        self.assertIsInstance(state['rewards'], TrackedDict)
+        self.assertNotIn(state['rewards'], state.stash)
+        stash = state.stash
+        stash += state['rewards']
+        stash -= state['price']
+        self.assertEqual(dict(state['resources']), {'gold': 80, 'wood': 5, 'crystals': 2})
+        self.assertIn(state['price'], state.stash)
+        self.assertIn(state['rewards'], state.stash)
+
+        state.rollback()
+        self.assertEqual(dict(state['resources']), {'gold': 100, 'wood': 5})
+
+    def test_02_get_and_set_value(self):
+        state = make_state()
+        self.assertEqual(get_value(state['map'], 'objects.1.x'), 3)
+        self.assertEqual(get_value(state['map'], 'tilegrid[1]'), [1, 0])
+        self.assertEqual(get_value(state['map'], 'objects.1.tags[0]'), 'house')
+        self.assertEqual(get_value(state['map'], 'objects.1', flatten=False),
+                         {'x': 3, 'y': 4, 'tags': ['house']})
+
+        set_value(state['map'], 'objects.1.x', 7)
+        set_value(state['map'], 'objects.1.tags[2]', 'farm')
+        self.assertEqual(get_value(state['map'], 'objects.1.x'), 7)
+        self.assertEqual(state['map']['objects']['1']['tags'], ['house', None, 'farm'])
+        state.rollback()
+        self.assertEqual(get_value(state['map'], 'objects.1.x'), 3)
+        self.assertEqual(state['map']['objects']['1']['tags'], ['house'])
+
+    def test_03_serialize_and_dump(self):
+        state = make_state()
+        data = {'m': state['map'], 'visited': state['visited'], 'tilegrid': state['map']['tilegrid']}
+        self.assertEqual(json_to_data(data_to_json(data)), {
+            'm': {'objects': {'1': {'x': 3, 'y': 4, 'tags': ['house']}}, 'tilegrid': [[0, 1], [1, 0]]},
+            'visited': {1, 2},
+            'tilegrid': [[0, 1], [1, 0]],
+        })
+        dumped = dump_value({'m': state['map']})
+        self.assertEqual(json.loads(json.dumps(dumped)), {'m': dict(state.data['map'])})
+
+        state['saved'] = {'map': state['map']}
+        state.commit()
+        self.assertIs(type(state.data['saved']['map']), dict)
+        self.assertEqual(json.loads(json.dumps(state.dump()))['saved']['map']['objects']['1']['x'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
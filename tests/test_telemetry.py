@@ -0,0 +1,96 @@
+import unittest
+
+import zmq
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from engine.apps.game.performance import PerformanceInfo
+from engine.common.telemetry import TelemetryCollector, TelemetryPublisher
+from engine.tests.test_user_sharding import free_port
+from engine.utils.asyncutils import sleep
+from engine.utils.mathutils import QuantileSketch
+from engine.utils.timeutils import milliseconds
+
+__author__ = 'kollad'
+
+
+def make_snapshot(process_id, requests, fetch_times):
+    performance = PerformanceInfo('game-1')
+    performance.requests = requests
+    for value in fetch_times:
+        performance.fetch_time += value
+    snapshot = performance.snapshot(process_id)
+    snapshot['rps'] = requests
+    return snapshot
+
+
+class TelemetryCollectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.address = 'tcp://127.0.0.1:{}'.format(free_port())
+        self.collector = TelemetryCollector(self.address, context=self.context)
+
+    def tearDown(self):
+        self.collector.close()
+        self.context.term()
+
+    def test_01_aggregation(self):
+        self.collector.add(make_snapshot('game.1', 10, range(1, 101)))
+        self.collector.add(make_snapshot('game.2', 30, range(101, 201)))
+        # only the latest snapshot of a process is kept
+        self.collector.add(make_snapshot('game.2', 20, range(101, 201)))
+
+        processes = self.collector.processes()
+        self.assertEqual([process['process_id'] for process in processes], ['game.2', 'game.1'])
+        fetch_time = processes[1]['sketches']['fetch_time']
+        self.assertEqual((fetch_time['count'], fetch_time['avg'], fetch_time['max']), (100, 50.5, 100))
+        self.assertAlmostEqual(fetch_time['p90'], 90, delta=0.9)
+
+        cluster = self.collector.cluster()
+        self.assertEqual((cluster['processes'], cluster['requests'], cluster['rps']), (2, 30, 30))
+        fetch_time = cluster['sketches']['fetch_time']
+        self.assertEqual((fetch_time['count'], fetch_time['max']), (200, 200))
+        # tail latencies are taken from the merged sketches, not averaged over processes
+        expected = QuantileSketch(*range(1, 201))
+        self.assertEqual([fetch_time[name] for name in ('p50', 'p90', 'p99', 'p999')],
+                         expected.quantiles(0.5, 0.9, 0.99, 0.999))
+        self.assertEqual(cluster['sketches']['redis_time']['count'], 0)
+        # merging doesn't change the sketches of the processes
+        self.assertEqual(self.collector.snapshots['game.1']['sketches']['fetch_time'].count, 100)
+
+    def test_02_stale_processes(self):
+        self.collector.add(make_snapshot('game.1', 10, [1]))
+        self.collector.add(make_snapshot('game.2', 10, [1]))
+        self.collector.snapshots['game.1']['received'] = milliseconds() - milliseconds(61)
+        self.assertEqual([process['process_id'] for process in self.collector.processes()], ['game.2'])
+        self.assertEqual(self.collector.dump()['cluster']['processes'], 1)
+
+    def test_03_invalid_snapshots(self):
+        with self.assertLogs('process', 'WARNING'):
+            self.collector.receive([b'not json', b'{"process_id": "game.1"}'])
+        self.assertEqual(self.collector.snapshots, {})
+
+    def test_04_push(self):
+        publisher = TelemetryPublisher(self.address, context=self.context)
+
+        def run():
+            self.assertTrue(publisher.push(make_snapshot('game.1', 5, [1, 2, 3])))
+            for _ in range(100):
+                if self.collector.snapshots:
+                    break
+                yield from sleep(0.01)
+
+        try:
+            IOLoop.current().run_sync(coroutine(run), timeout=5)
+        finally:
+            publisher.close()
+        snapshot = self.collector.snapshots['game.1']
+        self.assertEqual((snapshot['requests'], snapshot['sketches']['fetch_time'].count), (5, 3))
+
+    def test_05_settings(self):
+        self.assertIsNone(TelemetryCollector.from_settings({}))
+        self.assertIsNone(TelemetryPublisher.from_settings({'enable': False}))
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
@@ -0,0 +1,318 @@
+import shutil
+import subprocess
+import time
+import unittest
+
+from pymongo import ReplaceOne
+from pymongo.errors import AutoReconnect, BulkWriteError
+from redis import StrictRedis
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from engine.tests.test_user_sharding import Collection, free_port
+from engine.user.lock import LockError
+from engine.user.user_manager import UserManager
+from engine.utils.timeutils import milliseconds
+
+__author__ = 'kollad'
+
+
+def make_settings(port, **user_manager_settings):
+    settings = {
+        'user_manager': {
+            'redis': {'host': 'localhost', 'port': port, 'password': '', 'db': 0},
+            'mongo': {'host': 'localhost', 'port': 27017, 'db_name': 'test', 'collection': 'users'},
+            'fixed_random_seed': True,
+        },
+        'user': {'session_ttl': 60, 'starting_state': {}},
+    }
+    settings['user_manager'].update(user_manager_settings)
+    return settings
+
+
+class FailingCollection(Collection):
+    """
+    Users collection, that fails to write the documents of the given users
+    """
+
+    def __init__(self):
+        super(FailingCollection, self).__init__()
+        self.failing = set()
+        self.down = False
+
+    def bulk_write(self, requests, ordered=True):
+        if self.down:
+            raise AutoReconnect('Mongo is down')
+        errors = []
+        for index, request in enumerate(requests):
+            if request._filter['_id'] in self.failing:
+                errors.append({'index': index, 'code': 11000, 'errmsg': 'failed'})
+            else:
+                self.documents[request._filter['_id']] = request._doc
+        if errors:
+            raise BulkWriteError({'writeErrors': errors})
+
+
+class UpdatingCollection(Collection):
+    """
+    Users collection, that applies $set and $unset updates and keeps the written requests
+    """
+
+    def __init__(self):
+        super(UpdatingCollection, self).__init__()
+        self.requests = []
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self.requests.append(request)
+            if isinstance(request, ReplaceOne):
+                self.documents[request._filter['_id']] = request._doc
+                continue
+            document = self.documents.setdefault(request._filter['_id'], {'_id': request._filter['_id']})
+            document.update(request._doc.get('$set', {}))
+            for field in request._doc.get('$unset', {}):
+                document.pop(field, None)
+
+
+class RedisServerTestCase(unittest.TestCase):
+    """
+    Runs a dedicated redis server, which is flushed before every test
+    """
+    user_manager_class = UserManager
+
+    @classmethod
+    def setUpClass(cls):
+        if shutil.which('redis-server') is None:
+            raise unittest.SkipTest('redis-server is not found')
+        cls.port = free_port()
+        cls.server = subprocess.Popen(['redis-server', '--port', str(cls.port), '--save', '', '--appendonly', 'no'],
+                                      stdout=subprocess.DEVNULL)
+        cls.redis = StrictRedis('localhost', cls.port)
+        for _ in range(50):
+            try:
+                cls.redis.ping()
+                break
+            except Exception:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+
+    def setUp(self):
+        self.redis.flushall()
+
+    def make_user_manager(self, collection=None, **user_manager_settings):
+        user_manager = self.user_manager_class(make_settings(self.port, **user_manager_settings))
+        user_manager.mongo = collection if collection is not None else Collection()
+        return user_manager
+
+
+class UserDumpTestCase(RedisServerTestCase):
+    def save_users(self, user_manager, count):
+        for index in range(count):
+            user_manager.save(str(index), {'_id': str(index), 'gold': index})
+
+    def members(self, key):
+        return set(member.decode('utf-8') for member in self.redis.smembers(key))
+
+    def test_01_streaming_dump(self):
+        user_manager = self.make_user_manager(dump={'streaming': True, 'batch_size': 4})
+        self.save_users(user_manager, 10)
+        batches = list(user_manager.dump_users_batches())
+        self.assertEqual([count for count, _ in batches], [4, 4, 2])
+        self.assertEqual(len(user_manager.mongo.documents), 10)
+        self.assertEqual(user_manager.mongo.documents['3']['gold'], 3)
+        self.assertEqual(user_manager.unsaved_users_count, 0)
+        self.assertFalse(self.redis.exists(user_manager._flushing_users_key))
+
+    def test_02_failed_writes_are_requeued(self):
+        collection = FailingCollection()
+        collection.failing = {'2', '5'}
+        user_manager = self.make_user_manager(collection, dump={'streaming': True, 'batch_size': 4})
+        self.save_users(user_manager, 10)
+        self.assertEqual(user_manager.dump_users(), 10)
+        self.assertEqual(set(collection.documents), set(map(str, range(10))) - {'2', '5'})
+        self.assertEqual(self.members(user_manager._modified_users_key),
+                         {user_manager.user_key('2'), user_manager.user_key('5')})
+        self.assertFalse(self.redis.exists(user_manager._flushing_users_key))
+
+        collection.failing = set()
+        user_manager.dump_users()
+        self.assertEqual(len(collection.documents), 10)
+        self.assertEqual(user_manager.unsaved_users_count, 0)
+
+    def test_03_interrupted_flush_is_requeued(self):
+        collection = FailingCollection()
+        user_manager = self.make_user_manager(collection, dump={'streaming': True, 'batch_size': 4})
+        self.save_users(user_manager, 10)
+        collection.down = True
+        with self.assertRaises(AutoReconnect):
+            user_manager.dump_users()
+        # the popped batch is left in the flushing set, the rest are still modified
+        flushing = self.members(user_manager._flushing_users_key)
+        self.assertEqual(len(flushing), 4)
+        self.assertEqual(len(self.members(user_manager._modified_users_key) | flushing), 10)
+        self.assertFalse(collection.documents)
+
+        collection.down = False
+        self.assertEqual(user_manager.dump_users(), 10)
+        self.assertEqual(len(collection.documents), 10)
+        self.assertEqual(user_manager.unsaved_users_count, 0)
+        self.assertFalse(self.redis.exists(user_manager._flushing_users_key))
+
+    def test_04_modified_during_flush(self):
+        user_manager = self.make_user_manager(dump={'streaming': True, 'batch_size': 4})
+        self.save_users(user_manager, 3)
+        batches = user_manager.dump_users_batches(shard=user_manager.redis)
+        self.assertEqual(next(batches)[0], 3)
+        # saved after its batch was written, so it's dumped again by the same flush
+        user_manager.save('1', {'_id': '1', 'gold': 100})
+        self.assertEqual([count for count, _ in batches], [1])
+        self.assertEqual(user_manager.mongo.documents['1']['gold'], 100)
+        self.assertEqual(user_manager.unsaved_users_count, 0)
+
+
+class HashStorageTestCase(RedisServerTestCase):
+    def test_01_save_fields(self):
+        user_manager = self.make_user_manager(UpdatingCollection(), storage='hash', dump={'streaming': True})
+        data = {'_id': '1', 'gold': 10, 'wood': 5, 'map': {'objects': {}}}
+        user_manager.save('1', data)
+        user_manager.dump_users()
+        request = user_manager.mongo.requests.pop()
+        self.assertIsInstance(request, ReplaceOne)
+        version = self.redis.get(user_manager.version_key('1'))
+
+        data['gold'] = 20
+        del data['wood']
+        data['map']['objects']['1'] = {'x': 1}
+        self.assertTrue(user_manager.save_fields('1', data, {'gold', 'wood'}))
+        self.assertNotEqual(self.redis.get(user_manager.version_key('1')), version)
+        self.assertEqual(set(self.redis.hkeys(user_manager.user_key('1'))), {b'_id', b'gold', b'map', b'user_id'})
+        # map is not modified as far as the caller knows, so it's not written
+        state = user_manager.get('1')
+        self.assertEqual((state['gold'], state['map']), (20, {'objects': {}}))
+
+        user_manager.dump_users()
+        request, = user_manager.mongo.requests
+        self.assertEqual(request._doc, {'$set': {'gold': 20}, '$unset': {'wood': ''}})
+        self.assertEqual(user_manager.mongo.documents['1'],
+                         {'_id': '1', 'user_id': '1', 'gold': 20, 'map': {'objects': {}}})
+
+    def test_02_save_fields_of_blob(self):
+        user_manager = self.make_user_manager(UpdatingCollection(), storage='hash', dump={'streaming': True})
+        self.redis.set(user_manager.user_key('1'), user_manager.encode_data({'_id': '1', 'gold': 10}))
+        # a user stored as a blob is saved whole
+        self.assertTrue(user_manager.save_fields('1', {'_id': '1', 'gold': 20, 'wood': 5}, {'gold'}))
+        self.assertEqual(self.redis.hlen(user_manager.user_key('1')), 4)
+        user_manager.dump_users()
+        request, = user_manager.mongo.requests
+        self.assertIsInstance(request, ReplaceOne)
+        self.assertEqual(request._doc['wood'], 5)
+
+
+class SaveAndReleaseTestCase(RedisServerTestCase):
+    def acquire(self, user_manager, user_id):
+        lock = user_manager.get_lock(user_id)
+        IOLoop.current().run_sync(coroutine(lock.acquire))
+        return lock
+
+    def test_01_save_and_release(self):
+        user_manager = self.make_user_manager(storage='hash', cache={'enable': True})
+        user_manager.save('1', {'_id': '1', 'gold': 10, 'wood': 5})
+        lock = self.acquire(user_manager, '1')
+        self.assertTrue(user_manager.save_and_release('1', {'_id': '1', 'gold': 20, 'wood': 6}, lock, {'gold'}))
+        self.assertFalse(lock.acquired)
+        self.assertFalse(self.redis.exists(lock.key))
+        self.assertEqual(user_manager.get('1')['gold'], 20)
+        # only the modified fields are written
+        user_manager.cache.discard('1')
+        self.assertEqual(user_manager.load('1')['wood'], 5)
+
+    def test_02_expired_lock(self):
+        user_manager = self.make_user_manager(storage='hash', cache={'enable': True})
+        user_manager.save('1', {'_id': '1', 'gold': 10})
+        version = self.redis.get(user_manager.version_key('1'))
+        for fields in ({'gold'}, None):
+            lock = self.acquire(user_manager, '1')
+            # the lock has expired and is taken by another process
+            self.redis.set(lock.key, 'other')
+            with self.assertRaises(LockError):
+                user_manager.save_and_release('1', {'_id': '1', 'gold': 20}, lock, fields)
+            self.assertFalse(lock.acquired)
+            self.assertEqual(self.redis.get(lock.key), b'other')
+            self.assertEqual(self.redis.get(user_manager.version_key('1')), version)
+            self.assertNotIn('1', user_manager.cache)
+            self.assertEqual(user_manager.get('1')['gold'], 10)
+            self.redis.delete(lock.key)
+
+
+class UserKeysTestCase(RedisServerTestCase):
+    def test_01_scan_resume(self):
+        user_manager = self.make_user_manager()
+        for index in range(100):
+            user_manager.save(str(index), {'_id': str(index)})
+        self.redis.set('other', 1)
+        expected = set(user_manager.user_key(str(index)).encode('utf-8') for index in range(100))
+
+        batches = user_manager.scan_user_keys(batch_size=10)
+        cursor, keys = next(batches)
+        self.assertTrue(cursor)
+        batches.close()
+        # an interrupted walk is continued from the last cursor
+        seen = set(keys)
+        for cursor, keys in user_manager.scan_user_keys(cursor, batch_size=10):
+            seen.update(keys)
+        self.assertEqual(cursor, 0)
+        self.assertEqual(seen, expected)
+
+        dumped = 0
+        for count, _, cursor in user_manager.dump_all_users_batches(batch_size=10):
+            dumped += count
+        self.assertEqual((dumped, cursor), (100, 0))
+        self.assertEqual(len(user_manager.mongo.documents), 100)
+
+    def test_02_online_users(self):
+        user_manager = self.make_user_manager()
+        for index in range(10):
+            user_manager.save(str(index), {'_id': str(index)})
+        self.assertEqual(user_manager.online_users_count, 10)
+        # sessions of these users have expired
+        expired = milliseconds() - milliseconds(user_manager.settings['user']['session_ttl']) - 1000
+        self.redis.zadd(user_manager._online_users_key,
+                        dict((user_manager.user_key(str(index)), expired) for index in range(4)))
+        self.assertEqual(user_manager.online_users_count, 6)
+        self.assertEqual(user_manager.prune_online_users(), 4)
+        self.assertEqual(self.redis.zcard(user_manager._online_users_key), 6)
+        self.assertEqual(user_manager.prune_online_users(), 0)
+
+        user_manager.delete('5')
+        self.assertEqual(user_manager.online_users_count, 5)
+
+
+class UserCacheTestCase(RedisServerTestCase):
+    def test_01_readers_get_copies(self):
+        user_manager = self.make_user_manager(cache={'enable': True})
+        user_manager.save('1', {'_id': '1', 'gold': 10})
+        state = user_manager.get('1')
+        # setdefault-based properties modify the state of a reader, which never saves it
+        state['gold'] = 20
+        state.setdefault('map', {})['objects'] = {}
+
+        state = user_manager.get('1')
+        self.assertNotIn('map', state.data)
+        self.assertEqual(state['gold'], 10)
+        state['gold'] = 30
+        self.assertEqual(user_manager.get('1')['gold'], 10)
+        self.assertEqual(user_manager.cache.hits, 3)
+
+        # a state decoded from redis is copied into the cache as well
+        user_manager.cache.discard('1')
+        user_manager.get('1')['gold'] = 40
+        self.assertEqual(user_manager.get('1')['gold'], 10)
+        self.assertEqual(user_manager.cache.hits, 4)
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
@@ -0,0 +1,264 @@
+from collections import Counter
+import shutil
+import socket
+import subprocess
+import time
+import unittest
+
+from redis import StrictRedis
+from tornado.gen import coroutine, multi
+from tornado.ioloop import IOLoop
+
+from engine.user.sharding import HashRing, rebalance_users
+from engine.user.user_manager import UserManager, TransactionAborted
+from engine.utils.asyncutils import sleep
+
+__author__ = 'kollad'
+
+
+USERS = 300
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Collection(object):
+    """
+    Users collection, that keeps written documents in memory
+    """
+
+    def __init__(self):
+        self.documents = {}
+
+    def ensure_index(self, *args, **kwargs):
+        pass
+
+    def find_one(self, query):
+        return self.documents.get(query['_id'])
+
+    def remove(self, query):
+        self.documents.pop(query['_id'], None)
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self.documents[request._filter['_id']] = request._doc
+
+
+def make_settings(nodes):
+    return {
+        'user_manager': {
+            'redis': {'host': 'localhost', 'port': 6379, 'password': '', 'db': 0,
+                      'shards': [{'name': name, 'port': port} for name, port in nodes],
+                      'log_commands': {'enable': True, 'size': 10, 'ttl': 60}},
+            'mongo': {'host': 'localhost', 'port': 27017, 'db_name': 'test', 'collection': 'users'},
+            'lock': {'mode': 'notify'},
+            'dump': {'streaming': True, 'batch_size': 50},
+            'fixed_random_seed': True,
+        },
+        'user': {'session_ttl': 60, 'starting_state': {}},
+    }
+
+
+class UserShardingTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if shutil.which('redis-server') is None:
+            raise unittest.SkipTest('redis-server is not found')
+        cls.nodes = [('users-{}'.format(index), free_port()) for index in range(3)]
+        cls.servers = [subprocess.Popen(['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+                                        stdout=subprocess.DEVNULL) for _, port in cls.nodes]
+        cls.clients = dict((name, StrictRedis('localhost', port)) for name, port in cls.nodes)
+        for client in cls.clients.values():
+            for _ in range(50):
+                try:
+                    client.ping()
+                    break
+                except Exception:
+                    time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.terminate()
+            server.wait()
+
+    def setUp(self):
+        for client in self.clients.values():
+            client.flushall()
+        self.user_manager = self.make_user_manager(self.nodes)
+
+    def make_user_manager(self, nodes, cache=False):
+        settings = make_settings(nodes)
+        settings['user_manager']['cache'] = {'enable': cache, 'size': 100}
+        user_manager = UserManager(settings)
+        user_manager.mongo = Collection()
+        return user_manager
+
+    def save_users(self, user_manager):
+        for index in range(USERS):
+            user_manager.save(str(index), {'_id': str(index), 'gold': index})
+
+    def owners(self, user_manager):
+        return dict((str(index), user_manager.shard_name(str(index))) for index in range(USERS))
+
+    def test_01_ring(self):
+        ring = HashRing([name for name, _ in self.nodes])
+        owners = Counter(ring.node(str(index)) for index in range(10000))
+        self.assertEqual(set(owners), set(ring.nodes))
+        for count in owners.values():
+            self.assertGreater(count, 10000 / len(self.nodes) / 2)
+
+        bigger = HashRing(ring.nodes + ['users-new'])
+        moved = [index for index in range(10000) if ring.node(str(index)) != bigger.node(str(index))]
+        self.assertTrue(all(bigger.node(str(index)) == 'users-new' for index in moved))
+        self.assertLess(len(moved), 10000 / len(bigger.nodes) * 1.5)
+
+    def test_02_save_get_delete(self):
+        self.save_users(self.user_manager)
+        for user_id, owner in self.owners(self.user_manager).items():
+            key = self.user_manager.user_key(user_id)
+            for name, client in self.clients.items():
+                self.assertEqual(client.exists(key), name == owner)
+            self.assertTrue(self.clients[owner].sismember(self.user_manager._modified_users_key, key))
+        self.assertEqual(self.user_manager.unsaved_users_count, USERS)
+        self.assertEqual(self.user_manager.online_users_count, USERS)
+        self.assertEqual(self.user_manager.get('7')['gold'], 7)
+
+        self.user_manager.delete('7')
+        self.assertIsNone(self.user_manager.get('7', auto_create=False))
+        self.assertEqual(self.user_manager.unsaved_users_count, USERS - 1)
+
+    def test_03_transaction_and_log(self):
+        self.save_users(self.user_manager)
+        user_manager = self.user_manager
+
+        @coroutine
+        def run():
+            transaction = yield from user_manager.transaction('5')
+            lock_key = transaction.lock.key
+            self.assertTrue(self.clients[user_manager.shard_name('5')].exists(lock_key))
+            with transaction as writable_state:
+                writable_state['gold'] += 10
+            yield from transaction.wait()
+            user_manager.log_commands('5', [{'name': 'AddGold'}], {'gold': 15})
+            return lock_key
+
+        lock_key = IOLoop.current().run_sync(run)
+        owner = self.clients[user_manager.shard_name('5')]
+        self.assertFalse(owner.exists(lock_key))
+        self.assertEqual(user_manager.get('5')['gold'], 15)
+        self.assertEqual(len(user_manager.get_commands_log('5')), 1)
+        self.assertTrue(owner.exists(user_manager.log_key('5')))
+
+    def test_04_dump(self):
+        self.save_users(self.user_manager)
+        dumped = sum(count for count, _ in self.user_manager.dump_users_batches())
+        self.assertEqual(dumped, USERS)
+        self.assertEqual(len(self.user_manager.mongo.documents), USERS)
+        self.assertEqual(self.user_manager.unsaved_users_count, 0)
+
+        dumped = sum(count for count, _, _ in self.user_manager.dump_all_users_batches())
+        self.assertEqual(dumped, USERS)
+
+    def test_05_rebalance(self):
+        old_manager = self.make_user_manager(self.nodes[:2])
+        self.save_users(old_manager)
+        old_owners = self.owners(old_manager)
+        new_owners = self.owners(self.user_manager)
+        changed = [user_id for user_id in old_owners if old_owners[user_id] != new_owners[user_id]]
+        self.assertTrue(changed)
+
+        moved, skipped = rebalance_users(self.user_manager)
+        self.assertEqual((moved, skipped), (len(changed), 0))
+        for user_id, owner in new_owners.items():
+            key = self.user_manager.user_key(user_id)
+            self.assertTrue(self.clients[owner].exists(key))
+            self.assertTrue(self.clients[owner].sismember(self.user_manager._modified_users_key, key))
+            self.assertEqual(self.user_manager.get(user_id, auto_create=False)['gold'], int(user_id))
+        self.assertEqual(self.user_manager.unsaved_users_count, USERS)
+        self.assertEqual(rebalance_users(self.user_manager), (0, 0))
+
+    def test_06_cached_transaction(self):
+        user_manager = self.make_user_manager(self.nodes, cache=True)
+        user_manager.save('5', {'_id': '5', 'gold': 5})
+        self.assertEqual(user_manager.get('5')['gold'], 5)
+        self.assertIn('5', user_manager.cache)
+
+        @coroutine
+        def run():
+            transaction = yield from user_manager.transaction('5')
+            with transaction as writable_state:
+                writable_state['gold'] += 10
+                # readers don't see uncommitted changes through the cache
+                self.assertEqual(user_manager.get('5')['gold'], 5)
+            yield from transaction.wait()
+            self.assertEqual(user_manager.get('5')['gold'], 15)
+
+            transaction = yield from user_manager.transaction('5')
+            with self.assertRaises(ValueError):
+                with transaction as writable_state:
+                    writable_state['gold'] += 10
+                    raise ValueError()
+            self.assertEqual(user_manager.get('5')['gold'], 15)
+
+        IOLoop.current().run_sync(run)
+        self.assertEqual(user_manager.cache.stats()['bytes'], user_manager.cache.entry_size('5'))
+
+    def test_07_joined_transaction_abort(self):
+        user_manager = self.make_user_manager(self.nodes, cache=True)
+        user_manager.save('5', {'_id': '5', 'gold': 5})
+        user_manager.get('5')
+        reads = []
+
+        @coroutine
+        def first():
+            transaction = yield from user_manager.transaction('5')
+            with transaction as writable_state:
+                writable_state['gold'] += 10
+                # the second request joins meanwhile
+                yield from sleep(0.05)
+            yield from transaction.wait()
+
+        @coroutine
+        def second():
+            yield from sleep(0.01)
+            transaction = yield from user_manager.transaction('5')
+            self.assertEqual(transaction.requests_count, 2)
+            with transaction as writable_state:
+                self.assertEqual(writable_state['gold'], 15)
+                reads.append(user_manager.get('5')['gold'])
+                writable_state['gold'] += 10
+                raise ValueError()
+
+        @coroutine
+        def reader():
+            yield from sleep(0.03)
+            reads.append(user_manager.get('5')['gold'])
+
+        @coroutine
+        def run():
+            results = yield multi([self.collect(first()), self.collect(second()), reader()])
+            return results[:2]
+
+        first_error, second_error = IOLoop.current().run_sync(run)
+        # the first request is answered with an error instead of changes, that are never saved
+        self.assertIsInstance(first_error, TransactionAborted)
+        self.assertIsInstance(second_error, ValueError)
+        self.assertEqual(reads, [5, 5])
+        self.assertEqual(user_manager.get('5')['gold'], 5)
+        self.assertEqual(self.make_user_manager(self.nodes).get('5')['gold'], 5)
+
+    @staticmethod
+    @coroutine
+    def collect(request):
+        try:
+            yield request
+        except Exception as e:
+            return e
+
+
+if __name__ == '__main__':
+    unittest.main(warnings='ignore')
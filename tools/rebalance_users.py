@@ -0,0 +1,43 @@
+"""
+Move users between redis nodes after the user manager's node list has changed. Add the new node to
+user_manager.redis.shards in settings, stop game servers and run:
+
+    python -m engine.tools.rebalance_users --settings settings.yaml
+
+To remove a node, drop it from the settings and pass its address, so its users are moved to the remaining ones:
+
+    python -m engine.tools.rebalance_users --settings settings.yaml --source localhost:6381/10
+"""
+from argparse import ArgumentParser
+
+from redis import StrictRedis
+
+from engine.common.settings import load_settings
+from engine.user.sharding import rebalance_users
+from engine.user.user_manager import UserManager
+
+__author__ = 'kollad'
+
+
+def parse_node(address, password):
+    host, _, port = address.partition(':')
+    port, _, db = port.partition('/')
+    return StrictRedis(host, int(port or 6379), int(db or 0), password or None)
+
+
+def run():
+    parser = ArgumentParser(description='Move users to their redis nodes')
+    parser.add_argument('--settings', default='settings.yaml')
+    parser.add_argument('--source', action='append', default=[], help='Removed node, host:port/db')
+    parser.add_argument('--password', default='', help='Password of removed nodes')
+    parser.add_argument('--batch-size', type=int, default=None, help='SCAN count hint')
+    options = parser.parse_args()
+
+    user_manager = UserManager(load_settings(options.settings))
+    sources = [parse_node(address, options.password) for address in options.source]
+    moved, skipped = rebalance_users(user_manager, sources, batch_size=options.batch_size)
+    print('Moved: {}. Skipped locked: {}'.format(moved, skipped))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,395 @@
+from hashlib import sha1
+import json
+from logging import getLogger
+from time import perf_counter
+
+from redis.exceptions import ConnectionError, ResponseError
+from tornado.concurrent import chain_future
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from engine.user.lock import RedisLock, LockRedisMixin, LockError
+from engine.user.user_manager import UserManager, UserTransaction, UserRedis
+from engine.utils.timeutils import milliseconds
+
+__author__ = 'kollad'
+
+log = getLogger('process')
+
+
+class AsyncRedis(object):
+    """
+    Non-blocking redis client on top of tornadis connection pool. Replies are returned as they come from redis,
+    errors are raised as redis-py exceptions, so they are handled the same way as with the blocking client.
+    """
+
+    def __init__(self, host, port, db=0, password=None, pool_size=-1, ioloop=None):
+        """
+        :param pool_size: Maximum connections count, unlimited if -1
+        :type pool_size: int
+        """
+        try:
+            import tornadis
+        except ImportError:
+            raise ImportError('tornadis is required for asynchronous user manager')
+        self._tornadis = tornadis
+        self.pool = tornadis.ClientPool(max_size=pool_size, host=host, port=port, db=db, password=password or None,
+                                        ioloop=ioloop or IOLoop.instance(), tcp_nodelay=True)
+        self._script_hashes = {}
+        # commands and pipelines sent to redis, i.e. network round trips
+        self.round_trips = 0
+        # QuantileSketch of round trip times in milliseconds, set it to measure them
+        self.round_trip_time = None
+
+    def _check_reply(self, reply):
+        if isinstance(reply, self._tornadis.ConnectionError):
+            raise ConnectionError(str(reply))
+        if isinstance(reply, self._tornadis.TornadisException):
+            raise ResponseError(str(reply))
+        return reply
+
+    def _track_time(self, start):
+        if self.round_trip_time is not None:
+            self.round_trip_time += (perf_counter() - start) * 1000
+
+    @coroutine
+    def call(self, *args):
+        """
+        Call redis command
+
+        :return: Command reply
+        """
+        with (yield self.pool.connected_client()) as client:
+            self._check_reply(client)
+            self.round_trips += 1
+            start = perf_counter()
+            reply = yield client.call(*args)
+            self._track_time(start)
+        return self._check_reply(reply)
+
+    @coroutine
+    def pipeline(self, *calls, transaction=True):
+        """
+        Call several redis commands with a single round trip
+
+        :param calls: Commands, each one is a tuple of command arguments
+        :param transaction: Wrap commands into MULTI/EXEC
+        :type transaction: bool
+        :return: Command replies
+        :rtype: list
+        """
+        pipeline = self._tornadis.Pipeline()
+        if transaction:
+            pipeline.stack_call('MULTI')
+        for args in calls:
+            pipeline.stack_call(*args)
+        if transaction:
+            pipeline.stack_call('EXEC')
+        with (yield self.pool.connected_client()) as client:
+            self._check_reply(client)
+            self.round_trips += 1
+            start = perf_counter()
+            replies = yield client.call(pipeline)
+            self._track_time(start)
+        self._check_reply(replies)
+        if transaction:
+            # replies of the queued commands come with EXEC, the previous ones are just QUEUED
+            for reply in replies[:-1]:
+                self._check_reply(reply)
+            replies = self._check_reply(replies[-1])
+        for reply in replies:
+            self._check_reply(reply)
+        return replies
+
+    @coroutine
+    def script(self, script, keys=(), args=()):
+        """
+        Run lua script by its hash, the script is loaded with EVAL if redis doesn't know it yet
+
+        :param script: Script source
+        :type script: str
+        :return: Script reply
+        """
+        try:
+            script_hash = self._script_hashes[script]
+        except KeyError:
+            script_hash = self._script_hashes[script] = sha1(script.encode('utf-8')).hexdigest()
+        try:
+            reply = yield self.call('EVALSHA', script_hash, len(keys), *keys, *args)
+        except ResponseError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+            reply = yield self.call('EVAL', script, len(keys), *keys, *args)
+        return reply
+
+    def destroy(self):
+        self.pool.destroy()
+
+
+class AsyncRedisLock(RedisLock):
+    """
+    User lock, that talks to redis with non-blocking client. Release returns a future.
+    """
+
+    def __init__(self, redis, key, ioloop=None, notifier=None, async_redis=None, *args, **kwargs):
+        """
+        :param async_redis: Non-blocking redis client
+        :type async_redis: AsyncRedis
+        """
+        super(AsyncRedisLock, self).__init__(redis, key, ioloop, notifier, *args, **kwargs)
+        self._async_redis = async_redis
+
+    def _set_lock(self, key, value):
+        return self._async_redis.call('SET', key, value, 'NX', 'EX', self.validity_time)
+
+    @coroutine
+    def release(self):
+        lock_value = self._lock_value
+        self._acquire_time = None
+        self._lock_value = None
+        notifier = self._notifier
+        if notifier is None:
+            result = yield self._async_redis.script(LockRedisMixin.RELEASE_LOCK_SCRIPT, keys=[self.key, lock_value])
+        else:
+            try:
+                result = yield self._async_redis.script(
+                    LockRedisMixin.RELEASE_NOTIFY_LOCK_SCRIPT,
+                    keys=[self.key, notifier.channel(self.key)], args=[lock_value, notifier.token])
+            finally:
+                notifier.pass_turn(self.key)
+        if not result:
+            raise LockError('Try to release unlocked lock')
+
+
+class AsyncUserTransaction(UserTransaction):
+    """
+    User state transaction of asynchronous user manager. State is saved and the lock is released in background,
+    when the last request of the transaction exits, wait for the commit before responding.
+    """
+
+    def commit(self):
+        chain_future(self._commit(), self.committed)
+
+    @coroutine
+    def _commit(self):
+        try:
+            self.lock.check_validity_time()
+            result = yield self.user_manager.commit(self.user_id, self.writable_state, self.lock)
+        except Exception:
+            self.discard()
+            raise
+        finally:
+            if self.lock.acquired:
+                yield self.lock.release()
+        return result
+
+    def release(self):
+        self.lock.release().add_done_callback(self._log_release_error)
+
+    @staticmethod
+    def _log_release_error(future):
+        if future.exception() is not None:
+            log.error('User lock release failed: {}'.format(future.exception()))
+
+
+class AsyncUserManager(UserManager):
+    """
+    User manager with non-blocking redis client. Methods used in requests processing: get, load,
+    acquire_and_load, save, save_fields, save_and_release, delete, commit, log_commands and get_commands_log
+    return futures, the transaction helper and locks are non-blocking as well. Mongo is still blocking, it is used
+    only when user is not in redis.
+
+    The blocking client remains for backend tasks: dumping users to mongo, scans, counters.
+    """
+    transaction_class = AsyncUserTransaction
+
+    def __init__(self, settings):
+        self.async_redis = None
+        self.async_shards = None
+        super(AsyncUserManager, self).__init__(settings)
+
+    def init_redis(self):
+        """
+        Initialize blocking and non-blocking redis clients of every node
+
+        :return:
+        """
+        super(AsyncUserManager, self).init_redis()
+        pool_size = self.settings['user_manager']['redis'].get('pool_size', -1)
+        self.async_shards = dict(
+            (name, AsyncRedis(node['host'], node['port'], node['db'], node['password'], pool_size=pool_size))
+            for name, node in self.redis_nodes.items())
+        self.async_redis = self.async_shards[self.ring.nodes[0]]
+
+    def async_shard(self, user_id):
+        """
+        :param user_id: User ID
+        :type user_id: str
+        :return: Non-blocking redis client of the node the user is stored on
+        :rtype: AsyncRedis
+        """
+        return self.async_shards[self.ring.node(user_id)]
+
+    def get_lock(self, key):
+        """
+        :return: AsyncRedisLock object
+        """
+        name = self.shard_name(key)
+        return AsyncRedisLock(self.shards[name], key, notifier=self.lock_notifiers.get(name),
+                              async_redis=self.async_shards[name])
+
+    @coroutine
+    def get(self, user_id, auto_create=True):
+        user_id = str(user_id)
+        data = yield self.load(user_id)
+        if data is None:
+            data = yield self.fetch_or_create(user_id, auto_create=auto_create)
+        return self.make_user_state(data)
+
+    @coroutine
+    def load(self, user_id):
+        cache = self.cache
+        cached_version = cache.version(user_id) if cache is not None else None
+        version, stored = yield self.async_shard(user_id).script(
+            UserRedis.LOAD_USER_SCRIPT,
+            keys=[self.user_key(user_id), self.version_key(user_id)],
+            args=[cached_version or ''])
+        return self.loaded(user_id, version, stored)
+
+    @coroutine
+    def acquire_and_load(self, user_id, lock_key, lock_value, validity_time=RedisLock.validity_time):
+        cache = self.cache
+        cached_version = cache.version(user_id) if cache is not None else None
+        loaded = yield self.async_shard(user_id).script(
+            UserRedis.ACQUIRE_LOAD_USER_SCRIPT,
+            keys=[lock_key, self.user_key(user_id), self.version_key(user_id)],
+            args=[lock_value, validity_time, cached_version or ''])
+        if loaded is None:
+            return None
+        return True, self.loaded(user_id, *loaded, exclusive=True)
+
+    @coroutine
+    def fetch_or_create(self, user_id, auto_create=True):
+        user_state = self.mongo.find_one({'_id': user_id})
+
+        if not user_state and auto_create:
+            user_state = self.create_user_state(user_id)
+
+        if user_state:
+            result = yield self.save(user_id, user_state)
+            if result:
+                log.debug('User {} saved to redis'.format(user_id))
+            else:
+                raise ValueError('Cannot save user to redis : {}'.format(user_id))
+            return user_state
+        return None
+
+    @coroutine
+    def delete(self, user_id):
+        self.mongo.remove({'_id': user_id})
+        user_key = self.user_key(user_id)
+        results = yield self.async_shard(user_id).pipeline(
+            ('DEL', user_key),
+            ('DEL', self.version_key(user_id)),
+            ('DEL', self.fields_key(user_id)),
+            ('SREM', self._modified_users_key, user_key),
+            ('ZREM', self._online_users_key, user_key))
+        if self.cache is not None:
+            self.cache.discard(user_id)
+        return results[0]
+
+    @coroutine
+    def save(self, user_id, data):
+        user_key = self.user_key(user_id)
+        data['user_id'] = user_id
+        version = self.make_version()
+        if self.hash_storage:
+            stored = self.encode_fields(data)
+            hset = ['HSET', user_key]
+            for field, value in stored.items():
+                hset.extend((field, value))
+            calls = [('DEL', user_key), hset, ('DEL', self.fields_key(user_id)),
+                     ('SADD', self.fields_key(user_id), self._all_fields)]
+            size = sum(map(len, stored.values()))
+        else:
+            stored = self.encode_data(data)
+            # the set command cancels a user's ttl
+            calls = [('SET', user_key, stored)]
+            size = len(stored)
+        calls.extend((
+            ('SET', self.version_key(user_id), version),
+            ('SADD', self._modified_users_key, user_key),
+            ('ZADD', self._online_users_key, milliseconds(), user_key)))
+        try:
+            results = yield self.async_shard(user_id).pipeline(*calls)
+        except Exception:
+            self._cache_saved(user_id, version, data, 0, False)
+            raise
+        result = bool(results[int(self.hash_storage)])
+        self._cache_saved(user_id, version, data, size, result)
+        return result
+
+    @coroutine
+    def save_fields(self, user_id, data, fields):
+        if not self.hash_storage:
+            return (yield self.save(user_id, data))
+        data['user_id'] = user_id
+        version = self.make_version()
+        encoded = self.encode_fields(dict((field, data[field]) for field in fields if field in data))
+        args = [version, milliseconds(), len(encoded)]
+        for field, value in encoded.items():
+            args.extend((field, value))
+        args.extend(field for field in fields if field not in data)
+        result = yield self.async_shard(user_id).script(
+            UserRedis.SAVE_USER_FIELDS_SCRIPT,
+            keys=[self.user_key(user_id), self.version_key(user_id), self._modified_users_key,
+                  self._online_users_key, self.fields_key(user_id)],
+            args=args)
+        if not result:
+            return (yield self.save(user_id, data))
+        size = sum(map(len, encoded.values()))
+        if self.cache is not None:
+            size = max(size, self.cache.entry_size(user_id))
+        self._cache_saved(user_id, version, data, size, result)
+        return result
+
+    @coroutine
+    def save_and_release(self, user_id, data, lock, fields=None):
+        version, args, size = self._save_release_args(user_id, data, lock, fields)
+        result = yield self.async_shard(user_id).script(
+            UserRedis.SAVE_RELEASE_USER_SCRIPT, keys=self._save_release_keys(user_id, lock), args=args)
+        if not result:
+            return (yield self.save_and_release(user_id, data, lock))
+        return self._saved_and_released(user_id, version, data, size, lock, result)
+
+    @property
+    def redis_round_trips(self):
+        return (super(AsyncUserManager, self).redis_round_trips +
+                sum(shard.round_trips for shard in self.async_shards.values()))
+
+    def track_round_trip_time(self, sketch):
+        super(AsyncUserManager, self).track_round_trip_time(sketch)
+        for shard in self.async_shards.values():
+            shard.round_trip_time = sketch
+
+    @coroutine
+    def log_commands(self, user_id, commands, response):
+        settings = self.settings['user_manager']['redis']['log_commands']
+        if not settings['enable']:
+            return
+        if isinstance(commands, str):
+            commands = json.loads(commands)
+        key = self.log_key(user_id)
+        data = {"ts": milliseconds(),
+                "commands": commands,
+                "response": response}
+        yield self.async_shard(user_id).pipeline(
+            ('RPUSH', key, json.dumps(data)),
+            ('LTRIM', key, -settings['size'], -1),
+            ('EXPIRE', key, settings['ttl']))
+
+    @coroutine
+    def get_commands_log(self, user_id):
+        key = self.log_key(user_id)
+        data = yield self.async_shard(user_id).call('LRANGE', key, 0, -1)
+        return [json.loads(i.decode("utf-8")) for i in data]
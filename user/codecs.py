@@ -0,0 +1,228 @@
+from collections import OrderedDict, namedtuple
+import zlib
+
+from engine.common.serializers import data_to_json, json_to_data, isnamedtuple
+
+__author__ = 'kollad'
+
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+MSGPACK_ZLIB = 'msgpack+zlib'
+MSGPACK_LZ4 = 'msgpack+lz4'
+
+# msgpack extension types for python types, which are not supported by msgpack natively
+EXT_TUPLE = 1
+EXT_SET = 2
+EXT_ORDERED_DICT = 3
+EXT_NAMEDTUPLE = 4
+EXT_BIG_INT = 5
+
+# range of integers packed natively by msgpack, others are packed as decimal strings
+MIN_INT = -2 ** 63
+MAX_INT = 2 ** 64 - 1
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec(object):
+    """
+    User state codec. Every codec but the legacy json one prefixes encoded data with its header byte, so data
+    encoded with different codecs can be stored side by side and decoded with decode_data.
+    """
+    name = None
+    header = b''
+
+    def encode(self, data):
+        raise NotImplementedError()
+
+    def decode(self, data):
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return '<{}: {}>'.format(self.__class__.__name__, self.name)
+
+
+class JSONCodec(Codec):
+    """
+    Legacy codec, data is stored as plain json without a header
+    """
+    name = JSON
+
+    def encode(self, data):
+        return data_to_json(data)
+
+    def decode(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json_to_data(data)
+
+
+class MsgpackCodec(Codec):
+    name = MSGPACK
+    header = b'\x01'
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError('msgpack is required for {} codec'.format(self.name))
+        self._msgpack = msgpack
+        self._ext_decoders = {
+            EXT_TUPLE: tuple,
+            EXT_SET: set,
+            EXT_ORDERED_DICT: OrderedDict,
+            EXT_NAMEDTUPLE: self._restore_namedtuple,
+            EXT_BIG_INT: int,
+        }
+
+    def _default(self, value):
+        msgpack = self._msgpack
+        if isinstance(value, OrderedDict):
+            return msgpack.ExtType(EXT_ORDERED_DICT, self.pack(list(value.items())))
+        if isinstance(value, dict):
+            return dict(value)
+        if isnamedtuple(value):
+            return msgpack.ExtType(EXT_NAMEDTUPLE, self.pack(
+                [type(value).__name__, list(value._fields), list(value)]))
+        if isinstance(value, tuple):
+            return msgpack.ExtType(EXT_TUPLE, self.pack(list(value)))
+        if isinstance(value, (set, frozenset)):
+            return msgpack.ExtType(EXT_SET, self.pack(list(value)))
+        if isinstance(value, list):
+            return list(value)
+        if isinstance(value, int):
+            if not MIN_INT <= value <= MAX_INT:
+                return msgpack.ExtType(EXT_BIG_INT, self.pack(str(int(value))))
+            return int(value)
+        if isinstance(value, str):
+            return str(value)
+        raise TypeError('Type {} is not data-serializable'.format(type(value)))
+
+    def _ext_hook(self, code, data):
+        try:
+            decoder = self._ext_decoders[code]
+        except KeyError:
+            return self._msgpack.ExtType(code, data)
+        return decoder(self.unpack(data))
+
+    @staticmethod
+    def _restore_namedtuple(data):
+        type_name, fields, values = data
+        return namedtuple(type_name, fields)(*values)
+
+    def pack(self, data):
+        # strict types make tuples and dict subclasses go through the default hook instead of being packed as
+        # plain lists and dicts
+        return self._msgpack.packb(data, default=self._default, use_bin_type=True, strict_types=True)
+
+    def unpack(self, data):
+        return self._msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False, strict_map_key=False)
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def encode(self, data):
+        return self.header + self.compress(self.pack(data))
+
+    def decode(self, data):
+        return self.unpack(self.decompress(memoryview(data)[len(self.header):]))
+
+
+class MsgpackZlibCodec(MsgpackCodec):
+    name = MSGPACK_ZLIB
+    header = b'\x02'
+    level = 1
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class MsgpackLZ4Codec(MsgpackCodec):
+    name = MSGPACK_LZ4
+    header = b'\x03'
+
+    def __init__(self):
+        super(MsgpackLZ4Codec, self).__init__()
+        try:
+            import lz4.block
+        except ImportError:
+            raise ImportError('lz4 is required for {} codec'.format(self.name))
+        self._lz4 = lz4.block
+
+    def compress(self, data):
+        return self._lz4.compress(data)
+
+    def decompress(self, data):
+        return self._lz4.decompress(data)
+
+
+_codec_classes = {}
+_codecs = {}
+_codec_headers = {}
+
+
+def register_codec(codec_class):
+    """
+    Register codec class, so it could be selected by name and data encoded with it could be decoded
+
+    :param codec_class: Codec class
+    :type codec_class: type
+    """
+    _codec_classes[codec_class.name] = codec_class
+    if codec_class.header:
+        _codec_headers[codec_class.header[0]] = codec_class.name
+    return codec_class
+
+
+for _codec_class in (JSONCodec, MsgpackCodec, MsgpackZlibCodec, MsgpackLZ4Codec):
+    register_codec(_codec_class)
+
+
+def get_codec(name=JSON):
+    """
+    :param name: Codec name
+    :type name: str
+    :return: Codec instance
+    :rtype: Codec
+    :raises: CodecError if codec is unknown, ImportError if codec dependencies are not installed
+    """
+    try:
+        return _codecs[name]
+    except KeyError:
+        pass
+    try:
+        codec_class = _codec_classes[name]
+    except KeyError:
+        raise CodecError('Unknown codec: {}'.format(name))
+    codec = _codecs[name] = codec_class()
+    return codec
+
+
+def get_data_codec(data):
+    """
+    Detect codec data was encoded with. Data without a known header is treated as legacy json.
+
+    :param data: Encoded data
+    :type data: bytes or str
+    :rtype: Codec
+    """
+    if isinstance(data, str) or not data:
+        return get_codec(JSON)
+    return get_codec(_codec_headers.get(data[0], JSON))
+
+
+def encode_data(data, codec=JSON):
+    return get_codec(codec).encode(data)
+
+
+def decode_data(data):
+    return get_data_codec(data).decode(data)
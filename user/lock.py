@@ -1,24 +1,246 @@
+from collections import deque
+from logging import getLogger
 from uuid import uuid4
 
 from redis import StrictRedis
+from redis.exceptions import RedisError
+from tornado.concurrent import Future
+from tornado.gen import maybe_future
 from tornado.ioloop import IOLoop
 
-from engine.utils.asyncutils import sleep
+from engine.utils.asyncutils import sleep, wait_future
 
 __author__ = "lopalo"
 
 
+log = getLogger('process')
+
+
 class LockError(Exception):
     pass
 
 
+class LocalLockQueue(object):
+    """
+    Per-process FIFO of lock waiters. Only one waiter at a time, the contender, talks to redis: it either holds
+    the lock or tries to acquire it. The rest wait for the contender to pass the turn to them.
+    """
+    __slots__ = ('busy', 'waiters', 'notification', 'subscribed')
+
+    def __init__(self):
+        self.busy = False
+        self.waiters = deque()
+        self.notification = None
+        self.subscribed = False
+
+
+class LockNotifier(object):
+    """
+    Wakes up lock waiters of the process, when lock is released. Releases are published to a per-lock channel,
+    the notifier is subscribed to the channels of the locks, that have local waiters, with a single connection.
+    The connection is polled on the IOLoop with non-blocking reads, while there are subscriptions.
+    """
+    channel_prefix = 'lock-released'
+
+    def __init__(self, redis, ioloop=None, check_period=0.5, poll_period=0.005):
+        """
+        :param redis: Redis client
+        :type redis: StrictRedis
+        :param ioloop: IOLoop
+        :type ioloop: IOLoop
+        :param check_period: Fallback period to check the lock, in case notification is lost or the lock expired
+        :type check_period: float
+        :param poll_period: Period to read notifications from the connection, in seconds
+        :type poll_period: float
+        """
+        self._ioloop = ioloop or IOLoop.instance()
+        self._redis = redis
+        self._pubsub = None
+        self._poll_timeout = None
+        self._queues = {}
+        self.check_period = check_period
+        self.poll_period = poll_period
+        # notifications sent by this process are skipped, the turn is passed to local waiters directly
+        self.token = uuid4().hex
+
+    def channel(self, key):
+        return '{}:{}'.format(self.channel_prefix, key)
+
+    def queue(self, key):
+        try:
+            return self._queues[key]
+        except KeyError:
+            queue = self._queues[key] = LocalLockQueue()
+            return queue
+
+    def subscribe(self, key):
+        """
+        Subscribe to release notifications of the lock, the connection is opened with the first subscription
+
+        :param key: Lock key
+        :type key: str
+        :return: False if the notifier is not started
+        :rtype: bool
+        """
+        try:
+            if self._pubsub is None:
+                pubsub = self._redis.pubsub()
+                pubsub.subscribe(self.channel(key))
+                self._pubsub = pubsub
+            else:
+                self._pubsub.subscribe(self.channel(key))
+        except RedisError as e:
+            log.error('Lock notifier is not started: {}'.format(e))
+            return False
+        if self._poll_timeout is None:
+            self._schedule_poll()
+        return True
+
+    def unsubscribe(self, key):
+        """
+        :param key: Lock key
+        :type key: str
+        """
+        if self._pubsub is None:
+            return
+        try:
+            self._pubsub.unsubscribe(self.channel(key))
+        except RedisError as e:
+            log.error('Lock notifier stopped: {}'.format(e))
+            self.stop()
+
+    def stop(self):
+        if self._pubsub is None:
+            return
+        if self._poll_timeout is not None:
+            self._ioloop.remove_timeout(self._poll_timeout)
+            self._poll_timeout = None
+        try:
+            self._pubsub.close()
+        except RedisError:
+            pass
+        self._pubsub = None
+        for queue in self._queues.values():
+            queue.subscribed = False
+
+    def _schedule_poll(self):
+        self._poll_timeout = self._ioloop.call_later(self.poll_period, self._poll)
+
+    def _poll(self):
+        self._poll_timeout = None
+        token = self.token.encode('utf-8')
+        try:
+            while True:
+                message = self._pubsub.get_message(timeout=0)
+                if message is None:
+                    break
+                # confirmations of subscriptions are skipped too
+                if message['type'] != 'message' or message['data'] == token:
+                    continue
+                channel = message['channel'].decode('utf-8')
+                self.notify(channel[len(self.channel_prefix) + 1:])
+        except RedisError as e:
+            # waiters fall back to periodic checks until the notifier is started again
+            log.error('Lock notifier stopped: {}'.format(e))
+            self.stop()
+            return
+        # polling is stopped, when confirmations of all unsubscriptions are read
+        if self._pubsub.subscribed:
+            self._schedule_poll()
+
+    def notify(self, key):
+        """
+        Wake up the contender of the lock
+
+        :param key: Lock key
+        :type key: str
+        """
+        try:
+            notification = self._queues[key].notification
+        except KeyError:
+            return
+        if notification is not None and not notification.done():
+            notification.set_result(True)
+
+    def wait_notification(self, key, timeout):
+        """
+        Wait until the lock is released by another process or timeout expired. The channel of the lock is
+        subscribed on the first wait, which returns right away, as the lock could have been released before
+        the subscription.
+
+        :param key: Lock key
+        :type key: str
+        :param timeout: Timeout in seconds
+        :type timeout: float
+        """
+        queue = self.queue(key)
+        if not queue.subscribed:
+            queue.subscribed = self.subscribe(key)
+            if queue.subscribed:
+                return
+        queue.notification = Future()
+        yield from wait_future(queue.notification, min(timeout, self.check_period), self._ioloop)
+        queue.notification = None
+
+    def wait_turn(self, key, timeout):
+        """
+        Wait for local turn to contend for the lock
+
+        :param key: Lock key
+        :type key: str
+        :param timeout: Timeout in seconds
+        :type timeout: float
+        :return: True if it's the turn of the waiter, False if timeout expired
+        :rtype: bool
+        """
+        queue = self.queue(key)
+        if not queue.busy:
+            queue.busy = True
+            return True
+        turn = Future()
+        queue.waiters.append(turn)
+        if (yield from wait_future(turn, timeout, self._ioloop)):
+            return True
+        queue.waiters.remove(turn)
+        return False
+
+    def pass_turn(self, key):
+        """
+        Pass the turn to contend for the lock to the next local waiter
+
+        :param key: Lock key
+        :type key: str
+        """
+        queue = self._queues.get(key)
+        if queue is None:
+            return
+        if queue.waiters:
+            queue.waiters.popleft().set_result(True)
+        else:
+            del self._queues[key]
+            if queue.subscribed:
+                self.unsubscribe(key)
+
+
 class RedisLock(object):
     _key_prefix = 'lock'
     validity_time = 60  # seconds
 
-    def __init__(self, redis, key, ioloop=None, *args, **kwargs):
+    def __init__(self, redis, key, ioloop=None, notifier=None, *args, **kwargs):
+        """
+        :param redis: Redis client
+        :type redis: StrictRedis
+        :param key: Lock key
+        :type key: str
+        :param ioloop: IOLoop
+        :type ioloop: IOLoop
+        :param notifier: Lock notifier. If it is set, waiters are woken up by lock release notifications,
+            otherwise the lock is polled
+        :type notifier: LockNotifier
+        """
         self._ioloop = ioloop or IOLoop.instance()
         self._redis = redis
+        self._notifier = notifier
         self._acquire_time = None
         self._lock_value = None
         self._key = key
@@ -27,9 +249,32 @@ class RedisLock(object):
     def key(self):
         return '{}:{}'.format(self._key_prefix, self._key)
 
-    def acquire(self, blocking=True, timeout=10, check_period=0.005):
+    @property
+    def value(self):
+        return self._lock_value
+
+    @property
+    def notifier(self):
+        return self._notifier
+
+    @property
+    def acquired(self):
+        return self._lock_value is not None
+
+    def acquire(self, blocking=True, timeout=10, check_period=0.005, attempt=None):
+        """
+        Acquire the lock
+
+        :param attempt: Function to try to set the lock instead of plain SET NX, so that other commands could be
+            run along with it. It's called with lock key and value, and returns a falsy value or a future of it,
+            if the lock is taken.
+        :return: Result of the successful attempt, False if the lock is taken and blocking is False
+        """
         if self._lock_value is not None:
             raise LockError("Lock already acquired")
+        attempt = attempt or self._set_lock
+        if self._notifier is not None:
+            return (yield from self._acquire_notified(blocking, timeout, attempt))
 
         key = self.key
         value = self._lock_value = uuid4().hex
@@ -38,27 +283,86 @@ class RedisLock(object):
         start = self._ioloop.time()
         while not result:
             now = self._ioloop.time()
-            result = self._redis.set(key, value, nx=True,
-                                     ex=self.validity_time)
+            result = yield maybe_future(attempt(key, value))
             if result:
                 self._acquire_time = now
                 self._lock_value = value
-                return True
+                return result
             if not blocking:
+                self._lock_value = None
                 return False
             if now - start >= timeout:
+                self._lock_value = None
                 raise LockError('Timeout expired')
             yield from sleep(check_period, self._ioloop)
 
+    def _acquire_notified(self, blocking, timeout, attempt):
+        key = self.key
+        notifier = self._notifier
+        value = self._lock_value = uuid4().hex
+        start = self._ioloop.time()
+
+        if not blocking and notifier.queue(key).busy:
+            self._lock_value = None
+            return False
+        if not (yield from notifier.wait_turn(key, timeout)):
+            self._lock_value = None
+            raise LockError('Timeout expired')
+
+        try:
+            while True:
+                now = self._ioloop.time()
+                result = yield maybe_future(attempt(key, value))
+                if result:
+                    self._acquire_time = now
+                    return result
+                if not blocking:
+                    break
+                if now - start >= timeout:
+                    raise LockError('Timeout expired')
+                yield from notifier.wait_notification(key, timeout - (now - start))
+        except BaseException:
+            self._lock_value = None
+            notifier.pass_turn(key)
+            raise
+        self._lock_value = None
+        notifier.pass_turn(key)
+        return False
+
+    def _set_lock(self, key, value):
+        """
+        Try to set the lock key
+
+        :return: True if the lock is acquired or a future of it
+        """
+        return self._redis.set(key, value, nx=True, ex=self.validity_time)
+
     def check_validity_time(self):
         if self._ioloop.time() - self._acquire_time >= self.validity_time:
             raise LockError("Validity time expired")
 
+    def released(self):
+        """
+        Mark the lock as released by a script, that has deleted the lock key along with other commands
+        """
+        self._acquire_time = None
+        self._lock_value = None
+        if self._notifier is not None:
+            self._notifier.pass_turn(self.key)
+
     def release(self):
         lock_value = self._lock_value
         self._acquire_time = None
         self._lock_value = None
-        result = self._redis.release_lock_script(keys=[self.key, lock_value])
+        notifier = self._notifier
+        if notifier is None:
+            result = self._redis.release_lock_script(keys=[self.key, lock_value])
+        else:
+            try:
+                result = self._redis.release_notify_lock_script(
+                    keys=[self.key, notifier.channel(self.key)], args=[lock_value, notifier.token])
+            finally:
+                notifier.pass_turn(self.key)
         if not result:
             raise LockError('Try to release unlocked lock')
 
@@ -73,10 +377,20 @@ class LockRedisMixin(object):
         end
     """
 
+    RELEASE_NOTIFY_LOCK_SCRIPT = """
+        if redis.call("GET", KEYS[1]) == ARGV[1]
+        then
+            redis.call("PUBLISH", KEYS[2], ARGV[2])
+            return redis.call("DEL", KEYS[1])
+        else
+            return 0
+        end
+    """
+
     release_lock_script = None
+    release_notify_lock_script = None
 
     def init_lock_script(self):
         reg = self.register_script
         self.release_lock_script = reg(self.RELEASE_LOCK_SCRIPT)
-
-
+        self.release_notify_lock_script = reg(self.RELEASE_NOTIFY_LOCK_SCRIPT)
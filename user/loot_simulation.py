@@ -0,0 +1,206 @@
+from engine.user.user_stash import StashValue
+
+__author__ = 'kollad'
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('numpy is required for loot simulation')
+    return numpy
+
+
+class LootStats(object):
+    """
+    Distribution of one stash key over simulated rolls
+    """
+    __slots__ = ('rolls', 'sum', 'sum_squares', 'min', 'max', 'counts')
+
+    def __init__(self):
+        self.rolls = 0
+        self.sum = 0
+        self.sum_squares = 0
+        self.min = None
+        self.max = None
+        # rolls by rolled value
+        self.counts = {}
+
+    def add(self, values):
+        numpy = _numpy()
+        self.rolls += len(values)
+        self.sum += float(values.sum(dtype=numpy.float64))
+        self.sum_squares += float(numpy.square(values, dtype=numpy.float64).sum())
+        low, high = values.min().item(), values.max().item()
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        rolled, counts = numpy.unique(values, return_counts=True)
+        for value, count in zip(rolled.tolist(), counts.tolist()):
+            self.counts[value] = self.counts.get(value, 0) + count
+
+    @property
+    def mean(self):
+        return self.sum / max(self.rolls, 1)
+
+    @property
+    def variance(self):
+        return max(self.sum_squares / max(self.rolls, 1) - self.mean ** 2, 0)
+
+    @property
+    def std(self):
+        return self.variance ** 0.5
+
+    @property
+    def hit_rate(self):
+        """
+        :return: Share of rolls, that gave something
+        :rtype: float
+        """
+        return 1 - self.counts.get(0, 0) / max(self.rolls, 1)
+
+    def distribution(self):
+        """
+        :return: Probability by rolled value
+        :rtype: dict
+        """
+        return dict((value, count / self.rolls) for value, count in sorted(self.counts.items()))
+
+    def dump(self):
+        return {
+            'rolls': self.rolls,
+            'mean': self.mean,
+            'std': self.std,
+            'min': self.min,
+            'max': self.max,
+            'hit_rate': self.hit_rate,
+            'distribution': self.distribution(),
+        }
+
+
+class LootSimulator(object):
+    """
+    Rolls a stash many times at once with numpy, for loot balance sweeps and load test data.
+
+    Stash values are compiled into arrays by the same groups, that Stash.roll uses: plain and ranged values with
+    a probability, weighted values (exactly one of them is given, chosen by their probabilities) and sampled values
+    (given number of them is chosen uniformly). A simulated roll is a roll of a fresh Stash: weighted values of a
+    stash, that is rolled again, lose a percent of probability, which is not simulated.
+    """
+    batch_size = 100000
+
+    def __init__(self, loot, seed=None):
+        """
+        :param loot: Stash values by key, like the ones Stash is created with
+        :type loot: dict
+        :param seed: Seed of numpy random generator
+        :type seed: int
+        """
+        numpy = self.numpy = _numpy()
+        self.rng = numpy.random.default_rng(seed)
+        self.keys = list(loot)
+        values = [(key, StashValue(value, random=None)) for key, value in loot.items()]
+
+        rolled, weighted, sampled = [], [], []
+        self.sample_count = 0
+        for key, value in values:
+            if value.plain:
+                rolled.append((key, value))
+            elif value.sampled:
+                sampled.append((key, value))
+                self.sample_count = value.sampled
+            elif value.probability and value.weighted:
+                weighted.append((key, value))
+            else:
+                rolled.append((key, value))
+
+        self.plain = [(key, value.value) for key, value in rolled if value.plain]
+        self.rolled = self._compile([(key, value) for key, value in rolled if not value.plain])
+        self.weighted = self._compile(weighted)
+        self.sampled = self._compile(sampled)
+        # Stash.roll gives nothing for a single sampled value
+        self.sampled_keys = [key for key, _ in sampled] if len(sampled) > 1 and self.sample_count else []
+
+    def _compile(self, values):
+        numpy = self.numpy
+        return {
+            'keys': [key for key, _ in values],
+            'min': numpy.array([value.min for _, value in values], dtype=numpy.int64),
+            'max': numpy.array([value.max for _, value in values], dtype=numpy.int64),
+            'probability': numpy.array([value.probability for _, value in values], dtype=numpy.float64),
+        }
+
+    def _range(self, compiled, rolls):
+        """
+        :return: Values rolled between min and max, rolls by keys
+        """
+        low = compiled['min']
+        # like StashValue.roll, min is given if max is not greater
+        high = self.numpy.maximum(compiled['max'], low)
+        return self.rng.integers(low, high + 1, size=(rolls, len(low)))
+
+    def _chance(self, compiled, rolls):
+        return self.rng.random((rolls, len(compiled['keys']))) < compiled['probability']
+
+    def roll(self, rolls):
+        """
+        Roll the stash
+
+        :param rolls: Rolls count
+        :type rolls: int
+        :return: Rolled values by key, arrays of rolls size
+        :rtype: dict
+        """
+        numpy = self.numpy
+        result = {}
+        for key, value in self.plain:
+            result[key] = numpy.full(rolls, value)
+
+        rolled = self.rolled
+        if rolled['keys']:
+            values = self._range(rolled, rolls) * self._chance(rolled, rolls)
+            for index, key in enumerate(rolled['keys']):
+                result[key] = values[:, index]
+
+        weighted = self.weighted
+        if weighted['keys']:
+            values = self._range(weighted, rolls)
+            if len(weighted['keys']) > 1:
+                heights = numpy.cumsum(weighted['probability'])
+                chosen = numpy.searchsorted(heights, self.rng.random(rolls) * heights[-1], side='right')
+                chosen = numpy.minimum(chosen, len(heights) - 1)
+                values = values * (numpy.arange(len(heights)) == chosen[:, None])
+            for index, key in enumerate(weighted['keys']):
+                result[key] = values[:, index]
+
+        sampled = self.sampled
+        if self.sampled_keys:
+            count = min(self.sample_count, len(self.sampled_keys))
+            # ranks of uniform random numbers give a uniformly random subset of keys
+            ranks = self.rng.random((rolls, len(self.sampled_keys))).argsort(axis=1).argsort(axis=1)
+            values = self._range(sampled, rolls) * self._chance(sampled, rolls) * (ranks < count)
+            for index, key in enumerate(self.sampled_keys):
+                result[key] = values[:, index]
+        return result
+
+    def simulate(self, rolls):
+        """
+        Roll the stash in batches and collect distributions of its keys
+
+        :param rolls: Rolls count
+        :type rolls: int
+        :return: Distributions by key
+        :rtype: dict
+        """
+        stats = dict((key, LootStats()) for key in self.keys)
+        remaining = rolls
+        while remaining > 0:
+            batch = min(remaining, self.batch_size)
+            values = self.roll(batch)
+            for key, key_stats in stats.items():
+                try:
+                    key_values = values[key]
+                except KeyError:
+                    key_values = self.numpy.zeros(batch, dtype=self.numpy.int64)
+                key_stats.add(key_values)
+            remaining -= batch
+        return stats
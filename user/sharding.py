@@ -0,0 +1,170 @@
+from bisect import bisect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from logging import getLogger
+from queue import Queue
+
+from engine.user.lock import RedisLock
+
+__author__ = 'kollad'
+
+
+log = getLogger('process')
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of redis nodes. Every node is placed on the ring many times, a key belongs to the first
+    node point clockwise from the key's hash. When a node is added, only keys between its points and the previous
+    ones move to it, i.e. about 1/N of all keys.
+    """
+    replicas = 160
+
+    def __init__(self, nodes, replicas=None):
+        """
+        :param nodes: Node names, the names, not the addresses, define the key distribution
+        :type nodes: list
+        :param replicas: Points per node
+        :type replicas: int
+        """
+        if not nodes:
+            raise ValueError('Hash ring needs at least one node')
+        self.nodes = list(nodes)
+        replicas = replicas or self.replicas
+        points = sorted((self.hash('{}#{}'.format(node, replica)), node)
+                        for node in self.nodes for replica in range(replicas))
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    @staticmethod
+    def hash(key):
+        return int(md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+    def node(self, key):
+        """
+        :param key: Key, e.g. user ID
+        :type key: str
+        :return: Name of the node the key belongs to
+        :rtype: str
+        """
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        index = bisect(self._points, self.hash(key))
+        return self._owners[index % len(self._owners)]
+
+
+def redis_nodes(settings):
+    """
+    Redis nodes of the user manager. Users are sharded across the nodes listed in shards, if there are any,
+    otherwise the single node of the redis settings is used. Missing node settings are taken from the redis settings.
+
+    :param settings: Redis settings of the user manager
+    :type settings: dict
+    :return: Node settings by node name
+    :rtype: OrderedDict
+    """
+    nodes = OrderedDict()
+    for shard in settings.get('shards') or [settings]:
+        node = dict((key, shard.get(key, settings.get(key))) for key in ('host', 'port', 'db', 'password'))
+        name = shard.get('name') or '{host}:{port}/{db}'.format(**node)
+        if name in nodes:
+            raise ValueError('Redis node {} is listed twice'.format(name))
+        nodes[name] = node
+    return nodes
+
+
+def fan_out(functions):
+    """
+    Run generator functions in parallel threads and yield their items as they come
+
+    :param functions: Functions without arguments, that return generators
+    :type functions: list
+    :return: Generator of items
+    """
+    done = object()
+    items = Queue()
+
+    def run(function):
+        try:
+            for item in function():
+                items.put(item)
+        finally:
+            items.put(done)
+
+    with ThreadPoolExecutor(len(functions)) as executor:
+        futures = [executor.submit(run, function) for function in functions]
+        remaining = len(functions)
+        while remaining:
+            item = items.get()
+            if item is done:
+                remaining -= 1
+            else:
+                yield item
+    for future in futures:
+        future.result()
+
+
+def rebalance_users(user_manager, sources=(), batch_size=None, timeout=10000):
+    """
+    Move users to the nodes they belong to according to the current hash ring, e.g. after a node is added to
+    the user manager settings. Users are moved with MIGRATE along with their version, modified fields and commands
+    log, and keep their modified, flushing and online marks.
+
+    Run it while game servers are stopped: a user moved in the middle of a request would be loaded from mongo
+    on its new node. Users that are locked anyway are skipped and should be moved by another run.
+
+    :param user_manager: User manager with the new node list
+    :type user_manager: UserManager
+    :param sources: Redis clients of removed nodes to move all users from
+    :type sources: list
+    :param batch_size: SCAN count hint
+    :type batch_size: int
+    :param timeout: MIGRATE timeout in milliseconds
+    :type timeout: int
+    :return: Moved and skipped users count
+    :rtype: tuple
+    """
+    moved = skipped = 0
+    nodes = user_manager.redis_nodes
+    sources = [(name, shard) for name, shard in user_manager.shards.items()] + [(None, source) for source in sources]
+    for source_name, source in sources:
+        for _, keys in user_manager.scan_user_keys(batch_size=batch_size, shard=source):
+            for key in keys:
+                user_id = user_manager.decode_user_id(key)
+                target_name = user_manager.shard_name(user_id)
+                if target_name == source_name:
+                    continue
+                if source.exists('{}:{}'.format(RedisLock._key_prefix, user_id)):
+                    log.warning('User {} is locked and is not moved'.format(user_id))
+                    skipped += 1
+                    continue
+                _move_user(user_manager, user_id, source, user_manager.shards[target_name], nodes[target_name],
+                           timeout)
+                moved += 1
+    return moved, skipped
+
+
+def _move_user(user_manager, user_id, source, target, target_node, timeout):
+    user_key = user_manager.user_key(user_id)
+    pipe = source.pipeline(transaction=True)
+    pipe.sismember(user_manager._modified_users_key, user_key)
+    pipe.sismember(user_manager._flushing_users_key, user_key)
+    pipe.zscore(user_manager._online_users_key, user_key)
+    modified, flushing, online = pipe.execute()
+    keys = [user_key, user_manager.version_key(user_id), user_manager.fields_key(user_id),
+            user_manager.log_key(user_id)]
+    source.migrate(target_node['host'], target_node['port'], keys, target_node['db'], timeout, replace=True,
+                   auth=target_node['password'] or None)
+    pipe = target.pipeline(transaction=True)
+    if modified or flushing:
+        # a flushing user is not acknowledged on the old node, so it should be dumped again
+        pipe.sadd(user_manager._modified_users_key, user_key)
+    if online is not None:
+        pipe.zadd(user_manager._online_users_key, {user_key: online})
+    pipe.execute()
+    pipe = source.pipeline(transaction=True)
+    pipe.srem(user_manager._modified_users_key, user_key)
+    pipe.srem(user_manager._flushing_users_key, user_key)
+    pipe.zrem(user_manager._online_users_key, user_key)
+    pipe.execute()
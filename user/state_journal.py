@@ -0,0 +1,321 @@
+from collections import MutableMapping, MutableSequence, MutableSet
+
+from engine.utils.dictutils import dump_value
+
+__author__ = 'kollad'
+
+
+_missing = object()
+_snapshot = object()
+
+
+class StateJournal(object):
+    """
+    Undo journal of user state changes. Containers of the state are accessed through tracking wrappers, which
+    record the previous value of every assigned or deleted dict key, and a shallow copy of a list or a set before
+    its first change. So changes are made in place, and both keeping and rolling them back cost as much as the
+    changes themselves, not as the whole state.
+
+    Paths of changed values are collected as well: tuples of dict keys from the top of the state. Changes inside
+    a list are recorded as changes of the whole list.
+    """
+    __slots__ = ('entries', 'paths', 'changed_paths', '_snapshots')
+
+    def __init__(self):
+        # undo entries and changed paths of the open savepoint
+        self.entries = []
+        self.paths = set()
+        # changed paths of the committed savepoints
+        self.changed_paths = set()
+        self._snapshots = set()
+
+    def wrap(self, value, path):
+        """
+        :param value: Value of the state
+        :param path: Path of the value
+        :type path: tuple
+        :return: Tracking wrapper for containers, the value itself otherwise
+        """
+        if isinstance(value, dict):
+            return TrackedDict(value, path, self)
+        if isinstance(value, list):
+            return TrackedList(value, path, self)
+        if isinstance(value, set):
+            return TrackedSet(value, path, self)
+        return value
+
+    def record_key(self, container, key, path):
+        """
+        Record the value of a dict key before it's assigned or deleted
+        """
+        self.entries.append((container, key, container.get(key, _missing)))
+        self.paths.add(path + (key,))
+
+    def record_snapshot(self, container, path):
+        """
+        Record a copy of a list or a set before its first change within the savepoint
+        """
+        if id(container) in self._snapshots:
+            return
+        self._snapshots.add(id(container))
+        self.entries.append((container, _snapshot, container.copy()))
+        self.paths.add(path)
+
+    def commit(self):
+        """
+        Keep the changes of the savepoint and start a new one
+        """
+        self.changed_paths |= self.paths
+        self._reset()
+
+    def rollback(self):
+        """
+        Undo the changes of the savepoint and start a new one
+        """
+        for container, key, value in reversed(self.entries):
+            if key is _snapshot:
+                if isinstance(container, list):
+                    container[:] = value
+                else:
+                    container.clear()
+                    container |= value
+            elif value is _missing:
+                container.pop(key, None)
+            else:
+                container[key] = value
+        self._reset()
+
+    def _reset(self):
+        self.entries = []
+        self.paths = set()
+        self._snapshots = set()
+
+
+def raw(value):
+    """
+    :return: Wrapped value or the value itself
+    """
+    if isinstance(value, Tracked):
+        return value._data
+    return value
+
+
+def unwrap(value):
+    """
+    Prepare value to be put into the state: take it out of a tracking wrapper and replace wrappers, that could
+    have been put into it, with their values
+
+    :return: Value without tracking wrappers
+    """
+    if isinstance(value, Tracked):
+        return value._data
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, (Tracked, dict, list)):
+                unwrapped = unwrap(item)
+                if unwrapped is not item:
+                    value[key] = unwrapped
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            if isinstance(item, (Tracked, dict, list)):
+                unwrapped = unwrap(item)
+                if unwrapped is not item:
+                    value[index] = unwrapped
+    return value
+
+
+class Tracked(object):
+    __slots__ = ('_data', '_path', '_journal')
+
+    def __init__(self, data, path, journal):
+        self._data = data
+        self._path = path
+        self._journal = journal
+
+    @property
+    def data(self):
+        return self._data
+
+    def dump(self):
+        return dump_value(self._data)
+
+    def __eq__(self, other):
+        return self._data == raw(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._data)
+
+
+class TrackedDict(Tracked, MutableMapping):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return self._journal.wrap(self._data[key], self._path + (key,))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._journal.record_key(self._data, key, self._path)
+        self._data[key] = unwrap(value)
+
+    def __delitem__(self, key):
+        if key not in self._data:
+            raise KeyError(key)
+        self._journal.record_key(self._data, key, self._path)
+        del self._data[key]
+
+    def setdefault(self, key, default=None):
+        if key not in self._data:
+            self[key] = default
+        return self[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        wrap = self._journal.wrap
+        path = self._path
+        return [(key, wrap(value, path + (key,))) for key, value in self._data.items()]
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def copy(self):
+        return dict(self.items())
+
+
+class TrackedList(Tracked, MutableSequence):
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._journal.wrap(value, self._path) for value in self._data[index]]
+        return self._journal.wrap(self._data[index], self._path)
+
+    def __setitem__(self, index, value):
+        self._journal.record_snapshot(self._data, self._path)
+        if isinstance(index, slice):
+            value = [unwrap(item) for item in value]
+        else:
+            value = unwrap(value)
+        self._data[index] = value
+
+    def __delitem__(self, index):
+        self._journal.record_snapshot(self._data, self._path)
+        del self._data[index]
+
+    def insert(self, index, value):
+        self._journal.record_snapshot(self._data, self._path)
+        self._data.insert(index, unwrap(value))
+
+    def append(self, value):
+        self._journal.record_snapshot(self._data, self._path)
+        self._data.append(unwrap(value))
+
+    def extend(self, values):
+        self._journal.record_snapshot(self._data, self._path)
+        self._data.extend(unwrap(value) for value in values)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __add__(self, other):
+        return self._data + list(raw(other))
+
+    def pop(self, index=-1):
+        self._journal.record_snapshot(self._data, self._path)
+        return self._data.pop(index)
+
+    def remove(self, value):
+        self._journal.record_snapshot(self._data, self._path)
+        self._data.remove(raw(value))
+
+    def clear(self):
+        self._journal.record_snapshot(self._data, self._path)
+        self._data.clear()
+
+    def sort(self, *args, **kwargs):
+        self._journal.record_snapshot(self._data, self._path)
+        self._data.sort(*args, **kwargs)
+
+    def reverse(self):
+        self._journal.record_snapshot(self._data, self._path)
+        self._data.reverse()
+
+    def __contains__(self, value):
+        return raw(value) in self._data
+
+    def __iter__(self):
+        wrap = self._journal.wrap
+        path = self._path
+        for value in self._data:
+            yield wrap(value, path)
+
+    def __len__(self):
+        return len(self._data)
+
+    def index(self, value, *args):
+        return self._data.index(raw(value), *args)
+
+    def count(self, value):
+        return self._data.count(raw(value))
+
+    def copy(self):
+        return list(self)
+
+
+class TrackedSet(Tracked, MutableSet):
+    __slots__ = ()
+
+    @classmethod
+    def _from_iterable(cls, values):
+        return set(values)
+
+    def add(self, value):
+        if value not in self._data:
+            self._journal.record_snapshot(self._data, self._path)
+            self._data.add(value)
+
+    def discard(self, value):
+        if value in self._data:
+            self._journal.record_snapshot(self._data, self._path)
+            self._data.discard(value)
+
+    def update(self, *values):
+        self._journal.record_snapshot(self._data, self._path)
+        self._data.update(*values)
+
+    def clear(self):
+        self._journal.record_snapshot(self._data, self._path)
+        self._data.clear()
+
+    def __contains__(self, value):
+        return value in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def copy(self):
+        return self._data.copy()
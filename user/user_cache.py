@@ -0,0 +1,163 @@
+from collections import OrderedDict
+
+__author__ = 'kollad'
+
+
+class UserStateCache(object):
+    """
+    Per-process LRU cache of decoded user states. Every entry is stamped with the version it was saved or loaded
+    with, so a stale entry is never returned once another process has saved the user.
+    """
+
+    def __init__(self, size=1000, max_bytes=None):
+        """
+        :param size: Maximum entries count
+        :type size: int
+        :param max_bytes: Maximum total size of the encoded states, unlimited if None
+        :type max_bytes: int
+        """
+        self.size = size
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        # encoded sizes of the states taken by transactions, until they are saved or discarded
+        self._taken = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def version(self, user_id):
+        """
+        :param user_id: User ID
+        :type user_id: str
+        :return: Version of the cached state or None if the user is not cached
+        """
+        try:
+            return self._entries[user_id][0]
+        except KeyError:
+            return None
+
+    def entry_size(self, user_id):
+        """
+        :param user_id: User ID
+        :type user_id: str
+        :return: Encoded size of the cached state or 0 if the user is not cached
+        :rtype: int
+        """
+        try:
+            return self._entries[user_id][2]
+        except KeyError:
+            return self._taken.get(user_id, 0)
+
+    def get(self, user_id, version):
+        """
+        Get cached state if it has the same version
+
+        :param user_id: User ID
+        :type user_id: str
+        :param version: Current state version
+        :type version: str
+        :return: Decoded user state or None
+        :rtype: dict
+        """
+        try:
+            entry = self._entries[user_id]
+        except KeyError:
+            self.misses += 1
+            return None
+        if version is None or entry[0] != version:
+            self.discard(user_id)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def take(self, user_id, version):
+        """
+        Get cached state if it has the same version and remove it from the cache, so the state can be modified
+        by a transaction without other callers seeing uncommitted changes
+
+        :param user_id: User ID
+        :type user_id: str
+        :param version: Current state version
+        :type version: str
+        :return: Decoded user state or None
+        :rtype: dict
+        """
+        data = self.get(user_id, version)
+        if data is not None:
+            self.taken(user_id, self._entries[user_id][2])
+        return data
+
+    def taken(self, user_id, size):
+        """
+        Remove the user from the cache, while its state is modified by a transaction. The size is kept to account
+        the state when it's saved partially.
+
+        :param user_id: User ID
+        :type user_id: str
+        :param size: Encoded state size in bytes
+        :type size: int
+        """
+        self.discard(user_id)
+        self._taken[user_id] = size
+
+    def put(self, user_id, version, data, size=0):
+        """
+        Cache user state
+
+        :param user_id: User ID
+        :type user_id: str
+        :param version: State version
+        :type version: str
+        :param data: Decoded user state
+        :type data: dict
+        :param size: Encoded state size in bytes
+        :type size: int
+        """
+        self.discard(user_id)
+        if version is None:
+            return
+        self._entries[user_id] = (version, data, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.size or
+                                 (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def discard(self, user_id):
+        self._taken.pop(user_id, None)
+        try:
+            _, _, size = self._entries.pop(user_id)
+        except KeyError:
+            return
+        self._bytes -= size
+
+    def clear(self):
+        self._entries.clear()
+        self._taken.clear()
+        self._bytes = 0
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __repr__(self):
+        return '<UserStateCache: {}>'.format(self.stats())
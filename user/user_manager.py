@@ -1,30 +1,32 @@
-import contextlib
+from collections import deque, OrderedDict
+from itertools import count
 import json
 from random import Random
+from uuid import uuid4
 from copy import deepcopy
+from functools import partial
 from logging import getLogger
+from time import perf_counter
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 from redis import StrictRedis
+from tornado.concurrent import Future
+from tornado.gen import maybe_future
 
-from engine.common.serializers import data_to_json, json_to_data
 from engine.utils.dictutils import dump_value
-from engine.utils.timeutils import milliseconds
+from engine.utils.timeutils import milliseconds, seconds
+from engine.user.codecs import get_codec, decode_data
+from engine.user.user_cache import UserStateCache
 from engine.user.user_state import UserState
-from engine.user.lock import RedisLock, LockRedisMixin
+from engine.user.lock import RedisLock, LockRedisMixin, LockNotifier, LockError
+from engine.user.sharding import HashRing, redis_nodes, fan_out
+from engine.utils.asyncutils import wait_future
 
 
 __author__ = 'kollad'
 
 
-def encoder_function(data):
-    return data_to_json(data)
-
-
-def decoder_function(data):
-    return json_to_data(data)
-
-
 def key_maker(key_prefix):
     def make_key(ident):
         prefix = key_prefix + ":"
@@ -37,9 +39,184 @@ def key_maker(key_prefix):
 log = getLogger('process')
 
 
+class TransactionAborted(Exception):
+    pass
+
+
+class UserTransaction(object):
+    """
+    User state transaction context manager. State is saved on exit, unless an exception is raised,
+    and the lock is released anyway.
+
+    Transactions of one user within a process are coalesced: requests that come while a transaction is open
+    join it and use the already loaded state under the same lock, one by one in arrival order. The state is saved
+    once, when the last of them exits.
+
+    If the state is journaled (see UserState.begin), changes of a failed request are rolled back and the rest of
+    the requests go on. Otherwise, if any of them fails, the state is not saved: requests that have already
+    exited get TransactionAborted on wait, the queued ones start over with a fresh state.
+
+    Usage::
+
+        transaction = yield from user_manager.transaction(user_id)
+        with transaction as writable_state:
+            ...
+        yield from transaction.wait()
+    """
+    join_timeout = 10  # seconds
+
+    def __init__(self, user_manager, user_id):
+        """
+        :param user_manager: User manager
+        :type user_manager: UserManager
+        :param user_id: User ID
+        :type user_id: str
+        """
+        self.user_manager = user_manager
+        self.user_id = user_id
+        self.writable_state = None
+        self.lock = None
+        self.committed = Future()
+        self.requests_count = 1
+        self._queue = deque()
+        # requests that have finished with the state and wait for the commit
+        self._waiting = 0
+
+    def open(self):
+        """
+        Acquire user lock and load user state
+        """
+        user_manager = self.user_manager
+        lock = user_manager.get_lock(self.user_id)
+        _, data = yield from lock.acquire(attempt=partial(user_manager.acquire_and_load, self.user_id))
+        try:
+            if data is None:
+                data = yield maybe_future(user_manager.fetch_or_create(self.user_id))
+            self.writable_state = user_manager.make_user_state(data)
+            if user_manager.state_journal:
+                self.writable_state.begin()
+        except Exception:
+            self.discard()
+            yield maybe_future(lock.release())
+            raise
+        self.lock = lock
+
+    def join(self):
+        """
+        Wait for the turn of a request to use the state
+
+        :return: False if transaction was aborted and the request should start over
+        :rtype: bool
+        """
+        turn = Future()
+        self._queue.append(turn)
+        self.requests_count += 1
+        if not (yield from wait_future(turn, self.join_timeout)):
+            if not turn.done():
+                self._queue.remove(turn)
+                raise LockError('Timeout expired')
+        return turn.result()
+
+    def __enter__(self):
+        return self.writable_state
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        state = self.writable_state
+        if exc_type is not None:
+            # the whole state could have been changed bypassing the journal
+            if not state.journaled or state.touched_keys is None:
+                self.abort()
+                return
+            state.rollback()
+        elif state.journaled:
+            state.commit()
+        if self._queue:
+            if exc_type is None:
+                self._waiting += 1
+            self._queue.popleft().set_result(True)
+            return
+        self.close()
+        if exc_type is None:
+            self.commit()
+        elif self._waiting:
+            # the state has changes of the previous requests, saving errors are passed to them
+            try:
+                self.commit()
+            except Exception:
+                pass
+        else:
+            self.discard()
+            self.release()
+
+    def close(self):
+        """
+        Stop accepting new requests
+        """
+        if self.user_manager._transactions.get(self.user_id) is self:
+            del self.user_manager._transactions[self.user_id]
+
+    def abort(self):
+        """
+        Drop modified state without saving and release the lock
+        """
+        self.close()
+        self.discard()
+        while self._queue:
+            self._queue.popleft().set_result(False)
+        if self._waiting:
+            self.committed.set_exception(TransactionAborted(
+                'Transaction of user {} is aborted by a failed request'.format(self.user_id)))
+        if self.lock is not None:
+            self.release()
+
+    def commit(self):
+        """
+        Save user state and release the lock
+        """
+        try:
+            self.lock.check_validity_time()
+            self.user_manager.commit(self.user_id, self.writable_state, self.lock)
+        except Exception as e:
+            self.discard()
+            if self._waiting:
+                self.committed.set_exception(e)
+            raise
+        else:
+            self.committed.set_result(True)
+        finally:
+            if self.lock.acquired:
+                self.release()
+
+    def release(self):
+        self.lock.release()
+
+    def discard(self):
+        # the state is taken out of the cache while the transaction is open and might be partially modified,
+        # so it's not cached until it's loaded again
+        if self.user_manager.cache is not None:
+            self.user_manager.cache.discard(self.user_id)
+
+    def wait(self):
+        """
+        Wait until the transaction is committed
+
+        :raises: TransactionAborted if another request of the transaction has failed, saving errors
+        """
+        return (yield self.committed)
+
+
 class UserManager(object):
     _key_prefix = 'user'
     _log_key_prefix = 'user-log'
+    _version_key_prefix = 'version'
+    _fields_key_prefix = 'fields'
+    _all_fields = '*'
+    _modified_users_key = 'modified_users'
+    _flushing_users_key = 'modified_users:flushing'
+    _online_users_key = 'online_users'
+    default_dump_batch_size = 1000
+    default_scan_batch_size = 1000
+    transaction_class = UserTransaction
 
 
     def __init__(self, settings):
@@ -52,26 +229,77 @@ class UserManager(object):
         """
         self.settings = settings
         self.redis = None
+        self.shards = None
+        self.ring = None
         self.mongo = None
         self.random = Random()
+        self.cache = None
+        self.lock_notifiers = {}
+        self.hash_storage = settings['user_manager'].get('storage', 'blob') == 'hash'
+        # journal changes of user states within transactions, so a failed request can be rolled back alone
+        self.state_journal = settings['user_manager'].get('journal', False)
+        self.codec = get_codec(settings['user_manager'].get('codec', 'json'))
+        self._mongo_index_ensured = False
+        self._version_prefix = uuid4().hex[:12]
+        self._versions = count()
+        self._transactions = {}
 
         self.init_redis()
         self.init_mongo()
+        self.init_cache()
+        self.init_lock_notifier()
 
 
     def init_redis(self):
         """
-        Initialize redis client
+        Initialize redis clients, one per node. Users are sharded across the nodes by user ID with consistent
+        hashing, the first node is the default one.
 
         :return:
         """
-        settings = self.settings['user_manager']['redis']
-        host = settings['host']
-        port = settings['port']
-        password = settings['password']
-        db = settings['db']
-        self.redis = UserRedis(host, port, db, password)
-        self.redis.init_scripts()
+        self.shards = OrderedDict()
+        for name, node in self.redis_nodes.items():
+            shard = self.shards[name] = UserRedis(node['host'], node['port'], node['db'], node['password'])
+            shard.init_scripts()
+        self.ring = HashRing(list(self.shards))
+        self.redis = next(iter(self.shards.values()))
+
+    @property
+    def redis_nodes(self):
+        """
+        :return: Redis node settings by node name
+        :rtype: OrderedDict
+        """
+        return redis_nodes(self.settings['user_manager']['redis'])
+
+    def shard_name(self, user_id):
+        """
+        :param user_id: User ID
+        :type user_id: str
+        :return: Name of the redis node the user is stored on
+        :rtype: str
+        """
+        return self.ring.node(user_id)
+
+    def shard(self, user_id):
+        """
+        :param user_id: User ID
+        :type user_id: str
+        :return: Redis client of the node the user is stored on
+        :rtype: UserRedis
+        """
+        return self.shards[self.ring.node(user_id)]
+
+    def for_each_shard(self, function):
+        """
+        Run a generator function for every redis node, in parallel threads if there are several nodes
+
+        :param function: Generator function, that takes redis client
+        :return: Generator of items of all nodes
+        """
+        if len(self.shards) == 1:
+            return function(self.redis)
+        return fan_out([partial(function, shard) for shard in self.shards.values()])
 
 
     def init_mongo(self):
@@ -87,15 +315,68 @@ class UserManager(object):
         collection = settings['collection']
         self.mongo = MongoClient(host=host, port=port)[db_name][collection]
 
+    def init_cache(self):
+        """
+        Initialize per-process user state cache
+
+        :return:
+        """
+        settings = self.settings['user_manager'].get('cache', {})
+        if settings.get('enable', False):
+            self.cache = UserStateCache(size=settings.get('size', 1000), max_bytes=settings.get('max_bytes'))
+
+    def init_lock_notifier(self):
+        """
+        Initialize lock release notifier, so lock waiters are woken up by notifications instead of polling
+
+        :return:
+        """
+        settings = self.settings['user_manager'].get('lock', {})
+        if settings.get('mode', 'poll') == 'notify':
+            for name, shard in self.shards.items():
+                self.lock_notifiers[name] = LockNotifier(shard, check_period=settings.get('check_period', 0.5),
+                                                         poll_period=settings.get('poll_period', 0.005))
+
+    def ensure_mongo_index(self):
+        """
+        Ensure users collection indexes once per process
+
+        :return:
+        """
+        if not self._mongo_index_ensured:
+            self.mongo.ensure_index('user_id')
+            self._mongo_index_ensured = True
+
 
     def get_lock(self, key):
         """
+        :param key: User ID, the lock is kept on the user's redis node
+        :type key: str
         :return: RedisLock object
         """
-        return RedisLock(self.redis, key)
+        name = self.shard_name(key)
+        return RedisLock(self.shards[name], key, notifier=self.lock_notifiers.get(name))
 
 
     user_key = key_maker(_key_prefix)
+    _version_key = key_maker(_version_key_prefix)
+
+    _fields_key = key_maker(_fields_key_prefix)
+
+    def version_key(self, user_id):
+        return self._version_key(self.user_key(user_id))
+
+    def fields_key(self, user_id):
+        return self._fields_key(self.user_key(user_id))
+
+    def make_version(self):
+        """
+        Make a new state version, unique across all processes
+
+        :return: Version stamp
+        :rtype: str
+        """
+        return '{}.{}'.format(self._version_prefix, next(self._versions))
 
     def decode_user_id(self, user_key):
         """
@@ -121,19 +402,108 @@ class UserManager(object):
         :rtype: UserState
         """
         user_id = str(user_id)
-        user_key = self.user_key(user_id)
+        data = self.load(user_id)
+        if data is None:
+            data = self.fetch_or_create(user_id, auto_create=auto_create)
+        return self.make_user_state(data)
+
+    def make_user_state(self, data):
+        """
+        :param data: Decoded user state
+        :type data: dict
+        :return: User state object or None if there is no data
+        :rtype: UserState
+        """
+        if not data:
+            return None
         if self.settings['user_manager']['fixed_random_seed']:
             random = None
         else:
             random = self.random
-        if self.redis.exists(user_key):
-            data = self.decode_data(self.redis.get(user_key))
-            return UserState(data, random=random)
-        else:
-            data = self.fetch_or_create(user_id, auto_create=auto_create)
-            if data:
-                return UserState(data, random=random)
+        return UserState(data, random=random)
+
+    def load(self, user_id):
+        """
+        Load user state from the process cache or from redis. The cached state is used only if its version is
+        the same as the one stored in redis, otherwise the state is transferred and decoded again.
+
+        Every caller gets its own copy of a cached state, so changes made by a reader, which never saves them,
+        are not seen by the next one. Transactions load the state with acquire_and_load, which takes it out of
+        the cache without copying.
+
+        :param user_id: User ID
+        :type user_id: str
+        :return: Decoded user state or None if user is not in redis
+        :rtype: dict
+        """
+        cache = self.cache
+        cached_version = cache.version(user_id) if cache is not None else None
+        version, stored = self.shard(user_id).load_user_script(
+            keys=[self.user_key(user_id), self.version_key(user_id)],
+            args=[cached_version or ''])
+        return self.loaded(user_id, version, stored)
+
+    def acquire_and_load(self, user_id, lock_key, lock_value, validity_time=RedisLock.validity_time):
+        """
+        Try to acquire user lock and load user state with a single round trip
+
+        :param user_id: User ID
+        :type user_id: str
+        :param lock_key: Lock key
+        :type lock_key: str
+        :param lock_value: Lock value
+        :type lock_value: str
+        :param validity_time: Lock validity time in seconds
+        :type validity_time: int
+        :return: None if the lock is taken, otherwise a tuple of True and decoded user state, which is None
+            if user is not in redis. The state is not shared with other callers until it's saved.
+        :rtype: tuple
+        """
+        cache = self.cache
+        cached_version = cache.version(user_id) if cache is not None else None
+        loaded = self.shard(user_id).acquire_load_user_script(
+            keys=[lock_key, self.user_key(user_id), self.version_key(user_id)],
+            args=[lock_value, validity_time, cached_version or ''])
+        if loaded is None:
             return None
+        return True, self.loaded(user_id, *loaded, exclusive=True)
+
+    def loaded(self, user_id, version, stored, exclusive=False):
+        """
+        Decode user state loaded from redis, or take it from the process cache if it's of the same version
+
+        :param user_id: User ID
+        :type user_id: str
+        :param version: State version in redis
+        :type version: bytes
+        :param stored: Stored state or None if it's not transferred
+        :param exclusive: The state is loaded to be modified, so it's taken out of the cache and is cached again
+            only when it's saved. Otherwise a copy of the cached state is returned, as readers may modify it too.
+        :type exclusive: bool
+        :return: Decoded user state or None if user is not in redis
+        :rtype: dict
+        """
+        cache = self.cache
+        if isinstance(version, bytes):
+            version = version.decode('utf-8')
+        if cache is not None:
+            if exclusive:
+                data = cache.take(user_id, version)
+                if data is not None:
+                    return data
+            else:
+                data = cache.get(user_id, version)
+                if data is not None:
+                    return deepcopy(data)
+        if stored is None:
+            return None
+        data = self.decode_stored(stored)
+        if cache is not None:
+            if exclusive:
+                cache.taken(user_id, self.stored_size(stored))
+            else:
+                cache.put(user_id, version, deepcopy(data), self.stored_size(stored))
+        return data
 
     def create_user_state(self, user_id):
         """
@@ -178,10 +548,15 @@ class UserManager(object):
 
     def delete(self, user_id):
         self.mongo.remove({'_id': user_id})
-        pipe = self.redis.pipeline(transaction=True)
+        pipe = self.shard(user_id).pipeline(transaction=True)
         pipe.delete(self.user_key(user_id))
-        pipe.srem('modified_users', self.user_key(user_id))
+        pipe.delete(self.version_key(user_id))
+        pipe.delete(self.fields_key(user_id))
+        pipe.srem(self._modified_users_key, self.user_key(user_id))
+        pipe.zrem(self._online_users_key, self.user_key(user_id))
         result = pipe.execute()[0]
+        if self.cache is not None:
+            self.cache.discard(user_id)
         return result
 
     def save(self, user_id, data):
@@ -195,14 +570,164 @@ class UserManager(object):
         :return: indicates if player was saved in redis
         :rtype: bool
         """
-        pipe = self.redis.pipeline(transaction=True)
+        pipe = self.shard(user_id).pipeline(transaction=True)
+        user_key = self.user_key(user_id)
         data['user_id'] = user_id
-        # the set command cancels a user's ttl
-        pipe.set(self.user_key(user_id), self.encode_data(data))
-        pipe.sadd('modified_users', self.user_key(user_id))
-        result = pipe.execute()[0]
+        version = self.make_version()
+        if self.hash_storage:
+            stored = self.encode_fields(data)
+            pipe.delete(user_key)
+            pipe.hset(user_key, mapping=stored)
+            pipe.delete(self.fields_key(user_id))
+            pipe.sadd(self.fields_key(user_id), self._all_fields)
+            size = sum(map(len, stored.values()))
+        else:
+            stored = self.encode_data(data)
+            # the set command cancels a user's ttl
+            pipe.set(user_key, stored)
+            size = len(stored)
+        pipe.set(self.version_key(user_id), version)
+        pipe.sadd(self._modified_users_key, user_key)
+        pipe.zadd(self._online_users_key, {user_key: milliseconds()})
+        result = bool(pipe.execute()[int(self.hash_storage)])
+        self._cache_saved(user_id, version, data, size, result)
         return result
 
+    def save_fields(self, user_id, data, fields):
+        """
+        Save only provided top level fields of user data into redis. Fields that are not in the data are removed.
+        Works with hash storage only, the whole data is saved, if user is not stored as a hash yet.
+
+        :param user_id: User ID
+        :type user_id: str
+        :param data: User state
+        :type data: dict
+        :param fields: Modified top level fields
+        :type fields: set
+        :return: indicates if player was saved in redis
+        :rtype: bool
+        """
+        if not self.hash_storage:
+            return self.save(user_id, data)
+        data['user_id'] = user_id
+        version = self.make_version()
+        encoded = self.encode_fields(dict((field, data[field]) for field in fields if field in data))
+        args = [version, milliseconds(), len(encoded)]
+        for field, value in encoded.items():
+            args.extend((field, value))
+        args.extend(field for field in fields if field not in data)
+        result = self.shard(user_id).save_user_fields_script(
+            keys=[self.user_key(user_id), self.version_key(user_id), self._modified_users_key,
+                  self._online_users_key, self.fields_key(user_id)],
+            args=args)
+        if not result:
+            return self.save(user_id, data)
+        size = sum(map(len, encoded.values()))
+        if self.cache is not None:
+            size = max(size, self.cache.entry_size(user_id))
+        self._cache_saved(user_id, version, data, size, result)
+        return result
+
+    def save_and_release(self, user_id, data, lock, fields=None):
+        """
+        Save user data into redis and release user lock with a single round trip. Nothing is saved if the lock
+        is not held anymore.
+
+        :param user_id: User ID
+        :type user_id: str
+        :param data: User state
+        :type data: dict
+        :param lock: Acquired user lock
+        :type lock: RedisLock
+        :param fields: Modified top level fields to save only them with hash storage, the whole data is saved
+            if None
+        :type fields: set
+        :return: indicates if player was saved in redis
+        :rtype: bool
+        :raises: LockError if the lock has expired
+        """
+        version, args, size = self._save_release_args(user_id, data, lock, fields)
+        result = self.shard(user_id).save_release_user_script(keys=self._save_release_keys(user_id, lock), args=args)
+        if not result:
+            # the user is not stored as a hash yet
+            return self.save_and_release(user_id, data, lock)
+        return self._saved_and_released(user_id, version, data, size, lock, result)
+
+    def _save_release_keys(self, user_id, lock):
+        notifier = lock.notifier
+        return [self.user_key(user_id), self.version_key(user_id), self._modified_users_key,
+                self._online_users_key, self.fields_key(user_id), lock.key,
+                notifier.channel(lock.key) if notifier is not None else '']
+
+    def _save_release_args(self, user_id, data, lock, fields):
+        data['user_id'] = user_id
+        version = self.make_version()
+        notifier = lock.notifier
+        args = [lock.value, notifier.token if notifier is not None else '', version, milliseconds()]
+        if not self.hash_storage:
+            stored = self.encode_data(data)
+            args.extend(('blob', stored))
+            return version, args, len(stored)
+        if fields is None:
+            encoded = self.encode_fields(data)
+            args.extend(('hash', len(encoded)))
+        else:
+            encoded = self.encode_fields(dict((field, data[field]) for field in fields if field in data))
+            args.extend(('fields', len(encoded)))
+        for field, value in encoded.items():
+            args.extend((field, value))
+        size = sum(map(len, encoded.values()))
+        if fields is not None:
+            args.extend(field for field in fields if field not in data)
+            if self.cache is not None:
+                size = max(size, self.cache.entry_size(user_id))
+        return version, args, size
+
+    def _saved_and_released(self, user_id, version, data, size, lock, result):
+        lock.released()
+        if result < 0:
+            self._cache_saved(user_id, version, data, size, False)
+            raise LockError('Lock of user {} has expired before the state is saved'.format(user_id))
+        self._cache_saved(user_id, version, data, size, True)
+        return True
+
+    def _cache_saved(self, user_id, version, data, size, saved):
+        if self.cache is not None:
+            if saved:
+                self.cache.put(user_id, version, data, size)
+            else:
+                self.cache.discard(user_id)
+
+    def encode_fields(self, data):
+        """
+        Encode every top level field of data separately to store in redis hash
+
+        :param data: Decoded user state or its part
+        :type data: dict
+        :return: Encoded fields
+        :rtype: dict
+        """
+        return dict((field, self.encode_data(value)) for field, value in data.items())
+
+    def decode_stored(self, stored):
+        """
+        Decode user state stored in redis either as a single value or as a hash
+
+        :param stored: Encoded value or flat list of hash fields and values
+        :return: Decoded data
+        :rtype: dict
+        """
+        if isinstance(stored, list):
+            return dict((field.decode('utf-8'), self.decode_data(value))
+                        for field, value in zip(stored[::2], stored[1::2]))
+        return self.decode_data(stored)
+
+    @staticmethod
+    def stored_size(stored):
+        if isinstance(stored, list):
+            return sum(len(value) for value in stored[1::2])
+        return len(stored)
+
     def encode_data(self, data):
         """
         Encode data to store in redis
@@ -213,7 +738,7 @@ class UserManager(object):
         :rtype:
         """
 
-        return encoder_function(data)
+        return self.codec.encode(data)
 
     def decode_data(self, data):
         """
@@ -224,50 +749,131 @@ class UserManager(object):
         :return: Decoded data
         :rtype: dict
         """
-        if isinstance(data, bytes):
-            data = data.decode('utf-8')
-        return decoder_function(data)
+        return decode_data(data)
 
     @property
     def online_users_count(self):
         """
-        Count online players in redis
-        :return: Database size (players in database)
+        Count online players in redis, i.e. players saved within the session ttl
+
+        :return: Online players count
         :rtype: int
         """
-        return self.redis.keys(self.user_key("*"))
+        session_ttl = milliseconds(self.settings['user']['session_ttl'])
+        return sum(shard.zcount(self._online_users_key, milliseconds() - session_ttl, '+inf')
+                   for shard in self.shards.values())
+
+    def prune_online_users(self):
+        """
+        Remove players whose session ttl has passed from the online users index
+
+        :return: Removed players count
+        :rtype: int
+        """
+        session_ttl = milliseconds(self.settings['user']['session_ttl'])
+        return sum(shard.zremrangebyscore(self._online_users_key, '-inf', milliseconds() - session_ttl)
+                   for shard in self.shards.values())
+
+    @property
+    def scan_batch_size(self):
+        return self.settings['user_manager']['redis'].get('scan_batch_size', self.default_scan_batch_size)
+
+    def scan_user_keys(self, cursor=0, batch_size=None, shard=None):
+        """
+        Iterate over user keys in redis with SCAN, batch by batch. Every batch comes with the cursor to resume
+        the iteration from, so an interrupted walk can be continued by passing the last cursor back.
+
+        :param cursor: Cursor to start from, 0 starts a new iteration
+        :type cursor: int
+        :param batch_size: SCAN count hint, defaults to the redis scan batch size setting
+        :type batch_size: int
+        :param shard: Redis node to scan, all nodes one by one if None, the cursor is of the node then, so
+            it can be used only with a single node
+        :type shard: UserRedis
+        :return: Generator of (next cursor, user keys) tuples, the last cursor is 0, its keys may be empty
+        """
+        if shard is None:
+            if len(self.shards) > 1:
+                if cursor:
+                    raise ValueError('Cursor can be used only with a single redis node')
+                for shard in self.shards.values():
+                    yield from self.scan_user_keys(0, batch_size, shard)
+                return
+            shard = self.redis
+        batch_size = batch_size or self.scan_batch_size
+        match = self.user_key('*')
+        while True:
+            cursor, keys = shard.scan(cursor, match=match, count=batch_size)
+            if keys or not cursor:
+                yield cursor, keys
+            if not cursor:
+                break
 
     def transaction(self, user_id):
         """
         Context manager helper for opening user state. Provides lock for user get/set operations.
+        If a transaction of the user is already open in this process, the request joins it.
 
         :param user_id: User ID
         :type user_id: str
-        :return: context manager
+        :return: UserTransaction context manager
         """
-        lock = self.get_lock(user_id)
-        yield from lock.acquire()
-        writable_state = self.get(user_id)
-        return self._transaction_context(user_id, writable_state, lock)
-
-    @contextlib.contextmanager
-    def _transaction_context(self, user_id, writable_state, lock):
+        while True:
+            transaction = self._transactions.get(user_id)
+            if transaction is None:
+                transaction = self._transactions[user_id] = self.transaction_class(self, user_id)
+                try:
+                    yield from transaction.open()
+                except Exception:
+                    transaction.abort()
+                    raise
+                return transaction
+            if (yield from transaction.join()):
+                return transaction
+
+    def commit(self, user_id, writable_state, lock=None):
         """
-        User state transaction context manager
+        Save user state modified within a transaction
 
         :param user_id: User ID
         :type user_id: str
         :param writable_state: User state
         :type writable_state: UserState
-        :param key: Lock key
-        :type key: str
+        :param lock: User lock to release along with saving
+        :type lock: RedisLock
+        :return: indicates if player was saved in redis
+        :rtype: bool
         """
-        try:
-            yield writable_state
-            lock.check_validity_time()
-            self.save(user_id, dump_value(writable_state))
-        finally:
-            lock.release()
+        touched_keys = writable_state.touched_keys
+        if self.hash_storage and touched_keys is not None:
+            data, fields = writable_state.data, touched_keys
+        else:
+            data, fields = dump_value(writable_state), None
+        if lock is not None:
+            return self.save_and_release(user_id, data, lock, fields)
+        if fields is not None:
+            return self.save_fields(user_id, data, fields)
+        return self.save(user_id, data)
+
+    @property
+    def redis_round_trips(self):
+        """
+        Redis round trips made by the user manager since it's started
+
+        :return: Round trips count
+        :rtype: int
+        """
+        return sum(shard.round_trips for shard in self.shards.values())
+
+    def track_round_trip_time(self, sketch):
+        """
+        Measure redis round trips of the user manager
+
+        :param sketch: Sketch to add round trip times in milliseconds to, None to stop measuring
+        :type sketch: engine.utils.mathutils.QuantileSketch
+        """
+        for shard in self.shards.values():
+            shard.round_trip_time = sketch
 
     @property
     def unsaved_users_count(self):
@@ -277,23 +883,231 @@ class UserManager(object):
         :return: Unsaved players count
         :rtype: int
         """
-        return self.redis.scard('modified_users')
+        return sum(shard.scard(self._modified_users_key) for shard in self.shards.values())
+
+    @property
+    def dump_settings(self):
+        """
+        Backend dump settings: streaming mode flag and batch size
 
+        :return: Dump settings
+        :rtype: dict
+        """
+        settings = self.settings['user_manager'].get('dump', {})
+        return {
+            'streaming': settings.get('streaming', False),
+            'batch_size': settings.get('batch_size', self.default_dump_batch_size),
+        }
 
     def dump_users(self, all=False):
-        db = self.redis
-        expire = self.settings['user']['session_ttl']
+        """
+        Dump users from redis to mongo, redis nodes are dumped in parallel
+
+        :param all: Dump all users in redis, not only modified ones
+        :type all: bool
+        :return: Dumped users count
+        :rtype: int
+        """
         if all:
-            users = db.get_all_users_script(keys=[expire])
-        else:
-            users = db.get_modified_users_script(keys=[expire])
+            return sum(count for count, _, _ in self.dump_all_users_batches())
+        if self.dump_settings['streaming']:
+            return sum(count for count, _ in self.dump_users_batches())
+        return sum(self.for_each_shard(self._dump_modified_users))
+
+    def _dump_modified_users(self, db):
+        expire = self.settings['user']['session_ttl']
+        users = db.get_modified_users_script(keys=[expire])
         for user_data in users:
-            self._dump_user_to_mongo(self.decode_data(user_data))
-        return len(users)
+            self._dump_user_to_mongo(self.decode_stored(user_data))
+        yield len(users)
 
-    def remove_user_ttls(self):
+    def dump_all_users_batches(self, cursor=0, batch_size=None, shard=None):
+        """
+        Dump every user in redis to mongo, walking the keyspace with SCAN. Redis nodes are dumped in parallel,
+        unless a node is given.
+
+        :param cursor: Cursor to resume from, can be used only with a single node
+        :type cursor: int
+        :param batch_size: SCAN count hint
+        :type batch_size: int
+        :param shard: Redis node to dump
+        :type shard: UserRedis
+        :return: Generator of (dumped users count, batch time in seconds, next cursor) tuples
+        """
+        if shard is None:
+            if cursor and len(self.shards) > 1:
+                raise ValueError('Cursor can be used only with a single redis node')
+            return self.for_each_shard(partial(self.dump_all_users_batches, cursor, batch_size))
+        return self._dump_all_users_batches(cursor, batch_size, shard)
+
+    def _dump_all_users_batches(self, cursor, batch_size, db):
+        expire = self.settings['user']['session_ttl']
+        for cursor, keys in self.scan_user_keys(cursor, batch_size, db):
+            if not keys:
+                yield 0, 0, cursor
+                continue
+            start = seconds()
+            results = db.read_users_script(keys=keys, args=[expire])
+            user_keys = [key for key, stored in zip(keys, results) if stored is not None]
+            requests = [self._mongo_request(key, b'full', stored) for key, stored in zip(keys, results)
+                        if stored is not None]
+            failed_keys = self._bulk_dump_to_mongo(requests, user_keys)
+            if failed_keys:
+                db.sadd(self._modified_users_key, *failed_keys)
+            yield len(requests), seconds() - start, cursor
+
+    def dump_users_batches(self, batch_size=None, shard=None):
+        """
+        Stream modified users from redis to mongo in bounded batches. Redis nodes are dumped in parallel,
+        unless a node is given.
+
+        Every batch is moved from the modified users set to the flushing set atomically, written to mongo with
+        a single bulk write and then acknowledged. Users, that failed to be written, are kept in the flushing set
+        until the flush ends, so they are not popped again by the same flush. Users left in the flushing set
+        by an interrupted flush are marked as modified again when the next flush starts.
+
+        :param batch_size: Users per batch, defaults to the dump settings
+        :type batch_size: int
+        :param shard: Redis node to dump
+        :type shard: UserRedis
+        :return: Generator of (dumped users count, batch time in seconds) tuples
+        """
+        if shard is None:
+            return self.for_each_shard(partial(self.dump_users_batches, batch_size))
+        return self._dump_users_batches(batch_size, shard)
+
+    def _dump_users_batches(self, batch_size, db):
+        batch_size = batch_size or self.dump_settings['batch_size']
+        expire = self.settings['user']['session_ttl']
+        self.requeue_flushing_users(db)
+        while True:
+            start = seconds()
+            popped = db.pop_modified_users_script(
+                keys=[self._modified_users_key, self._flushing_users_key],
+                args=[batch_size, expire])
+            if not popped[0]:
+                break
+            user_keys = popped[1::3]
+            requests = [self._mongo_request(*user) for user in zip(user_keys, popped[2::3], popped[3::3])]
+            self._dump_users_to_mongo(requests, user_keys, db)
+            yield len(requests), seconds() - start
+        self.requeue_flushing_users(db)
+
+    def requeue_flushing_users(self, shard=None):
+        """
+        Mark users of an unacknowledged flush as modified again
+
+        :param shard: Redis node, all nodes if None
+        :type shard: UserRedis
+        :return:
+        """
+        for db in [shard] if shard is not None else self.shards.values():
+            pipe = db.pipeline(transaction=True)
+            pipe.sunionstore(self._modified_users_key, self._modified_users_key, self._flushing_users_key)
+            pipe.delete(self._flushing_users_key)
+            pipe.execute()
+
+    def _dump_users_to_mongo(self, requests, user_keys, db):
+        """
+        Dump a batch of users to MongoDB and acknowledge the written ones
+
+        :param requests: Mongo write requests, one per user
+        :type requests: list
+        :param user_keys: Redis keys of the users
+        :type user_keys: list
+        :param db: Redis node of the users
+        :type db: UserRedis
+        :return:
+        """
+        if not requests:
+            return
+        failed_keys = set(self._bulk_dump_to_mongo(requests, user_keys))
+        written_keys = [key for key in user_keys if key not in failed_keys]
+        if written_keys:
+            db.srem(self._flushing_users_key, *written_keys)
+
+    def _mongo_request(self, user_key, kind, stored):
+        """
+        Make mongo write request for a user read from redis
+
+        :param user_key: Redis key of the user
+        :type user_key: bytes
+        :param kind: b'full' if stored is the whole user state, b'fields' if it is a flat list of modified fields
+            and their values, where removed fields have None values
+        :type kind: bytes
+        :param stored: Stored user state
+        :return: Mongo write request
+        """
+        if kind != b'fields':
+            user_data = self.decode_stored(stored)
+            return ReplaceOne({'_id': user_data['user_id']}, dump_value(user_data), upsert=True)
+        set_fields = {}
+        unset_fields = {}
+        for field, value in zip(stored[::2], stored[1::2]):
+            field = field.decode('utf-8')
+            if field == '_id':
+                continue
+            if value is None:
+                unset_fields[field] = ''
+            else:
+                set_fields[field] = dump_value(self.decode_data(value))
+        update = {}
+        if set_fields:
+            update['$set'] = set_fields
+        if unset_fields:
+            update['$unset'] = unset_fields
+        return UpdateOne({'_id': self.decode_user_id(user_key)}, update, upsert=True)
+
+    def _bulk_dump_to_mongo(self, requests, user_keys):
+        """
+        Dump a batch of users to MongoDB with a single bulk write
+
+        :param requests: Mongo write requests, one per user
+        :type requests: list
+        :param user_keys: Redis keys of the users
+        :type user_keys: list
+        :return: Redis keys of the users that were not written
+        :rtype: list
+        """
+        if not requests:
+            return []
+        self.ensure_mongo_index()
+        try:
+            self.mongo.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            failed_keys = [user_keys[error['index']] for error in e.details['writeErrors']]
+            log.error('Users bulk write failed for {} of {} users'.format(len(failed_keys), len(requests)))
+            return failed_keys
+        return []
+
+    def remove_user_ttls(self, cursor=0, batch_size=None):
+        """
+        Remove ttls from all users in redis, walking the keyspace with SCAN
+
+        :param cursor: Cursor to resume from, can be used only with a single redis node
+        :type cursor: int
+        :param batch_size: SCAN count hint
+        :type batch_size: int
+        :return: Processed users count
+        :rtype: int
+        """
         # TODO: a script that calls this method
-        self.redis.remove_user_ttls_script()
+        if cursor and len(self.shards) > 1:
+            raise ValueError('Cursor can be used only with a single redis node')
+        return sum(self._remove_user_ttls(cursor, batch_size, shard) for shard in self.shards.values())
+
+    def _remove_user_ttls(self, cursor, batch_size, shard):
+        count = 0
+        for cursor, keys in self.scan_user_keys(cursor, batch_size, shard):
+            if not keys:
+                continue
+            pipe = shard.pipeline(transaction=False)
+            for key in keys:
+                pipe.persist(key)
+                pipe.persist(self.version_key(self.decode_user_id(key)))
+            pipe.execute()
+            count += len(keys)
+        return count
 
     def _dump_user_to_mongo(self, user_data):
         """
@@ -303,7 +1117,7 @@ class UserManager(object):
         :type player_data: dict or UserState
         :return:
         """
-        self.mongo.ensure_index('user_id')
+        self.ensure_mongo_index()
         self.mongo.find_and_modify({'_id': user_data['user_id']},
                                    dump_value(user_data), upsert=True)
 
@@ -319,7 +1133,7 @@ class UserManager(object):
         data = {"ts": milliseconds(),
                 "commands": commands,
                 "response": response}
-        pipe = self.redis.pipeline(transaction=True)
+        pipe = self.shard(user_id).pipeline(transaction=True)
         pipe.rpush(key, json.dumps(data))
         pipe.ltrim(key, -settings['size'], -1)
         pipe.expire(key, settings['ttl'])
@@ -327,51 +1141,218 @@ class UserManager(object):
 
     def get_commands_log(self, user_id):
         key = self.log_key(user_id)
-        data = self.redis.lrange(key, 0, -1)
+        data = self.shard(user_id).lrange(key, 0, -1)
         return [json.loads(i.decode("utf-8")) for i in data]
 
 
 class UserRedis(StrictRedis, LockRedisMixin):
-    GET_ALL_USERS_SCRIPT = """
-        local ids = redis.call("KEYS", "user:*")
+    # commands and pipelines sent to redis, i.e. network round trips
+    round_trips = 0
+    # QuantileSketch of round trip times in milliseconds, set it to measure them
+    round_trip_time = None
+
+    # user might be stored either as a single value or as a hash with a field per top level key
+    READ_USER_FUNCTION = """
+        local function read_user(key)
+            local key_type = redis.call("TYPE", key)["ok"]
+            if key_type == "hash" then
+                return redis.call("HGETALL", key)
+            elseif key_type == "string" then
+                return redis.call("GET", key)
+            end
+            return false
+        end
+    """
+
+    LOAD_USER_SCRIPT = READ_USER_FUNCTION + """
+        local version = redis.call("GET", KEYS[2])
+        if version and version == ARGV[1] then
+            return {version, false}
+        end
+        return {version, read_user(KEYS[1])}
+    """
+
+    # KEYS: lock, user, version; ARGV: lock value, lock validity time, cached version
+    ACQUIRE_LOAD_USER_SCRIPT = READ_USER_FUNCTION + """
+        if not redis.call("SET", KEYS[1], ARGV[1], "NX", "EX", ARGV[2]) then
+            return false
+        end
+        local version = redis.call("GET", KEYS[3])
+        if version and version == ARGV[3] then
+            return {version, false}
+        end
+        return {version, read_user(KEYS[2])}
+    """
+
+    READ_USERS_SCRIPT = READ_USER_FUNCTION + """
         local objects = {}
-        for n, id in ipairs(ids) do
-            table.insert(objects, redis.call("GET", id))
-            redis.call("EXPIRE", id, KEYS[1])
+        for n, id in ipairs(KEYS) do
+            objects[n] = read_user(id)
+            redis.call("EXPIRE", id, ARGV[1])
+            redis.call("EXPIRE", "version:" .. id, ARGV[1])
         end
         return objects
     """
 
-    GET_MODIFIED_USERS_SCRIPT = """
+    SAVE_USER_FIELDS_SCRIPT = """
+        if redis.call("TYPE", KEYS[1])["ok"] ~= "hash" then
+            return 0
+        end
+        local set_count = tonumber(ARGV[3])
+        for i = 4, 3 + set_count * 2, 2 do
+            redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+            redis.call("SADD", KEYS[5], ARGV[i])
+        end
+        for i = 4 + set_count * 2, #ARGV do
+            redis.call("HDEL", KEYS[1], ARGV[i])
+            redis.call("SADD", KEYS[5], ARGV[i])
+        end
+        -- unlike the set command, hash commands don't cancel a user's ttl
+        redis.call("PERSIST", KEYS[1])
+        redis.call("SET", KEYS[2], ARGV[1])
+        redis.call("SADD", KEYS[3], KEYS[1])
+        redis.call("ZADD", KEYS[4], ARGV[2], KEYS[1])
+        return 1
+    """
+
+    # KEYS: user, version, modified users, online users, fields, lock, lock channel
+    # ARGV: lock value, release notification, version, now, mode, then the state for the blob mode, or for the hash
+    # and fields modes: count of set fields, set fields and their values, removed fields
+    SAVE_RELEASE_USER_SCRIPT = """
+        if redis.call("GET", KEYS[6]) ~= ARGV[1] then
+            return -1
+        end
+        local mode = ARGV[5]
+        if mode == "blob" then
+            redis.call("SET", KEYS[1], ARGV[6])
+        else
+            if mode == "hash" then
+                redis.call("DEL", KEYS[1], KEYS[5])
+                redis.call("SADD", KEYS[5], "*")
+            elseif redis.call("TYPE", KEYS[1])["ok"] ~= "hash" then
+                return 0
+            end
+            local set_count = tonumber(ARGV[6])
+            for i = 7, 6 + set_count * 2, 2 do
+                redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+                if mode == "fields" then
+                    redis.call("SADD", KEYS[5], ARGV[i])
+                end
+            end
+            for i = 7 + set_count * 2, #ARGV do
+                redis.call("HDEL", KEYS[1], ARGV[i])
+                redis.call("SADD", KEYS[5], ARGV[i])
+            end
+            redis.call("PERSIST", KEYS[1])
+        end
+        redis.call("SET", KEYS[2], ARGV[3])
+        redis.call("SADD", KEYS[3], KEYS[1])
+        redis.call("ZADD", KEYS[4], ARGV[4], KEYS[1])
+        redis.call("DEL", KEYS[6])
+        if ARGV[2] ~= "" then
+            redis.call("PUBLISH", KEYS[7], ARGV[2])
+        end
+        return 1
+    """
+
+    GET_MODIFIED_USERS_SCRIPT = READ_USER_FUNCTION + """
         local ids = redis.call("SMEMBERS", "modified_users")
         redis.call("DEL", "modified_users")
         local objects = {}
         for n, id in ipairs(ids) do
-            table.insert(objects, redis.call("GET", id))
+            table.insert(objects, read_user(id))
+            redis.call("DEL", "fields:" .. id)
             redis.call("EXPIRE", id, KEYS[1])
+            redis.call("EXPIRE", "version:" .. id, KEYS[1])
         end
         return objects
     """
 
-    REMOVE_USER_TTLS_SCRIPT = """
-        local ids = redis.call("KEYS", "user:*")
+    # returns popped users count followed by key, kind and stored state of every found user
+    POP_MODIFIED_USERS_SCRIPT = READ_USER_FUNCTION + """
+        if redis.replicate_commands then
+            redis.replicate_commands()
+        end
+        local ids = redis.call("SPOP", KEYS[1], ARGV[1])
+        local objects = {#ids}
         for n, id in ipairs(ids) do
-            redis.call("PERSIST", id)
+            local fields_key = "fields:" .. id
+            local fields = redis.call("SMEMBERS", fields_key)
+            redis.call("DEL", fields_key)
+            local kind = "fields"
+            if #fields == 0 or redis.call("TYPE", id)["ok"] ~= "hash" then
+                kind = "full"
+            end
+            for i, field in ipairs(fields) do
+                if field == "*" then
+                    kind = "full"
+                end
+            end
+            local object
+            if kind == "fields" then
+                object = {}
+                local values = redis.call("HMGET", id, unpack(fields))
+                for i, field in ipairs(fields) do
+                    table.insert(object, field)
+                    table.insert(object, values[i])
+                end
+            else
+                object = read_user(id)
+            end
+            if object then
+                redis.call("SADD", KEYS[2], id)
+                table.insert(objects, id)
+                table.insert(objects, kind)
+                table.insert(objects, object)
+                redis.call("EXPIRE", id, ARGV[2])
+                redis.call("EXPIRE", "version:" .. id, ARGV[2])
+            end
         end
-        return redis.status_reply("OK")
+        return objects
     """
 
-    get_all_users_script = None
+    load_user_script = None
+    acquire_load_user_script = None
+    read_users_script = None
+    save_user_fields_script = None
+    save_release_user_script = None
     get_modified_users_script = None
-    remove_user_ttls_script = None
+    pop_modified_users_script = None
 
     def init_scripts(self):
         reg = self.register_script
-        self.get_all_users_script = reg(self.GET_ALL_USERS_SCRIPT)
+        self.load_user_script = reg(self.LOAD_USER_SCRIPT)
+        self.acquire_load_user_script = reg(self.ACQUIRE_LOAD_USER_SCRIPT)
+        self.read_users_script = reg(self.READ_USERS_SCRIPT)
+        self.save_user_fields_script = reg(self.SAVE_USER_FIELDS_SCRIPT)
+        self.save_release_user_script = reg(self.SAVE_RELEASE_USER_SCRIPT)
         self.get_modified_users_script = reg(self.GET_MODIFIED_USERS_SCRIPT)
-        self.remove_user_ttls_script = reg(self.REMOVE_USER_TTLS_SCRIPT)
+        self.pop_modified_users_script = reg(self.POP_MODIFIED_USERS_SCRIPT)
         self.init_lock_script()
 
-
-
-
+    def execute_command(self, *args, **options):
+        self.round_trips += 1
+        if self.round_trip_time is None:
+            return super(UserRedis, self).execute_command(*args, **options)
+        start = perf_counter()
+        try:
+            return super(UserRedis, self).execute_command(*args, **options)
+        finally:
+            self.round_trip_time += (perf_counter() - start) * 1000
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipeline = super(UserRedis, self).pipeline(transaction, shard_hint)
+        execute = pipeline.execute
+
+        def counted_execute(*args, **kwargs):
+            self.round_trips += 1
+            if self.round_trip_time is None:
+                return execute(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                self.round_trip_time += (perf_counter() - start) * 1000
+
+        pipeline.execute = counted_execute
+        return pipeline
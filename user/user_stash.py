@@ -1,12 +1,13 @@
 from random import Random
 from copy import copy
-from collections import MutableMapping
+from collections import Mapping, MutableMapping, Sequence
 from logging import getLogger
 import re
 import operator
 
-from engine.utils.dictutils import DictView
-from engine.utils.mathutils import Weights
+from engine.common.snapshot import SnapshotDict
+from engine.utils.dictutils import DictView, ListView, MappingView
+from engine.utils.mathutils import weighted_choice
 
 
 log = getLogger('process')
@@ -21,47 +22,46 @@ class StashError(Exception):
         return 'Stash operation error: {description}'.format(**self.__dict__)
 
 
-class StashValue(object):
-    __slots__ = ('value', 'random', 'plain', 'min', 'max',
-                 'probability', 'weighted', 'sampled')
+class StashSpec(object):
+    """
+    Parsed stash value string, e.g. "5:10%30*": range, probability, weighted or sampled flags. Specs are
+    immutable and shared by all stash values of the same string, see compile_stash_value.
+    """
+    __slots__ = ('value', 'plain', 'min', 'max', 'probability', 'weighted', 'sampled')
 
     PATTERN = re.compile(
         r"(?P<min>\d+)(:(?P<max>\d+))?(%(?P<probability>\d+))?(?P<weighted>\*)?(#(?P<sampled>\d+))?")
 
-    def __init__(self, value, *, random):
-        self.random = random
-        self.weighted = False
-        if isinstance(value, (int, float)):
-            self.value = value
-            self.plain = True
-            return
-
+    def __init__(self, value):
+        set_field = super(StashSpec, self).__setattr__
         try:
-            self.value = int(float(value))
+            set_field('value', int(float(value)))
         except ValueError:
             pass
         else:
-            self.plain = True
+            for field, field_value in (('plain', True), ('min', None), ('max', None), ('probability', 1),
+                                       ('weighted', False), ('sampled', False)):
+                set_field(field, field_value)
             return
 
         match = self.PATTERN.match(value)
         if not match:
             raise StashError('Unable to parse {}'.format(value))
-
-        self.value = value
-        self.plain = False
         match = match.groupdict()
 
-        self.min = int(self._float(match['min'], 0))
-        self.max = int(self._float(match['max'], self.min))
-        self.probability = self._float(match['probability'], 100) / 100
+        set_field('value', value)
+        set_field('plain', False)
+        set_field('min', int(self._float(match['min'], 0)))
+        set_field('max', int(self._float(match['max'], self.min)))
+        set_field('probability', self._float(match['probability'], 100) / 100)
         try:
             sampled = int(match['sampled'])
         except TypeError:
-            self.weighted = bool(match['weighted'])
-            self.sampled = False
+            set_field('weighted', bool(match['weighted']))
+            set_field('sampled', False)
         else:
-            self.sampled = sampled
+            set_field('weighted', False)
+            set_field('sampled', sampled)
 
     @staticmethod
     def _float(value, default):
@@ -70,6 +70,95 @@ class StashValue(object):
         else:
             return float(value)
 
+    def __setattr__(self, key, value):
+        raise AttributeError('Stash spec is immutable')
+
+    def __repr__(self):
+        return '<StashSpec: {}>'.format(self.value)
+
+
+_specs = {}
+# stash strings mostly come from game data, the limit only guards against strings built at runtime
+MAX_SPECS = 100000
+
+
+def compile_stash_value(value):
+    """
+    Parse stash value string once per process
+
+    :param value: Stash value string
+    :type value: str
+    :return: Shared parsed spec
+    :rtype: StashSpec
+    :raise StashError: If the string can't be parsed
+    """
+    try:
+        return _specs[value]
+    except KeyError:
+        pass
+    spec = StashSpec(value)
+    if len(_specs) >= MAX_SPECS:
+        _specs.clear()
+    _specs[value] = spec
+    return spec
+
+
+def precompile_stash_values(data):
+    """
+    Compile all strings of the data, that look like stash values, e.g. all rewards and prices of the game data,
+    so they are not parsed while requests are processed
+
+    :param data: Game data, views of content snapshots as well
+    :return: Compiled strings count
+    :rtype: int
+    """
+    if isinstance(data, SnapshotDict):
+        # strings are stored once in a snapshot, so the distinct ones are compiled without reading the containers
+        data = data.snapshot.strings()
+    compiled = 0
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (dict, MappingView)):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple, ListView)):
+            stack.extend(value)
+        elif isinstance(value, str) and value[:1].isdigit():
+            try:
+                compile_stash_value(value)
+            except StashError:
+                pass
+            else:
+                compiled += 1
+    return compiled
+
+
+class StashValue(object):
+    __slots__ = ('value', 'random', 'plain', 'min', 'max',
+                 'probability', 'weighted', 'sampled')
+
+    PATTERN = StashSpec.PATTERN
+
+    def __init__(self, value, *, random):
+        self.random = random
+        self.weighted = False
+        if isinstance(value, (int, float)):
+            self.value = value
+            self.plain = True
+            return
+
+        spec = compile_stash_value(value)
+        self.value = spec.value
+        self.plain = spec.plain
+        if spec.plain:
+            return
+        self.min = spec.min
+        self.max = spec.max
+        # probability of a weighted value decreases with every roll, so it's kept per value
+        self.probability = spec.probability
+        self.weighted = spec.weighted
+        self.sampled = spec.sampled
+
     def roll(self, dice=None):
         if self.plain:
             return self.value
@@ -83,7 +172,7 @@ class StashValue(object):
                     self.probability -= 0.01
                     self.probability = max(self.probability, 0)
             if self.min < self.max:
-                return self.random.choice(list(range(self.min, self.max + 1)))
+                return self.random.randint(self.min, self.max)
             else:
                 return self.min
 
@@ -114,6 +203,14 @@ class StashValue(object):
         return str(self)
 
 
+def is_stash_operand(value):
+    """
+    :return: Value is a mapping, or a sequence of key and value, but not a string
+    :rtype: bool
+    """
+    return isinstance(value, Mapping) or (isinstance(value, Sequence) and not isinstance(value, (str, bytes)))
+
+
 class Stash(DictView, MutableMapping):
     def __init__(self, src=None, *, random, **kwargs):
         self.random = random
@@ -178,8 +275,8 @@ class Stash(DictView, MutableMapping):
 
         if len(weighted_values) > 1:
             self._data.update(dict.fromkeys(weighted_values, 0))
-            weights = Weights(**dict((key, value.probability) for key, value in weighted_values.items()))
-            key = weights.choice()
+            keys = list(weighted_values)
+            key = weighted_choice(keys, [weighted_values[key].probability for key in keys], self.random)
             value = weighted_values[key]
             self._data[key] = value.roll(0)
         elif len(weighted_values) == 1:
@@ -196,6 +293,18 @@ class Stash(DictView, MutableMapping):
 
         return self._data
 
+    def sample(self, sampled_values, count):
+        """
+        :param sampled_values: Sampled stash values by key
+        :type sampled_values: dict
+        :param count: Keys count to choose
+        :type count: int
+        :return: Keys chosen at random, all of them if there are not more than count
+        :rtype: set
+        """
+        keys = list(sampled_values)
+        return set(self.random.sample(keys, min(count, len(keys))))
+
     def __getitem__(self, item):
         try:
             return self._data[item]
@@ -218,7 +327,7 @@ class Stash(DictView, MutableMapping):
         return ", ".join(["{0}:{1}".format(key, value) for key, value in list(self.items())])
 
     def __contains__(self, item):
-        if isinstance(item, (dict, DictView, list, tuple)):
+        if isinstance(item, (dict, list, tuple)) or is_stash_operand(item):
             item = Stash(item, random=self.random)
         if isinstance(item, Stash):
             for item_key, item_value in list(item.items()):
@@ -239,10 +348,67 @@ class Stash(DictView, MutableMapping):
         if value or current_value:
             self[key] = value
 
+    _plain_types = (int, float)
+
+    def plain_items(self, other):
+        """
+        Items of a stash or of a dict of plain numbers, that can be applied without parsing and rolling
+
+        :param other: Stash or dict
+        :return: Items or None if the values should be parsed
+        """
+        if isinstance(other, Stash):
+            return other._data.items()
+        if type(other) is dict:
+            plain_types = self._plain_types
+            for value in other.values():
+                if type(value) not in plain_types:
+                    return None
+            return other.items()
+        return None
+
+    def _operand_items(self, other):
+        items = self.plain_items(other)
+        if items is None:
+            items = Stash(other, random=self.random).items()
+        return items
+
     def _generic_operation_with_dict(self, other, op):
-        other = Stash(other, random=self.random)
-        for key, value in other.items():
-            self._apply_operator(key, value, op)
+        items = self._operand_items(other)
+        data = self._data
+        for key, value in items:
+            current_value = data.get(key, 0)
+            value = op(current_value, value)
+            if value or current_value:
+                data[key] = value
+        return self
+
+    def apply_deltas(self, add=(), subtract=()):
+        """
+        Add and subtract many stashes at once: deltas are summed up by key first and every key is changed
+        once. Unlike applying them one by one, a missing key is not set, if its deltas cancel each other out.
+
+        :param add: Stashes or dicts to add
+        :type add: list
+        :param subtract: Stashes or dicts to subtract
+        :type subtract: list
+        :return: self
+        :rtype: Stash
+        """
+        deltas = {}
+        get = deltas.get
+        for other in add:
+            for key, value in self._operand_items(other):
+                deltas[key] = get(key, 0) + value
+        for other in subtract:
+            for key, value in self._operand_items(other):
+                deltas[key] = get(key, 0) - value
+        data = self._data
+        for key, delta in deltas.items():
+            current_value = data.get(key, 0)
+            value = current_value + delta
+            if value or current_value:
+                data[key] = value
         return self
 
     def _generic_operation_with_key_value(self, key_value, op):
@@ -257,9 +423,10 @@ class Stash(DictView, MutableMapping):
         return self
 
     def _generic_operation(self, other, op):
-        if isinstance(other, (dict, DictView)):
+        # state and content wrappers, like journaled state or snapshot dicts, are mappings and sequences too
+        if isinstance(other, dict) or isinstance(other, Mapping):
             return self._generic_operation_with_dict(other, op)
-        elif isinstance(other, (list, tuple)):
+        elif isinstance(other, (list, tuple)) or is_stash_operand(other):
             return self._generic_operation_with_key_value(other, op)
         else:
             return self._generic_operation_with_number(other, op)
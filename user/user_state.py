@@ -1,32 +1,106 @@
 from random import Random
 
-from engine.utils.dictutils import MappingView
+from engine.utils.dictutils import MappingView, dump_value
+from engine.user.state_journal import StateJournal, unwrap
 from engine.user.user_stash import Stash
 
 __author__ = 'kollad'
 
 
 class UserStash(Stash):
-    def __init__(self, state, **kwargs):
+    """
+    Stash over user resources. Resources are plain numbers, so they are neither parsed nor rolled, unless stash
+    values are asked for.
+    """
+
+    def __init__(self, state, *, random):
         self.state = state
-        data = state['resources']
-        super(UserStash, self).__init__(data, **kwargs)
-        self._data = data
+        self.random = random
+        MappingView.__init__(self, state['resources'])
+
+    @property
+    def _stash_values(self):
+        return dict(self.init_stash_values(self._data))
 
     def copy(self):
-        return UserStash(self.state)
+        return UserStash(self.state, random=self.random)
 
 
 class UserState(MappingView):
+    _mutable_types = (dict, list, set)
+
     def __init__(self, data, *args, random, **kwargs):
         super(UserState, self).__init__(*args, **kwargs)
         self._data = data or {}
         self._content_manager = None
+        # top level keys, which values could have been modified, None means that any value could be modified
+        self._touched = set()
+        self._journal = None
         if random is None:
             self.random = Random(0)
         else:
             self.random = random
 
+    @property
+    def data(self):
+        self._touched = None
+        return self._data
+
+    @property
+    def touched_keys(self):
+        """
+        Top level keys, which were assigned, deleted or which mutable values were accessed. With the journal
+        only the keys of the committed changes are counted, not just accessed ones.
+
+        :return: Set of keys or None if the whole state could be modified
+        :rtype: set
+        """
+        if self._touched is None or self._journal is None:
+            return self._touched
+        return self._touched | set(path[0] for path in self._journal.changed_paths)
+
+    @property
+    def changed_paths(self):
+        """
+        Paths of the committed changes, tuples of keys from the top of the state
+
+        :return: Set of paths or None if the state is not journaled or the whole state could be modified
+        :rtype: set
+        """
+        if self._touched is None or self._journal is None:
+            return None
+        return self._journal.changed_paths | set((key,) for key in self._touched)
+
+    def touch(self, key):
+        if self._touched is not None:
+            self._touched.add(key)
+
+    @property
+    def journaled(self):
+        return self._journal is not None
+
+    def begin(self):
+        """
+        Start a savepoint: changes made from now on are recorded, so they can be rolled back. Nested containers
+        of the state are returned wrapped to track changes. Rolling back and committing cost as much as the changes.
+        """
+        if self._journal is None:
+            self._journal = StateJournal()
+        else:
+            self._journal.commit()
+
+    def commit(self):
+        """
+        Keep the changes of the savepoint
+        """
+        self._journal.commit()
+
+    def rollback(self):
+        """
+        Undo the changes of the savepoint
+        """
+        self._journal.rollback()
+
     @property
     def content_manager(self):
         if self._content_manager is None:
@@ -37,13 +111,37 @@ class UserState(MappingView):
         self._content_manager = manager
 
     def __setitem__(self, item, value):
+        journal = self._journal
+        if journal is None:
+            self.touch(item)
+        else:
+            journal.record_key(self._data, item, ())
+            value = unwrap(value)
         self._data[item] = value
 
     def __delitem__(self, key):
+        journal = self._journal
+        if journal is None:
+            self.touch(key)
+        elif key in self._data:
+            journal.record_key(self._data, key, ())
         del self._data[key]
 
     def __getitem__(self, item):
-        return self._data[item]
+        value = self._data[item]
+        journal = self._journal
+        if journal is not None:
+            return journal.wrap(value, (item,))
+        if isinstance(value, self._mutable_types):
+            self.touch(item)
+        return value
+
+    def dump(self, copy=True):
+        """
+        :param copy: Copy nested values, otherwise they could be shared with the state, see dump_value
+        :type copy: bool
+        """
+        return dict((key, dump_value(value, copy)) for key, value in self._data.items())
 
     def setdefault(self, key, default=None):
         if key not in self:
@@ -64,7 +162,11 @@ class UserState(MappingView):
         :return: User stash
         :rtype: UserStash
         """
-        return UserStash(self._data, random=self.random)
+        journal = self._journal
+        if journal is None:
+            self.touch('resources')
+            return UserStash(self._data, random=self.random)
+        return UserStash(journal.wrap(self._data, ()), random=self.random)
 
     @stash.setter
     def stash(self, stash):
@@ -1,3 +1,4 @@
+from tornado.concurrent import Future
 from tornado.gen import Task
 from tornado.ioloop import IOLoop
 
@@ -5,4 +6,36 @@ from tornado.ioloop import IOLoop
 def sleep(seconds, ioloop=None):
     ioloop = ioloop or IOLoop.instance()
     time = ioloop.time() + seconds
-    yield Task(ioloop.add_timeout, time)
\ No newline at end of file
+    yield Task(ioloop.add_timeout, time)
+
+
+def wait_future(future, seconds, ioloop=None):
+    """
+    Wait until future is resolved or timeout expired. Unlike tornado.gen.with_timeout the future is not failed
+    on timeout, so it can be waited again.
+
+    :param future: Future to wait
+    :type future: Future
+    :param seconds: Timeout in seconds
+    :type seconds: float
+    :param ioloop: IOLoop
+    :type ioloop: IOLoop
+    :return: Future result or False if timeout expired
+    """
+    ioloop = ioloop or IOLoop.instance()
+    if not future.done():
+        waiter = Future()
+
+        def chain(_):
+            if not waiter.done():
+                waiter.set_result(None)
+
+        timeout = ioloop.add_timeout(ioloop.time() + seconds, chain, None)
+        future.add_done_callback(chain)
+        try:
+            yield waiter
+        finally:
+            ioloop.remove_timeout(timeout)
+    if not future.done():
+        return False
+    return future.result()
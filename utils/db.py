@@ -348,9 +348,12 @@ class Proxy(MappingView):
 
 
 class DiffedProxy(Proxy, MutableMapping):
+    # cache effective values, see Diffed
+    materialized = False
+
     def __init__(self, _id=None, data=None, diffs=()):
         super(DiffedProxy, self).__init__(_id=_id, data=data)
-        self._data = Diffed(self._data)
+        self._data = Diffed(self._data, materialized=self.materialized)
         self.add_diff(*diffs)
 
     @property
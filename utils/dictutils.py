@@ -1,29 +1,180 @@
-from collections import Mapping, Sequence, MutableMapping
+from collections import Mapping, Sequence, MutableMapping, MutableSequence
+from functools import lru_cache
+from itertools import islice
 import re
 from types import GeneratorType
 from engine import utils
 
 
-def dump_value(value):
+class TreeNode(object):
+    """
+    Container found by a convert function of convert_tree, which items should be converted too
+    """
+    __slots__ = ('source', 'is_dict', 'wrap', 'reusable', 'items', 'out', 'index', 'key', 'child')
+
+    def __init__(self, source, is_dict=False, wrap=None, reusable=False):
+        """
+        :param source: Dict or iterable of items
+        :param is_dict: Source is a dict, its values are converted
+        :type is_dict: bool
+        :param wrap: Function to build the result from the converted dict or list
+        :param reusable: Source itself could be the result, if none of its items are changed by conversion
+        :type reusable: bool
+        """
+        self.source = source
+        self.is_dict = is_dict
+        self.wrap = wrap
+        self.reusable = reusable
+        self.items = iter(source.items() if is_dict else source)
+        self.out = None if reusable else ({} if is_dict else [])
+        self.index = 0
+        self.key = None
+        self.child = None
+
+    def put(self, key, value, converted):
+        out = self.out
+        if out is None:
+            if converted is value:
+                self.index += 1
+                return
+            # the first changed item, the source can't be reused anymore
+            if self.is_dict:
+                out = self.out = dict(islice(self.source.items(), self.index))
+            else:
+                out = self.out = self.source[:self.index]
+        if self.is_dict:
+            out[key] = converted
+        else:
+            out.append(converted)
+        self.index += 1
+
+    def result(self):
+        result = self.source if self.out is None else self.out
+        if self.wrap is not None:
+            return self.wrap(result)
+        return result
+
+
+def convert_tree(value, convert):
+    """
+    Convert nested value without recursion
+
+    :param value: Value to convert
+    :param convert: Function, that returns converted value or TreeNode for a container, which items should be
+     converted with the same function
+    :return: Converted value
+    """
+    converted = convert(value)
+    if not isinstance(converted, TreeNode):
+        return converted
+    stack = [converted]
+    while True:
+        node = stack[-1]
+        is_dict = node.is_dict
+        for item in node.items:
+            if is_dict:
+                key, item_value = item
+            else:
+                key, item_value = None, item
+            converted = convert(item_value)
+            if isinstance(converted, TreeNode):
+                node.key = key
+                node.child = item_value
+                stack.append(converted)
+                break
+            node.put(key, item_value, converted)
+        else:
+            stack.pop()
+            result = node.result()
+            if not stack:
+                return result
+            parent = stack[-1]
+            parent.put(parent.key, parent.child, result)
+
+
+_plain_types = frozenset((str, int, float, bool, type(None)))
+
+
+def is_plain(values):
+    """
+    :param values: Items of a list or values of a dict
+    :return: All values are scalars, that need no conversion
+    :rtype: bool
+    """
+    # type check runs in C, it's much faster than walking the items
+    return _plain_types.issuperset(map(type, values))
+
+
+def _dump_copy(value):
+    value_type = type(value)
+    if value_type in _plain_types:
+        return value
+    if value_type in _view_types:
+        # view is dumped as its data, same as with its dump method, but without recursion
+        value = value._data
     if hasattr(value, 'dump'):
         return value.dump()
     if isinstance(value, str):
         return str(value)
     elif isinstance(value, (tuple, list, set, GeneratorType)):
-        return list(map(dump_value, value))
+        if isinstance(value, list) and is_plain(value):
+            return list(value)
+        return TreeNode(value)
     elif isinstance(value, dict):
-        # TODO: Raise an exception if key is empty string or None.
-        return dict((key, dump_value(value)) for key, value in value.items()
-                    if key is not None or key != '')
+        if is_plain(value.values()):
+            return dict(value)
+        return TreeNode(value, is_dict=True)
     elif isinstance(value, int) and value > 0xffffffff:
         return int(value)
     return value
 
 
+def _dump_reuse(value):
+    value_type = type(value)
+    if value_type in _plain_types:
+        return value
+    if value_type in _view_types:
+        # view is dumped as its data, same as with its dump method, but without recursion
+        value = value._data
+    if hasattr(value, 'dump'):
+        return value.dump()
+    if isinstance(value, str):
+        return str(value)
+    elif isinstance(value, list):
+        if is_plain(value):
+            return value
+        return TreeNode(value, reusable=True)
+    elif isinstance(value, (tuple, set, GeneratorType)):
+        return TreeNode(value)
+    elif isinstance(value, dict):
+        if is_plain(value.values()):
+            return value
+        return TreeNode(value, is_dict=True, reusable=True)
+    elif isinstance(value, int) and value > 0xffffffff:
+        return int(value)
+    return value
+
+
+def dump_value(value, copy=True):
+    """
+    Dump value to plain dicts, lists and scalars: views and other objects with dump method are dumped, tuples, sets
+    and generators become lists.
+
+    :param value: Value to dump
+    :param copy: Copy all containers, otherwise dicts and lists, which don't need conversion, are returned as is,
+     so the result could share them with the value and should not be modified
+    :type copy: bool
+    :return: Dumped value
+    """
+    return convert_tree(value, _dump_copy if copy else _dump_reuse)
+
+
 def flatten_value(value):
-    if isinstance(value, (dict, DictView)):
+    if type(value) is int:
+        return value
+    if isinstance(value, (dict, Mapping)):
         return dict((k, flatten_value(v)) for k, v in value.items())
-    elif isinstance(value, (list, ListView)):
+    elif isinstance(value, (list, ListView, MutableSequence)):
         return list(map(flatten_value, value))
     elif isinstance(value, str):
         value = str(value)
@@ -89,6 +240,7 @@ def view_value(value):
 
 
 _default = object()
+_invalid = object()
 _field_pattern = re.compile('(([^\.\[\]]+)(\[(\d+)\])?)+')
 
 
@@ -102,6 +254,118 @@ def split_field(field):
     return full_match, nested_field, index
 
 
+class FieldPath(object):
+    """
+    Parsed dot separated field name, e.g. `nested_list[2].a`. Use compile_field to get one, paths are cached.
+    """
+    __slots__ = ('field', 'segments')
+
+    def __init__(self, field):
+        self.field = field
+        segments = []
+        while True:
+            try:
+                full_match, nested_field, index = split_field(field)
+            except ValueError:
+                if not segments:
+                    raise
+                # like nested lookups, an invalid rest of the field fails only if the value before it is found
+                segments.append((_invalid, None, field))
+                break
+            # the rest of the field is kept for error messages
+            segments.append((nested_field, index, field))
+            if full_match == field:
+                break
+            field = field[len(full_match) + 1:]
+        self.segments = tuple(segments)
+
+    def get(self, document, default=_default, flatten=True):
+        """
+        See get_value
+        """
+        value = document
+        for nested_field, index, field in self.segments:
+            if type(value) is not dict and not isinstance(value, Mapping):
+                raise TypeError('Only mapping type supported as a document')
+            if nested_field is _invalid:
+                raise ValueError('Invalid field: {}'.format(field))
+            try:
+                value = value[nested_field]
+            except KeyError:
+                if default is not _default:
+                    return default
+                raise KeyError('Field not found: {}'.format(field))
+            if index is not None:
+                if not isinstance(value, _list_types):
+                    raise TypeError('Nested value is not a list')
+                try:
+                    value = value[index]
+                except IndexError:
+                    if default is not _default:
+                        return default
+                    raise
+        return _flatten(value, flatten)
+
+    def set(self, document, value):
+        """
+        See set_value
+        """
+        last = len(self.segments) - 1
+        for position, (nested_field, index, field) in enumerate(self.segments):
+            if not isinstance(document, (dict, MutableMapping)):
+                raise TypeError('Only dict or MutableMapping type supported as a document.')
+            if nested_field is _invalid:
+                raise ValueError('Invalid field: {}'.format(field))
+            if position == last:
+                break
+            document = document.setdefault(nested_field, {})
+            if index is not None:
+                if isinstance(document, (list, MutableSequence)):
+                    document = document[index]
+                else:
+                    raise ValueError('Value should be list')
+
+        if index is not None:
+            try:
+                nested_value = document[nested_field]
+            except KeyError:
+                nested_value = [None] * (index + 1)
+                document[nested_field] = nested_value
+            else:
+                if isinstance(nested_value, (list, MutableSequence)):
+                    l = len(nested_value)
+                    if l <= index:
+                        nested_value += [None] * (index + 1 - l)
+                else:
+                    raise ValueError('Value should be list')
+            nested_value[index] = value
+        else:
+            document[nested_field] = value
+
+    def __repr__(self):
+        return '<FieldPath: {}>'.format(self.field)
+
+
+@lru_cache(maxsize=4096)
+def compile_field(field):
+    """
+    :param field: Dot separated field name
+    :type field: str
+    :return: Parsed field, cached by the name
+    :rtype: FieldPath
+    """
+    return FieldPath(field)
+
+
+def _flatten(value, flatten):
+    if flatten is None:
+        return value
+    if not flatten:
+        return dump_value(value)
+    else:
+        return flatten_value(value)
+
+
 def get_value(document, field, default=_default, flatten=True):
     """This function will try to get value from a document by the field name. Nested fields supported.
     For nested lists you can provide indexes in the form `nested_list[0]`.
@@ -117,8 +381,8 @@ def get_value(document, field, default=_default, flatten=True):
 
     :param document: Object to lookup field in
     :type document: dict or MappingView
-    :param field: dot separated field name
-    :type field: basestring
+    :param field: dot separated field name or compiled field
+    :type field: basestring or FieldPath
     :param default: Default value to return, if field not found in the document. If default is None -
      KeyError will be raised.
     :param: flatten: If set to None, value will be returned as is. If set to False - value will be dumped.
@@ -127,70 +391,113 @@ def get_value(document, field, default=_default, flatten=True):
     :return: if the field found in document, it's value will be converted to most simple format available.
      i.e. all dumpable values will be dumped, also the function will try to convert value to number.
     """
-    if not isinstance(document, (dict, MappingView)):
-        raise TypeError('Only mapping type supported as a document')
+    if not isinstance(field, FieldPath):
+        field = compile_field(field)
+    return field.get(document, default, flatten)
 
-    full_match, nested_field, index = split_field(field)
-    try:
-        value = document[nested_field]
-    except KeyError:
-        if default is not _default:
-            return default
-        raise KeyError('Field not found: {}'.format(field))
 
-    if index is not None:
-        if not isinstance(value, (tuple, list, ListView)):
-            raise TypeError('Nested value is not a list')
-        try:
-            value = value[int(index)]
-        except IndexError:
-            if default is not _default:
-                return default
-            raise
+class FieldPaths(object):
+    """
+    Many fields to get from a document in one traversal: fields are put into a tree by their segments, so common
+    parents, e.g. of `map.objects` and `map.tilegrid`, are looked up once. Use compile_fields to get one.
+    """
+    __slots__ = ('fields', '_root')
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        # node is (children, positions of fields, which end at the node), a child is (key, index, rest, node)
+        self._root = ([], [])
+        nodes = {}
+        for position, field in enumerate(self.fields):
+            node = self._root
+            path = ()
+            for nested_field, index, rest in compile_field(field).segments:
+                path += ((nested_field, index),)
+                try:
+                    node = nodes[path]
+                except KeyError:
+                    child = nodes[path] = ([], [])
+                    node[0].append((nested_field, index, rest, child))
+                    node = child
+            node[1].append(position)
+
+    def get(self, document, default=_default, flatten=True):
+        """
+        :param document: Object to lookup fields in
+        :type document: dict or MappingView
+        :param default: Default value of missing fields, KeyError is raised without it
+        :param flatten: See get_value
+        :return: Values in the order of fields
+        :rtype: list
+        """
+        values = [default] * len(self.fields)
+        stack = [(self._root, document)]
+        while stack:
+            node, value = stack.pop()
+            if type(value) is not dict and not isinstance(value, Mapping):
+                raise TypeError('Only mapping type supported as a document')
+            for nested_field, index, rest, child in node[0]:
+                if nested_field is _invalid:
+                    raise ValueError('Invalid field: {}'.format(rest))
+                try:
+                    nested_value = value[nested_field]
+                except KeyError:
+                    if default is _default:
+                        raise KeyError('Field not found: {}'.format(rest))
+                    continue
+                if index is not None:
+                    if not isinstance(nested_value, _list_types):
+                        raise TypeError('Nested value is not a list')
+                    try:
+                        nested_value = nested_value[index]
+                    except IndexError:
+                        if default is _default:
+                            raise
+                        continue
+                for position in child[1]:
+                    values[position] = _flatten(nested_value, flatten)
+                if child[0]:
+                    stack.append((child, nested_value))
+        return values
+
+
+@lru_cache(maxsize=1024)
+def compile_fields(fields):
+    """
+    :param fields: Dot separated field names
+    :type fields: tuple
+    :return: Parsed fields, cached by the names
+    :rtype: FieldPaths
+    """
+    return FieldPaths(fields)
 
-    if full_match != field:
-        field = field[len(full_match) + 1:]
-        return get_value(value, field, default, flatten)
 
-    if flatten is None:
-        return value
-    if not flatten:
-        return dump_value(value)
-    else:
-        return flatten_value(value)
+def get_values(document, fields, default=_default, flatten=True):
+    """Get many fields from a document in one traversal, see get_value.
 
+    Examples:
+        >>> document = {'nested_dict':{'a': 1, 'b': 2}, 'nested_list': [0, 1, {'a':1}]}
+        >>> get_values(document, ['nested_dict.a', 'nested_dict.b', 'nested_list[2].a'])
+        [1, 2, 1]
 
-def set_value(document, field, value):
-    if not isinstance(document, (dict, MutableMapping)):
-        raise TypeError('Only dict or MutableMapping type supported as a document.')
+    :param document: Object to lookup fields in
+    :type document: dict or MappingView
+    :param fields: Dot separated field names or compiled fields
+    :type fields: list or FieldPaths
+    :param default: Default value of missing fields, KeyError is raised without it
+    :param flatten: See get_value
+    :return: Values in the order of fields
+    :rtype: list
+    """
+    if not isinstance(fields, FieldPaths):
+        fields = compile_fields(tuple(fields))
+    return fields.get(document, default, flatten)
 
-    full_match, nested_field, index = split_field(field)
-    if full_match == field:
-        if index is not None:
-            try:
-                nested_value = document[nested_field]
-            except KeyError:
-                nested_value = [None] * (index + 1)
-                document[nested_field] = nested_value
-            else:
-                if isinstance(nested_value, list):
-                    l = len(nested_value)
-                    if l <= index:
-                        nested_value += [None] * (index + 1 - l)
-                else:
-                    raise ValueError('Value should be list')
-            nested_value[index] = value
-        else:
-            document[nested_field] = value
-    else:
-        nested_value = document.setdefault(nested_field, {})
-        if index is not None:
-            if isinstance(nested_value, list):
-                nested_value = nested_value[index]
-            else:
-                raise ValueError('Value should be list')
-        field = field[len(full_match) + 1:]
-        set_value(nested_value, field, value)
+
+def set_value(document, field, value):
+    if not isinstance(field, FieldPath):
+        field = compile_field(field)
+    field.set(document, value)
 
 
 def get_schema(documents, skip_nested=False, keep_none=False, nested_level=None):
@@ -235,7 +542,7 @@ class ListView(Sequence):
         return iter(self._data)
 
     def dump(self):
-        return list(map(dump_value, self))
+        return dump_value(list(self._data))
 
     def __str__(self):
         return 'ListView({})'.format(self.dump())
@@ -244,6 +551,10 @@ class ListView(Sequence):
         self.__str__()
 
 
+# lists of documents, including wrappers like views or journaled state lists
+_list_types = (tuple, list, ListView, MutableSequence)
+
+
 class MappingView(Mapping):
     def __init__(self, data=None):
         if data is None:
@@ -284,7 +595,11 @@ class MappingView(Mapping):
 
 
 class DictView(MappingView):
-    pass
+    def dump(self):
+        return dump_value(self._data)
+
+
+_view_types = frozenset((DictView,))
 
 
 class BaseDiffed(MappingView, MutableMapping):
@@ -292,12 +607,30 @@ class BaseDiffed(MappingView, MutableMapping):
 
 
 class Diffed(MappingView, MutableMapping):
-    def __init__(self, data=None, diffs=None):
+    """
+    Data with diffs applied over it. The value of a key is taken from the last diff, that has it, nested dicts are
+    looked up in all diffs.
+
+    In materialized mode effective values and keys are cached: a value is looked up in diffs once and then only
+    when its key is changed or a diff is added or removed. Nested values of such an object are materialized too.
+    Cached values are views of the data and diffs, so they see changes made through them, but the data and diffs
+    should not be changed other way, except with apply_diff. Nested objects of the same key share a change
+    counter, so an object taken before the cache of its parent was dropped can still be written to.
+    """
+
+    def __init__(self, data=None, diffs=None, materialized=False):
         if data is None:
             data = {}
         elif not isinstance(data, dict):
             raise TypeError('Only dicts supported. {object!s} given.'.format(object=data))
         super(Diffed, self).__init__(data)
+        self._materialized = materialized
+        # effective values and keys of materialized object
+        self._cache = {}
+        self._keys = None
+        # changes count of the objects over the same diffs and counters of their nested objects by key
+        self._counter = [0, {}]
+        self._seen = 0
         self._diffs = []
         if isinstance(diffs, dict):
             self.add_diff(diffs)
@@ -363,17 +696,62 @@ class Diffed(MappingView, MutableMapping):
             last_diff[item] = last_value
             diffs.append(last_value)
         if isinstance(value, (dict, DictView)):
-            return Diffed(value, diffs)
+            return self._nested(item, value, diffs)
         else:
-            return Diffed({}, diffs)
+            return self._nested(item, {}, diffs)
+
+    def _nested(self, item, data, diffs=None):
+        nested = Diffed(data, diffs, materialized=self._materialized)
+        if self._materialized:
+            counters = self._counter[1]
+            try:
+                counter = counters[item]
+            except KeyError:
+                counter = counters[item] = [0, {}]
+            nested._counter = counter
+            nested._seen = counter[0]
+        return nested
+
+    def _check_cache(self):
+        # another object over the same diffs has changed them
+        if self._seen != self._counter[0]:
+            self._invalidate()
+            self._seen = self._counter[0]
+
+    def _changed(self, nested=False):
+        """
+        Count a change made through this object, its own cache is kept up to date by the caller
+
+        :param nested: Nested values have been changed as well
+        :type nested: bool
+        """
+        counter = self._counter
+        counter[0] += 1
+        self._seen = counter[0]
+        if nested:
+            stack = list(counter[1].values())
+            while stack:
+                counter = stack.pop()
+                counter[0] += 1
+                stack.extend(counter[1].values())
 
     def __getitem__(self, item):
+        if not self._materialized:
+            return self._get_item(item)
+        self._check_cache()
+        try:
+            return self._cache[item]
+        except KeyError:
+            value = self._cache[item] = self._get_item(item)
+            return value
+
+    def _get_item(self, item):
         if not self._diffs:
             value = self._data[item]
             if value is None:
                 raise KeyError('{} not found'.format(item))
             elif isinstance(value, dict):
-                return Diffed(value)
+                return self._nested(item, value)
             else:
                 return view_value(value)
 
@@ -408,12 +786,26 @@ class Diffed(MappingView, MutableMapping):
             return view_value(value)
 
     def __contains__(self, item):
+        if self._materialized:
+            self._check_cache()
+            return item in self._effective_keys()
         for container in self.lookup():
             if item in container:
                 return container[item] is not None
         return False
 
+    def _effective_keys(self):
+        if self._keys is None:
+            self._keys = set(self._lookup_keys())
+        return self._keys
+
     def keys(self):
+        if self._materialized:
+            self._check_cache()
+            return list(self._effective_keys())
+        return self._lookup_keys()
+
+    def _lookup_keys(self):
         keys = set()
         lookup = list(self.lookup())
         for container in reversed(lookup):
@@ -434,6 +826,9 @@ class Diffed(MappingView, MutableMapping):
         return list(keys)
 
     def __len__(self):
+        if self._materialized:
+            self._check_cache()
+            return len(self._effective_keys())
         return len(list(self.keys()))
 
     def __iter__(self):
@@ -445,19 +840,53 @@ class Diffed(MappingView, MutableMapping):
         return self._diffs
 
     def add_diff(self, *diffs):
+        self._check_cache()
         for diff in diffs:
             if not isinstance(diff, (dict, DictView, type(None))):
                 raise TypeError(
                     'Only dicts, DictViews and Nones accepted. Got {} - {}'.format(diff.__class__.__name__, diff))
             self._diffs.append(diff)
+            self._invalidate_diff(diff)
+        self._changed()
 
     def remove_diff(self, *diffs):
+        self._check_cache()
         for diff in diffs:
             self._diffs.remove(diff)
+            self._invalidate_diff(diff)
+            self._keys = None
+        self._changed()
+
+    def _invalidate_diff(self, diff):
+        if not isinstance(diff, dict):
+            # deleted object or a view, that hides diffs below it
+            self._invalidate()
+            return
+        cache = self._cache
+        for key, value in diff.items():
+            cache.pop(key, None)
+            if self._keys is not None:
+                if value is None:
+                    self._keys.discard(key)
+                else:
+                    self._keys.add(key)
+        # nested values write into the last diff, which has been changed
+        for key in [key for key, value in cache.items() if isinstance(value, Diffed)]:
+            del cache[key]
+
+    def _invalidate(self, item=_default):
+        if item is _default:
+            self._cache = {}
+            self._keys = None
+        else:
+            self._cache.pop(item, None)
 
     def apply_diff(self, *diffs):
         for diff in diffs:
             merge(self._data, diff)
+        self._invalidate()
+        # nested dicts of the data are merged in place
+        self._changed(nested=True)
 
     def flatten_diff(self, *diffs):
         self.apply_diff(*diffs)
@@ -469,20 +898,34 @@ class Diffed(MappingView, MutableMapping):
     def __setitem__(self, item, value):
         if not self._diffs:
             raise RuntimeError('Assign at least a one diff to Diffed in order to set value.')
+        self._check_cache()
         diff = self.get_current_diff()
         if diff is None:
             diff = {}
             self._diffs[-1] = diff
+            self._invalidate()
         if isinstance(value, (type(None), int, float, str, list, set, tuple, dict, DictView)):
             diff[item] = value
         else:
             raise ValueError('Type not supported: {value_type}'.format(value_type=type(value)))
+        self._invalidate(item)
+        if self._keys is not None:
+            if value is None:
+                self._keys.discard(item)
+            else:
+                self._keys.add(item)
+        self._changed()
 
     def __delitem__(self, item):
         if not self._diffs:
             raise RuntimeError('Assign at least a one diff to Diffed in order to remove value.')
+        self._check_cache()
         diff = self.get_current_diff()
         diff[item] = None
+        self._invalidate(item)
+        if self._keys is not None:
+            self._keys.discard(item)
+        self._changed()
 
     def setdefault(self, key, default=None):
         if key not in self:
@@ -585,11 +1028,89 @@ def check_data_format(data_format=JSON):
     return _module
 
 
+def _encode_default(value):
+    """
+    Called by json and msgpack encoders for values, they don't support. Views are given to encoders as their
+    data, so they are encoded without being dumped to a plain copy first.
+    """
+    if type(value) in (DictView, ListView):
+        return value._data
+    if hasattr(value, 'dump'):
+        return value.dump()
+    if isinstance(value, (set, GeneratorType)):
+        return list(value)
+    raise TypeError('Type {} is not encodable'.format(type(value)))
+
+
 def encode_data(data, data_format=JSON):
     _module = check_data_format(data_format)
+    if data_format in (JSON, MSGPACK):
+        return _module.dumps(data, default=_encode_default)
     return _module.dumps(data)
 
 
+def encode_data_with(data, encoded, data_format=JSON):
+    """
+    Encode a dict along with values, that are already encoded in the same format, e.g. content shared by many
+    responses and encoded once. Encoded values are copied into the result as they are for JSON and msgpack,
+    other formats decode them first.
+
+    :param data: Values to encode
+    :type data: dict
+    :param encoded: Encoded values by key, keys should not be in data
+    :type encoded: dict
+    :return: Encoded dict of both values
+    :rtype: bytes
+    """
+    _module = check_data_format(data_format)
+    if data_format == JSON:
+        parts = [_module.dumps(key).encode('utf-8') + b': ' + value for key, value in encoded.items()]
+        if data:
+            parts.append(encode_data(data, JSON)[1:-1].encode('utf-8'))
+        return b'{' + b', '.join(parts) + b'}'
+    if data_format == MSGPACK:
+        packer = _module.Packer(default=_encode_default)
+        parts = [packer.pack_map_header(len(data) + len(encoded))]
+        for key, value in encoded.items():
+            parts.append(packer.pack(key))
+            parts.append(value)
+        for key, value in data.items():
+            parts.append(packer.pack(key))
+            parts.append(packer.pack(value))
+        return b''.join(parts)
+    data = dict(data)
+    for key, value in encoded.items():
+        data[key] = decode_data(value.decode('utf-8'), data_format)
+    encoded_data = encode_data(data, data_format)
+    if isinstance(encoded_data, str):
+        encoded_data = encoded_data.encode('utf-8')
+    return encoded_data
+
+
+def iter_json(data, chunk_size=65536):
+    """
+    Encode data to json by chunks, without building neither a plain copy of the data nor the whole json string
+
+    :param data: Data to encode, views and objects with dump method are supported
+    :param chunk_size: Approximate chunk size in characters
+    :type chunk_size: int
+    :return: Generator of utf-8 encoded chunks
+    """
+    import json
+
+    parts = []
+    size = 0
+    for part in json.JSONEncoder(default=_encode_default).iterencode(data):
+        parts.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+            size = 0
+    if parts:
+        yield ''.join(parts).encode('utf-8')
+
+
 def decode_data(data, data_format=JSON):
     _module = check_data_format(data_format)
     return _module.loads(data)
@@ -1,5 +1,6 @@
-from bisect import insort_left
+from bisect import bisect_right, insort_left
 from collections import MutableMapping, OrderedDict
+import math
 import random
 import struct
 import hashlib
@@ -110,6 +111,207 @@ class Median(object):
         return self.__repr__()
 
 
+class QuantileSketch(object):
+    """
+    Fixed memory replacement of Median: values are counted in buckets with logarithmically growing bounds, so
+    a quantile is estimated with the given relative error, whatever the values count is. Adding a value is O(1),
+    sketches with the same accuracy can be merged, e.g. to combine stats of all game processes.
+
+    Values are expected to be non-negative, like times, negative ones are counted as zeros.
+    """
+    __slots__ = ('relative_accuracy', 'max_buckets', 'counts', 'zero_count', 'count', 'sum', '_min', '_max',
+                 '_gamma', '_multiplier', '_indices')
+
+    def __init__(self, *args, relative_accuracy=0.01, max_buckets=2048):
+        """
+        :param args: Initial values
+        :param relative_accuracy: Relative error of quantile estimates
+        :type relative_accuracy: float
+        :param max_buckets: Buckets limit, when it's reached, the lowest buckets are merged, so only low
+         quantiles lose accuracy
+        :type max_buckets: int
+        """
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / math.log(self._gamma)
+        self.clear()
+        for value in args:
+            self += value
+
+    def __add__(self, other):
+        value = float(other)
+        self.count += 1
+        self.sum += value
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+        if value <= 0:
+            self.zero_count += 1
+            return self
+        index = math.ceil(math.log(value) * self._multiplier)
+        counts = self.counts
+        try:
+            counts[index] += 1
+        except KeyError:
+            counts[index] = 1
+            insort_left(self._indices, index)
+            if len(counts) > self.max_buckets:
+                self._collapse()
+        return self
+
+    def _collapse(self):
+        # bucket indices are kept sorted, so the lowest ones are at hand without sorting on every insert
+        lowest = self._indices.pop(0)
+        self.counts[self._indices[0]] += self.counts.pop(lowest)
+
+    def merge(self, other):
+        """
+        Add values of other sketch with the same accuracy
+
+        :type other: QuantileSketch
+        :return: self
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Only sketches with the same accuracy can be merged')
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self._indices = sorted(self.counts)
+        while len(self.counts) > self.max_buckets:
+            self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if other._min is not None and (self._min is None or other._min < self._min):
+            self._min = other._min
+        if other._max is not None and (self._max is None or other._max > self._max):
+            self._max = other._max
+        return self
+
+    def clear(self):
+        self.counts = {}
+        self._indices = []
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0
+        self._min = None
+        self._max = None
+
+    def quantile(self, q):
+        """
+        :param q: Quantile from 0 to 1
+        :type q: float
+        :return: Estimated value of the quantile, 0 if there are no values
+        :rtype: float
+        """
+        return self.quantiles(q)[0]
+
+    def quantiles(self, *qs):
+        """
+        Estimate several quantiles in one pass over the buckets
+
+        :param qs: Quantiles from 0 to 1
+        :type qs: float
+        :return: Estimated values in the order of quantiles, 0 if there are no values
+        :rtype: list
+        """
+        values = [0] * len(qs)
+        if not self.count:
+            return values
+        last = self.count - 1
+        ranks = sorted((q * last, position) for position, q in enumerate(qs))
+        ranks.reverse()
+        seen = self.zero_count
+        while ranks and seen > ranks[-1][0]:
+            values[ranks.pop()[1]] = max(self._min, 0)
+        counts = self.counts
+        gamma = self._gamma
+        for index in self._indices:
+            if not ranks:
+                break
+            seen += counts[index]
+            if seen > ranks[-1][0]:
+                value = min(max(2 * gamma ** index / (gamma + 1), self._min), self._max)
+                while ranks and seen > ranks[-1][0]:
+                    values[ranks.pop()[1]] = value
+        for _, position in ranks:
+            values[position] = self._max
+        return values
+
+    @property
+    def min(self):
+        return self._min or 0
+
+    @property
+    def max(self):
+        return self._max or 0
+
+    @property
+    def len(self):
+        return self.count
+
+    @property
+    def avg(self):
+        return self.sum / max(self.count, 1)
+
+    @property
+    def med(self):
+        return self.quantile(0.5)
+
+    @property
+    def p50(self):
+        return self.quantile(0.5)
+
+    @property
+    def p90(self):
+        return self.quantile(0.9)
+
+    @property
+    def p99(self):
+        return self.quantile(0.99)
+
+    @property
+    def p999(self):
+        return self.quantile(0.999)
+
+    def dump(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'counts': [[index, count] for index, count in sorted(self.counts.items())],
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'sum': self.sum,
+            'min': self._min,
+            'max': self._max,
+        }
+
+    @classmethod
+    def load(cls, data):
+        """
+        :param data: Dumped sketch
+        :type data: dict
+        :rtype: QuantileSketch
+        """
+        sketch = cls(relative_accuracy=data['relative_accuracy'])
+        sketch.counts = dict((index, count) for index, count in data['counts'])
+        sketch._indices = sorted(sketch.counts)
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        sketch._min = data['min']
+        sketch._max = data['max']
+        return sketch
+
+    def __repr__(self):
+        med, p90, p99, p999 = self.quantiles(0.5, 0.9, 0.99, 0.999)
+        return ('<QuantileSketch: (min: {:.1f}, max: {:.1f}, med: {:.1f}, avg: {:.2f}, p90: {:.1f}, p99: {:.1f}, '
+                'p999: {:.1f})>').format(self.min, self.max, med, self.avg, p90, p99, p999)
+
+    def __str__(self):
+        return self.__repr__()
+
+
 class WeightedItem(object):
     __slots__ = 'name', 'weight', 'toughness', 'hunger'
 
@@ -127,6 +329,13 @@ class WeightedItem(object):
 
 
 class Weights(MutableMapping):
+    """
+    Mutable weights to choose items by. Cumulative weights are recalculated on the first choice after a change,
+    a choice itself is a binary search. For many choices with weights changed in between, use FenwickSampler.
+    """
+    # module or random.Random instance, set it to get reproducible choices
+    random = random
+
     def __init__(self, **kwargs):
         self._items = {}
         self._updated = True
@@ -134,6 +343,9 @@ class Weights(MutableMapping):
         self._len = 0
         self._first = None
         self._last = None
+        self._names = []
+        self._toughness = []
+        self._hunger = []
         self.update(kwargs)
 
     def __getitem__(self, item):
@@ -178,7 +390,7 @@ class Weights(MutableMapping):
         total = self._total = t
 
         t = 0
-        c = l - 1
+        c = max(l - 1, 1)
         for item in items:
             t += float(total - item.weight) / c
             item.hunger = t
@@ -187,9 +399,12 @@ class Weights(MutableMapping):
         for item in items:
             self._items[item.name] = item
         self._first = items[0]
+        self._names = [item.name for item in items]
+        self._toughness = [item.toughness for item in items]
+        self._hunger = [item.hunger for item in items]
 
     def roll(self):
-        return random.random() * self._total
+        return self.random.random() * self._total
 
     def choice(self, thin=False):
         if self._updated:
@@ -202,16 +417,10 @@ class Weights(MutableMapping):
             else:
                 raise IndexError('Nothing to choose')
 
-        r = self.roll()
-        if not thin:
-            for item in self._items.values():
-                if r < item.toughness:
-                    return item.name
-        else:
-            for item in self._items.values():
-                if r < item.hunger:
-                    return item.name
-
+        heights = self._hunger if thin else self._toughness
+        index = bisect_right(heights, self.roll())
+        if index < self._len:
+            return self._names[index]
         raise IndexError('Nothing to choose')
 
     def __repr__(self):
@@ -219,3 +428,186 @@ class Weights(MutableMapping):
 
     def __str__(self):
         return self.__repr__()
+
+
+def weighted_choice(names, weights, random=random):
+    """
+    Choose one item by weights, for a single choice it's cheaper, than building a sampler
+
+    :param names: Items
+    :type names: list
+    :param weights: Non-negative weights of the items
+    :type weights: list
+    :param random: Random generator
+    :return: Chosen item
+    """
+    heights = []
+    total = 0
+    for weight in weights:
+        total += weight
+        heights.append(total)
+    if not total:
+        raise IndexError('Nothing to choose')
+    index = bisect_right(heights, random.random() * total)
+    # float rounding could push the roll up to the total
+    return names[min(index, len(names) - 1)]
+
+
+class AliasSampler(object):
+    """
+    Sampler for static weights by Vose's alias method: it's built in O(n), every choice is O(1) and takes one random
+    number. Build it once for a loot table, that is rolled many times.
+    """
+    __slots__ = ('names', 'probabilities', 'aliases', 'random')
+
+    def __init__(self, weights, random=random):
+        """
+        :param weights: Non-negative weights by item
+        :type weights: dict
+        :param random: Random generator
+        """
+        self.names = list(weights.keys())
+        self.random = random
+        count = len(self.names)
+        total = sum(weights.values())
+        if not count or total <= 0:
+            raise IndexError('Cannot choose from nothing.')
+        scaled = [float(weights[name]) * count / total for name in self.names]
+        if min(scaled) < 0:
+            raise ValueError('Value should be positive or zero.')
+        self.probabilities = [1.0] * count
+        self.aliases = list(range(count))
+        small = [index for index, value in enumerate(scaled) if value < 1]
+        large = [index for index, value in enumerate(scaled) if value >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+        # leftovers are 1 up to float rounding
+        for index in small + large:
+            self.probabilities[index] = 1.0
+
+    def choice(self):
+        value = self.random.random() * len(self.names)
+        index = int(value)
+        if value - index < self.probabilities[index]:
+            return self.names[index]
+        return self.names[self.aliases[index]]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class FenwickSampler(MutableMapping):
+    """
+    Sampler for weights, that change between choices, on a Fenwick (binary indexed) tree: both a weight change and
+    a choice are O(log n). Removed items leave free slots, which are reused by new items.
+    """
+
+    def __init__(self, weights=None, random=random):
+        """
+        :param weights: Non-negative weights by item
+        :type weights: dict
+        :param random: Random generator
+        """
+        self.random = random
+        self._index = {}
+        self._names = []
+        self._weights = []
+        self._tree = [0]
+        self._free = []
+        if weights:
+            self.update(weights)
+
+    def _add(self, index, delta):
+        tree = self._tree
+        index += 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+
+    def _grow(self, name):
+        # new slot's node covers the slots below it, whose sum is the prefix sum difference
+        index = len(self._names)
+        self._names.append(name)
+        self._weights.append(0)
+        position = index + 1
+        lowest = position - (position & -position)
+        self._tree.append(self._prefix_sum(index) - self._prefix_sum(lowest))
+        return index
+
+    def _prefix_sum(self, count):
+        tree = self._tree
+        total = 0
+        while count > 0:
+            total += tree[count]
+            count -= count & -count
+        return total
+
+    @property
+    def total(self):
+        return self._prefix_sum(len(self._names))
+
+    def __getitem__(self, name):
+        return self._weights[self._index[name]]
+
+    def __setitem__(self, name, weight):
+        if weight < 0:
+            raise ValueError('Value should be positive or zero.')
+        try:
+            index = self._index[name]
+        except KeyError:
+            if self._free:
+                index = self._free.pop()
+                self._names[index] = name
+            else:
+                index = self._grow(name)
+            self._index[name] = index
+        self._add(index, weight - self._weights[index])
+        self._weights[index] = weight
+
+    def __delitem__(self, name):
+        index = self._index.pop(name)
+        self._add(index, -self._weights[index])
+        self._weights[index] = 0
+        self._names[index] = None
+        self._free.append(index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(list(self._index))
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def choice(self):
+        total = self.total
+        if total <= 0:
+            raise IndexError('Nothing to choose')
+        value = self.random.random() * total
+        tree = self._tree
+        size = len(tree) - 1
+        position = 0
+        step = 1 << size.bit_length()
+        # descend to the last position, which prefix sum is not greater than the value
+        while step:
+            next_position = position + step
+            if next_position <= size and tree[next_position] <= value:
+                position = next_position
+                value -= tree[next_position]
+            step >>= 1
+        if position >= size:
+            # float rounding could push the value up to the total
+            position = max(index for index, weight in enumerate(self._weights) if weight)
+        return self._names[position]
+
+    def __repr__(self):
+        return '<FenwickSampler: {}>'.format(dict(self.items()))